@@ -0,0 +1,219 @@
+import os, sys
+import json
+import glob
+import hashlib
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+from ssastore import ShardReader, is_store, unpack_arrays, label_of, method_of_file
+from features import ssa_arrays, instruction_rows, MAX_ARGS
+from methodsdb import open_methods_db
+
+# On-disk feature tensors, built once and memory-mapped by later runs. A cache directory holds
+#   manifest.json        - format version, methods DB version, generation, rows in use and one
+#                          entry per method: [name, label, stamp, first row, rows, max var]
+#   targets-<gen>.bin    - int32 [rows]            raw target var per instruction (-1 no target)
+#   funcs-<gen>.bin      - int32 [rows]            function id per instruction
+#   args-<gen>.bin       - int32 [rows, MAX_ARGS]  argument vars, 0 padded
+# Vocabulary limits are applied when batches are encoded, so one cache serves any
+# --max-len/--max-vars. The stamp of a method is metadata only (its index row in a store, size
+# and mtime of a JSON file), so checking a cache reads no SSA. Updating vectorizes the new and
+# changed methods and appends their rows; rows of changed or removed methods stay behind until
+# they outnumber the live ones, then the live rows are compacted into a new generation. The
+# manifest is replaced last and readers only map the rows it lists, so they never see a half
+# written cache.
+
+CACHE_VERSION = 2
+MANIFEST = "manifest.json"
+ARRAYS = ("targets", "funcs", "args")
+SHAPES = ((), (), (MAX_ARGS,))
+DTYPE = numpy.dtype("<i4")
+
+def methods_db_digest(methods_db, count=None):
+    # hash of the first count (all) names in ID order; the DB is append-only, so a cache built
+    # against a prefix of it still has valid function ids
+    h = hashlib.sha1()
+    for name, index in sorted(methods_db.items(), key=lambda e: e[1]):
+        if count is not None and index > count:
+            break
+        h.update(f"{index} {name}\n".encode())
+    return h.hexdigest()
+
+def methods_db_version(methods_db):
+    return {"count": len(methods_db), "digest": methods_db_digest(methods_db)}
+
+def load_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CACHE_VERSION or manifest.get("max_args") != MAX_ARGS:
+        return None
+    return manifest
+
+def array_path(path, name, generation):
+    return os.path.join(path, f"{name}-{generation}.bin")
+
+def open_arrays(path, generation, rows):
+    # the first rows rows; an update may have appended more that aren't in the manifest yet
+    if rows == 0:
+        return [numpy.zeros((0,) + shape, dtype=DTYPE) for shape in SHAPES]
+    return [numpy.memmap(array_path(path, name, generation), dtype=DTYPE, mode="r", shape=(rows,) + shape) for name, shape in zip(ARRAYS, SHAPES)]
+
+def compatible(manifest, methods_db):
+    old = manifest["methods_db"]
+    return old["count"] <= len(methods_db) and methods_db_digest(methods_db, old["count"]) == old["digest"]
+
+def list_stamps(ssa_dir):
+    # (name, label, location, stamp) sorted by name, from metadata only
+    items = []
+    if is_store(ssa_dir):
+        reader = ShardReader(ssa_dir)
+        try:
+            for e in reader.Entries():
+                if e.label is None:
+                    raise ValueError("No label indicator in method name")
+                items.append((f"{e.cls} {e.method}", e.label, (e.shard, e.offset, e.size), [e.shard, e.offset, e.size]))
+        finally:
+            reader.Close()
+    else:
+        with os.scandir(ssa_dir) as it:
+            for e in it:
+                y = label_of(method_of_file(e.name)) # not the class path, it may contain good/bad
+                if y is None:
+                    raise ValueError("No label indicator in file name")
+                st = e.stat()
+                items.append((e.name, y, e.name, [st.st_size, st.st_mtime_ns]))
+    items.sort(key=lambda item: item[0])
+    return items
+
+def read_record(ssa_dir, reader, location):
+    if reader is None:
+        with open(os.path.join(ssa_dir, location), 'rb') as fp:
+            return fp.read()
+    shard, offset, size = location
+    return reader.shard_map(shard)[offset:offset + size]
+
+def record_rows(buf, store):
+    arrays = unpack_arrays(buf) if store else ssa_arrays(json.loads(buf))
+    return instruction_rows(arrays)
+
+class RowWriter(object):
+    # appends rows to the arrays of a generation, after the rows a manifest has in use
+    def __init__(self, path, generation, rows):
+        self.rows = rows
+        self.files = []
+        for name, shape in zip(ARRAYS, SHAPES):
+            fp = open(array_path(path, name, generation), "ab")
+            # what an interrupted update left behind goes
+            fp.truncate(rows * DTYPE.itemsize * (shape[0] if shape else 1))
+            self.files.append(fp)
+
+    def Append(self, rows):
+        offset = self.rows
+        for fp, a in zip(self.files, rows):
+            fp.write(numpy.ascontiguousarray(a, dtype=DTYPE).tobytes())
+        self.rows += len(rows[0])
+        return offset
+
+    def Close(self):
+        for fp in self.files:
+            fp.close()
+
+class FeatureCache(object):
+    # read-only view of a cache; rows are slices of the memory maps, nothing is copied
+    def __init__(self, path):
+        manifest = load_manifest(path)
+        if manifest is None:
+            raise ValueError(f"No feature cache in {path}")
+        self.path = path
+        self.manifest = manifest
+        self.targets, self.funcs, self.args = open_arrays(path, manifest["generation"], manifest["rows"])
+        self.labels = numpy.array([entry[1] for entry in manifest["methods"]], dtype=numpy.float32)
+
+    def Items(self):
+        # loader.list_methods() items with the first row as location
+        return [(name, label, offset, count, max_var) for name, label, _, offset, count, max_var in self.manifest["methods"]]
+
+    def Rows(self, offset, count):
+        return self.targets[offset:offset + count], self.funcs[offset:offset + count], self.args[offset:offset + count]
+
+    def __len__(self):
+        return len(self.manifest["methods"])
+
+def update(ssa_dir, path, methods_db):
+    # returns the up to date cache and (reused, vectorized) method counts
+    os.makedirs(path, exist_ok=True)
+    items = list_stamps(ssa_dir)
+    previous = load_manifest(path)
+    manifest = previous
+    if manifest is not None and (manifest["ssa_dir"] != os.path.abspath(ssa_dir) or not compatible(manifest, methods_db)):
+        manifest = None # other SSA or changed function ids, everything is vectorized again
+    old = {entry[0]: entry for entry in manifest["methods"]} if manifest is not None else {}
+    kept = [old[name] for name, _, _, stamp in items if name in old and old[name][2] == stamp]
+    if manifest is not None and len(kept) == len(items) == len(old):
+        return FeatureCache(path), (len(items), 0)
+    live = sum(entry[4] for entry in kept)
+    if manifest is None or manifest["rows"] - live > live:
+        # new cache, or more dead rows than live ones: the kept rows move to a new generation
+        # never the generation the current manifest points to, readers may have it mapped
+        generation = previous["generation"] + 1 if previous is not None else 0
+        rows = 0
+    else:
+        generation = manifest["generation"]
+        rows = manifest["rows"]
+    old_arrays = open_arrays(path, manifest["generation"], manifest["rows"]) if manifest is not None and rows == 0 else None
+    store = is_store(ssa_dir)
+    reader = ShardReader(ssa_dir) if store else None
+    out = RowWriter(path, generation, rows)
+    entries = []
+    vectorized = 0
+    try:
+        for name, label, location, stamp in items:
+            entry = old.get(name)
+            if entry is not None and entry[2] == stamp:
+                if old_arrays is None:
+                    entries.append(entry)
+                    continue
+                offset = out.Append([a[entry[3]:entry[3] + entry[4]] for a in old_arrays])
+                entries.append([name, label, stamp, offset, entry[4], entry[5]])
+                continue
+            new_rows = record_rows(read_record(ssa_dir, reader, location), store)
+            vectorized += 1
+            max_var = int(max(new_rows[0].max(initial=0), new_rows[2].max(initial=0)))
+            entries.append([name, label, stamp, out.Append(new_rows), len(new_rows[0]), max_var])
+    finally:
+        out.Close()
+        if reader is not None:
+            reader.Close()
+    del old_arrays
+
+    manifest = {"version": CACHE_VERSION, "max_args": MAX_ARGS, "generation": generation, "rows": out.rows, "ssa_dir": os.path.abspath(ssa_dir),
+                "methods_db": methods_db_version(methods_db), "methods": entries}
+    tmp = os.path.join(path, f"{MANIFEST}.{os.getpid()}")
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+    # earlier generations (and caches of the previous format); open readers keep their maps
+    for f in glob.glob(os.path.join(path, "*.bin")) + glob.glob(os.path.join(path, "*.npy")):
+        if not f.endswith(f"-{generation}.bin"):
+            os.remove(f)
+    return FeatureCache(path), (len(items) - vectorized, vectorized)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the memory-mapped feature cache of an SSA corpus")
+    parser.add_argument("methods_db", help="methods db (.json or SQLite store) the SSA was generated with")
+    parser.add_argument("ssa_dir", help="SSA store or directory of JSON .ssa files")
+    parser.add_argument("cache_dir", help="feature cache directory, created if missing")
+    args = parser.parse_args()
+    if not os.path.isfile(args.methods_db):
+        print("[!] Invalid methods db path.")
+        sys.exit(1)
+    if not os.path.isdir(args.ssa_dir):
+        print("[!] Invalid ssa dir path.")
+        sys.exit(1)
+    cache, (reused, vectorized) = update(args.ssa_dir, args.cache_dir, open_methods_db(args.methods_db))
+    print(f"Feature cache: {len(cache)} methods, {len(cache.targets)} instructions, {reused} reused, {vectorized} vectorized")
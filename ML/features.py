@@ -0,0 +1,84 @@
+import numpy
+
+# Index features of an SSA method: per instruction the target var, the function id and up to
+# MAX_ARGS argument vars, as int32 arrays padded with 0. The model embeds them, which is the
+# same as multiplying the old one-hot/multi-hot rows with a weight matrix, without ever
+# materializing VARS_SIZE * 2 + FUNCS_SIZE wide rows.
+
+VARS_SIZE = 100 # default var vocabulary, var ids above it are folded into the last index
+MAX_LEN = 100 # default instructions per sample, see window()
+MAX_ARGS = 8 # args per instruction, the rest are dropped
+NO_TARGET = -1
+
+# what happens to methods longer than max_len
+LONG_POLICIES = ("head", "tail", "window")
+
+def ssa_arrays(ssa_data):
+    # the list form ([[target, func, [args]], ...]) as the (targets, funcs, ends, args) arrays
+    # that ssastore.ShardReader.ReadArrays returns
+    count = len(ssa_data)
+    targets = numpy.fromiter((NO_TARGET if t is None else t for t, _, _ in ssa_data), numpy.int32, count)
+    funcs = numpy.fromiter((f for _, f, _ in ssa_data), numpy.int32, count)
+    lengths = numpy.fromiter((len(a) for _, _, a in ssa_data), numpy.int32, count)
+    ends = numpy.cumsum(lengths, dtype=numpy.int32)
+    args = numpy.fromiter((a for _, _, inst_args in ssa_data for a in inst_args), numpy.int32, int(ends[-1]) if count else 0)
+    return targets, funcs, ends, args
+
+def windows(count, max_len=MAX_LEN, policy="head", stride=None):
+    # (start, length) samples taken from a method of count instructions
+    if count <= max_len:
+        return [(0, count)]
+    if policy == "head":
+        return [(0, max_len)]
+    if policy == "tail":
+        return [(count - max_len, max_len)]
+    stride = stride or max_len // 2 or 1
+    starts = list(range(0, count - max_len + 1, stride))
+    if starts[-1] != count - max_len:
+        starts.append(count - max_len)
+    return [(s, max_len) for s in starts]
+
+def var_index(v, vars_size):
+    # 0 is padding/no var
+    return numpy.where(v < 0, 0, numpy.minimum(v, vars_size))
+
+def instruction_rows(arrays, max_args=MAX_ARGS):
+    # raw (targets, funcs, args[count, max_args]) of a method, args padded with 0; this is what
+    # featurecache.py stores, the vocabulary limits are applied by encode_rows()
+    targets, funcs, ends, args = (numpy.asarray(a, dtype=numpy.int32) for a in arrays)
+    rows = numpy.zeros((len(targets), max_args), numpy.int32)
+    if len(args):
+        counts = numpy.diff(ends, prepend=0)
+        inst = numpy.repeat(numpy.arange(len(counts)), counts)
+        pos = numpy.arange(len(args)) - numpy.repeat(ends - counts, counts)
+        keep = pos < max_args
+        rows[inst[keep], pos[keep]] = args[keep]
+    return targets, funcs, rows
+
+def encode_rows(rows, row, T, F, A, funcs_size, vars_size=VARS_SIZE, start=0, length=None):
+    # writes instructions [start, start + length) of instruction_rows() into row of the batch arrays
+    targets, funcs, args = rows
+    stop = len(targets) if length is None else min(len(targets), start + length)
+    n = max(0, min(stop - start, T.shape[1]))
+    stop = start + n
+    T[row, :n] = var_index(targets[start:stop], vars_size)
+    F[row, :n] = numpy.minimum(funcs[start:stop], funcs_size - 1)
+    A[row, :n] = var_index(args[start:stop], vars_size)
+    return n
+
+def encode(arrays, row, T, F, A, funcs_size, vars_size=VARS_SIZE, start=0, length=None):
+    return encode_rows(instruction_rows(arrays, A.shape[2]), row, T, F, A, funcs_size, vars_size, start, length)
+
+def allocate(count, max_len=MAX_LEN):
+    T = numpy.zeros((count, max_len), numpy.int32)
+    F = numpy.zeros((count, max_len), numpy.int32)
+    A = numpy.zeros((count, max_len, MAX_ARGS), numpy.int32)
+    return T, F, A
+
+def encode_batch(methods, funcs_size, max_len=MAX_LEN, vars_size=VARS_SIZE, spans=None):
+    # methods is a list of (targets, funcs, ends, args) arrays, spans optional (start, length)
+    T, F, A = allocate(len(methods), max_len)
+    for row, arrays in enumerate(methods):
+        start, length = spans[row] if spans is not None else (0, None)
+        encode(arrays, row, T, F, A, funcs_size, vars_size, start, length)
+    return T, F, A
@@ -0,0 +1,216 @@
+import os, sys
+import json
+import math
+import queue
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from keras.utils import Sequence
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+from ssastore import ShardReader, is_store, label_of, method_of_file, unpack_arrays
+from features import ssa_arrays, encode_batch, encode_rows, allocate, windows, MAX_LEN
+
+# Streams training batches from an SSA store or a directory of JSON .ssa files. Only the list
+# of (name, label, location, instruction count, max var) is kept in memory; methods are read
+# and encoded per batch. Samples of similar length are batched together (buckets), so a batch
+# is only padded to its own bucket length. With a featurecache.FeatureCache the instructions
+# are sliced out of its memory-mapped tensors instead.
+
+def list_methods(ssa_dir):
+    # sorted by name, so the order doesn't depend on the file system or on the writers
+    items = []
+    if is_store(ssa_dir):
+        reader = ShardReader(ssa_dir)
+        try:
+            for e in reader.Entries():
+                if e.label is None:
+                    raise ValueError("No label indicator in method name")
+                items.append((f"{e.cls} {e.method}", e.label, (e.shard, e.offset, e.size), e.count, e.max_var))
+        finally:
+            reader.Close()
+    else:
+        # JSON has no index, the files are parsed once for their sizes
+        for f in os.listdir(ssa_dir):
+            y = label_of(method_of_file(f)) # not the class path, it may contain good/bad
+            if y is None:
+                raise ValueError("No label indicator in file name")
+            with open(os.path.join(ssa_dir, f), 'r') as fp:
+                ssa_data = json.load(fp)
+            max_var = max((max([t or 0] + a) for t, _, a in ssa_data), default=0)
+            items.append((f, y, f, len(ssa_data), max_var))
+    items.sort()
+    return items
+
+def data_dims(items, max_len, max_vars):
+    # (sample length, var vocabulary) from the data, capped by the configured limits
+    longest = max((item[3] for item in items), default=1)
+    known = [item[4] for item in items if item[4] is not None]
+    vars_size = min(max(known), max_vars) if len(known) == len(items) and known else max_vars
+    return max(1, min(longest, max_len)), max(1, vars_size)
+
+def samples(items, max_len=MAX_LEN, policy="head", stride=None):
+    # (name, label, location, start, length); a long method gives one sample per window
+    result = []
+    for name, label, location, count, _ in items:
+        for start, length in windows(count, max_len, policy, stride):
+            result.append((name, label, location, start, length))
+    return result
+
+def bucket_bounds(max_len, smallest=16):
+    bounds = []
+    b = smallest
+    while b < max_len:
+        bounds.append(b)
+        b *= 2
+    bounds.append(max_len)
+    return bounds
+
+def name_hash(name, seed):
+    return int(hashlib.sha1(f"{seed}:{name}".encode()).hexdigest()[:8], 16)
+
+def split(items, test_size=0.20, seed=77):
+    # a method's side only depends on its name and the seed, not on the rest of the corpus
+    train, test = [], []
+    for item in items:
+        (test if name_hash(item[0], seed) < test_size * 0x100000000 else train).append(item)
+    return train, test
+
+def kfold(items, folds, seed=77):
+    # [(train, test)] per fold, a method's fold is picked by the same name hash as split()
+    parts = [[] for _ in range(folds)]
+    for item in items:
+        parts[name_hash(item[0], seed) % folds].append(item)
+    return [([item for j, part in enumerate(parts) if j != i for item in part], parts[i]) for i in range(folds)]
+
+_readers = {}
+
+def decode(ssa_dir, locations):
+    # runs in the prefetch thread or in decoder processes, each keeps its own store reader
+    if not is_store(ssa_dir):
+        methods = []
+        for f in locations:
+            with open(os.path.join(ssa_dir, f), 'r') as fp:
+                methods.append(ssa_arrays(json.load(fp)))
+        return methods
+    if ssa_dir not in _readers:
+        _readers[ssa_dir] = ShardReader(ssa_dir)
+    reader = _readers[ssa_dir]
+    return [unpack_arrays(reader.shard_map(shard)[offset:offset + size]) for shard, offset, size in locations]
+
+class SSASequence(Sequence):
+    def __init__(self, ssa_dir, samples, funcs_size, vars_size, max_len, batch_size=64, shuffle=True, seed=77, executor=None, workers=1, cache=None):
+        self.ssa_dir = ssa_dir
+        self.cache = cache
+        self.samples = samples
+        self.funcs_size = funcs_size
+        self.vars_size = vars_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.executor = executor
+        self.workers = workers
+        self.epoch = 0
+        self.bounds = bucket_bounds(max_len)
+        self.buckets = {}
+        for i, sample in enumerate(samples):
+            bound = next(b for b in self.bounds if b >= sample[4])
+            self.buckets.setdefault(bound, []).append(i)
+        self.batches = []
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        bound, indices = self.batches[index]
+        batch = [self.samples[i] for i in indices]
+        labels = numpy.asarray([sample[1] for sample in batch], dtype=numpy.float32)
+        if self.cache is not None:
+            # the location is the first row of the method in the cache
+            T, F, A = allocate(len(batch), bound)
+            for row, (_, _, offset, start, length) in enumerate(batch):
+                encode_rows(self.cache.Rows(offset + start, length), row, T, F, A, self.funcs_size, self.vars_size)
+            return [T, F, A], labels
+        locations = [sample[2] for sample in batch]
+        if self.executor is None:
+            methods = decode(self.ssa_dir, locations)
+        else:
+            size = math.ceil(len(locations) / self.workers)
+            parts = [locations[i:i + size] for i in range(0, len(locations), size)]
+            methods = [m for part in self.executor.map(decode, [self.ssa_dir] * len(parts), parts) for m in part]
+        spans = [(sample[3], sample[4]) for sample in batch]
+        T, F, A = encode_batch(methods, self.funcs_size, bound, self.vars_size, spans)
+        return [T, F, A], labels
+
+    def on_epoch_end(self):
+        # batches are cut per bucket; with shuffle both the samples in a bucket and the batch
+        # order are permuted from seed + epoch, so runs see the same batches
+        rng = numpy.random.RandomState(self.seed + self.epoch) if self.shuffle else None
+        self.batches = []
+        for bound in sorted(self.buckets):
+            indices = self.buckets[bound]
+            if rng is not None:
+                indices = [indices[i] for i in rng.permutation(len(indices))]
+            for i in range(0, len(indices), self.batch_size):
+                self.batches.append((bound, indices[i:i + self.batch_size]))
+        if rng is not None:
+            self.batches = [self.batches[i] for i in rng.permutation(len(self.batches))]
+        self.epoch += 1
+
+    def close(self):
+        # stops the decoder processes; train and test share them, shutting down twice is harmless
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def prefetch(sequence, depth=4):
+    # endless batch generator (epoch after epoch) filled by a background thread; close() stops
+    # the thread, so a sequence can be prefetched again afterwards
+    batches = queue.Queue(depth)
+    stop = threading.Event()
+    def put(item):
+        # gives up once the consumer is gone
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            while not stop.is_set():
+                for i in range(len(sequence)):
+                    if not put(sequence[i]):
+                        return
+                sequence.on_epoch_end()
+        except BaseException as e:
+            put(e)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        producer.join()
+
+def open_sequences(ssa_dir, train, test, funcs_size, dims, batch_size=64, seed=77, decode_workers=1, policy="head", stride=None, cache=None):
+    max_len, vars_size = dims
+    executor = ProcessPoolExecutor(decode_workers) if decode_workers > 1 and cache is None else None
+    train = SSASequence(ssa_dir, samples(train, max_len, policy, stride), funcs_size, vars_size, max_len, batch_size, True, seed, executor, decode_workers, cache)
+    test = SSASequence(ssa_dir, samples(test, max_len, policy, stride), funcs_size, vars_size, max_len, batch_size, False, seed, executor, decode_workers, cache)
+    return train, test
+
+def open_split(ssa_dir, funcs_size, batch_size=64, test_size=0.20, seed=77, decode_workers=1, max_len=MAX_LEN, max_vars=1024, policy="head", stride=None, cache=None):
+    # returns the train and test sequences and the (max_len, vars_size) the model needs
+    items = cache.Items() if cache is not None else list_methods(ssa_dir)
+    dims = data_dims(items, max_len, max_vars)
+    train, test = split(items, test_size, seed)
+    return open_sequences(ssa_dir, train, test, funcs_size, dims, batch_size, seed, decode_workers, policy, stride, cache) + (dims,)
@@ -1,26 +1,209 @@
 import os, sys
-from subprocess import call
+import time
+import signal
+import argparse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-command = 'python bparser.py {path} {methods_db} {ssaout}'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+import bparser
+from disasm import OpalPool, get_pool
+from methodsdb import open_methods_db, ScopedMethodsDB, replay, remap_ssa
+from sources import iter_classes
+import tracing
+import metrics
+from ssastore import open_writer, FORMATS
+from ssacache import get_cache, DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES
+from journal import Journal
 
-def main(dir, methods_db_path, ssaout_path):
-    files = os.listdir(dir)
-    cfiles = [os.path.join(dir, f) for f in files if f.endswith(".class")]
+_journal = None
+
+def init_worker(trace_args, emulation, metrics_args=(False, None), journal_path=None):
+    global _journal
+    tracing.configure(*trace_args)
+    bparser.Method.EMULATION = emulation
+    enable, profile_dir = metrics_args
+    if enable and not metrics.enabled: # serial runs and forked workers keep the parent's setup
+        metrics.configure(True, profile_dir=profile_dir)
+    _journal = Journal(journal_path) if journal_path is not None else None
+
+def process_chunk(cfiles, backend="native", pool=None, cache_args=None, timeout=None):
+    # each class gets its own scoped db, IDs are assigned later in input order by merge()
+    cache = get_cache(*cache_args) if cache_args is not None else None
+    results = []
     for cf in cfiles:
         print(f"Processing {cf}...")
-        call(command.format(path=cf, methods_db=methods_db_path, ssaout=ssaout_path))
+        if _journal is not None:
+            _journal.Start(cf.name)
+        scoped = ScopedMethodsDB()
+        statuses = []
+        start = time.perf_counter()
+        try:
+            methods = bparser.ProcessClass(cf, scoped, backend, pool if pool is not None else get_pool(), cache, statuses, timeout)
+        except Exception as e:
+            results.append((cf.name, None, None, None, f"{e.__class__.__name__}: {e}", time.perf_counter() - start))
+            continue
+        results.append((cf.name, scoped.ops, methods, statuses, None, time.perf_counter() - start))
+    # the trace of the chunk is on disk before its results are, whatever happens to the worker later
+    tracing.flush()
+    # worker metrics travel with the results, the parent merges and exports them
+    return results, metrics.take() if metrics.enabled else None
+
+def class_status(statuses):
+    # (status, error) of a class that was processed
+    failed = sum(1 for _, status, _ in statuses if status == "failed")
+    if failed:
+        return "failed", f"{failed} of {len(statuses)} methods failed"
+    if not any(status == "done" for _, status, _ in statuses):
+        return "skipped", "No methods to convert"
+    return "done", None
+
+def merge(chunk, methods_db, writer, journal=None):
+    results, worker_metrics = chunk
+    metrics.merge(worker_metrics)
+    known = len(methods_db)
+    for cf, ops, methods, statuses, error, seconds in results:
+        if error is not None:
+            print(f"[!] Failed to process {cf}: {error}")
+            if journal is not None:
+                journal.Record(cf, "failed", error, seconds)
+            continue
+        with methods_db.Batch():
+            table = replay(methods_db, ops)
+        with metrics.stage("write"):
+            for method_name, ssaout in methods:
+                writer.Write(cf, method_name, remap_ssa(ssaout, table))
+        for method_name, status, reason in statuses:
+            if status != "done":
+                print(f"[!] {status.capitalize()} method '{method_name}' of {cf}: {reason}")
+        if journal is not None:
+            journal.Record(cf, *class_status(statuses), seconds, statuses)
+    if metrics.enabled:
+        metrics.methods_db_growth(known, len(methods_db))
+        metrics.maybe_export()
+
+def checkpoint(methods_db, writer, journal):
+    # the journal only says "done" for SSA and methods DB entries that are on disk
+    writer.Flush()
+    methods_db.Flush()
+    journal.Commit(len(methods_db))
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def default_journal_path(ssaout_path, format):
+    # next to the store index; a JSON output dir holds nothing but .ssa files
+    if format == "json":
+        return os.path.normpath(ssaout_path) + ".journal.sqlite"
+    return os.path.join(ssaout_path, "journal.sqlite")
+
+def main(dir, methods_db_path, ssaout_path, backend="native", opal_workers=1, jobs=1, chunksize=8, max_pending=None, cache_args=None, trace_args=("off", None), emulation="linear", format="shards", metrics_args=(False, None),
+         journal_path=None, resume=False, retry_failed=False, max_attempts=2, timeout=None, checkpoint_every=256):
+    journal_path = journal_path or default_journal_path(ssaout_path, format)
+    journal = Journal(journal_path)
+    settings = {"input": os.path.abspath(dir), "methods_db": os.path.abspath(methods_db_path), "backend": backend, "emulation": emulation, "format": format}
+    if resume:
+        for key, old, new in journal.Mismatches(settings):
+            print(f"[!] The journal was written with {key} {old}, not {new}; start a new run instead of --resume.")
+            sys.exit(1)
+    methods_db = open_methods_db(methods_db_path)
+    if resume:
+        finished = journal.Finished(retry_failed, max_attempts)
+        print(f"Resuming: {len(finished)} classes are already finished")
+        # names interned after the last checkpoint belong to classes that are processed again
+        size = journal.MethodsDBSize()
+        if size is not None and len(methods_db) > size:
+            print(f"Dropping {len(methods_db) - size} methods DB entries added after the last checkpoint")
+            methods_db.Truncate(size)
+    else:
+        journal.Reset(settings)
+        journal.Commit(len(methods_db))
+        finished = set()
+    cfiles = (cf for cf in iter_classes(dir) if cf.name not in finished)
+    writer = open_writer(ssaout_path, format)
+    # SIGTERM stops like Ctrl-C, through the finally below
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if jobs == 1:
+            init_worker(trace_args, emulation, metrics_args, journal_path)
+            with OpalPool(opal_workers) as pool:
+                for chunk in chunks(cfiles, chunksize):
+                    merge(process_chunk(chunk, backend, pool, cache_args, timeout), methods_db, writer, journal)
+                    if len(journal.pending) >= checkpoint_every:
+                        checkpoint(methods_db, writer, journal)
+            print(bparser.ARGS_CACHE.Stats())
+            return
+        # results are merged strictly in submission order, so IDs don't depend on scheduling
+        max_pending = max_pending or jobs * 2
+        pending = deque()
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(trace_args + (True,), emulation, metrics_args, journal_path)) as executor:
+            for chunk in chunks(cfiles, chunksize):
+                if len(pending) >= max_pending:
+                    merge(pending.popleft().result(), methods_db, writer, journal)
+                    if len(journal.pending) >= checkpoint_every:
+                        checkpoint(methods_db, writer, journal)
+                pending.append(executor.submit(process_chunk, chunk, backend, None, cache_args, timeout))
+            while pending:
+                merge(pending.popleft().result(), methods_db, writer, journal)
+    except BrokenProcessPool:
+        print(f"[!] A worker process died, the finished classes are in {journal_path}; continue with --resume.")
+        raise
+    finally:
+        writer.Close()
+        size = len(methods_db)
+        methods_db.Close()
+        journal.Commit(size)
+        classes, methods = journal.Summary()
+        print("Journal: " + ", ".join(f"{status} {count}" for status, count in sorted(classes.items())) + " classes")
+        journal.Close()
+        metrics.export()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: .py <dir> <methods_db> <ssaout>")
-        sys.exit(1)
-    if not os.path.isdir(sys.argv[1]):
+    parser = argparse.ArgumentParser(description="Bulk SSA generation for class files in a directory tree or jar")
+    parser.add_argument("dir", help="directory (searched recursively, jars included) or jar/zip")
+    parser.add_argument("methods_db")
+    parser.add_argument("ssaout")
+    parser.add_argument("--format", choices=FORMATS, default="shards", help="binary SSA store (default) or one JSON file per method")
+    parser.add_argument("--backend", choices=sorted(bparser.BACKENDS), default="native")
+    parser.add_argument("--opal-workers", type=int, default=1, help="persistent OPAL disassembler processes (serial mode)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=8, help="classes per task")
+    parser.add_argument("--max-pending", type=int, default=None, help="tasks in flight (default: 2 * jobs)")
+    parser.add_argument("--emulation", choices=bparser.Method.EMULATIONS, default="linear", help="straight-line emulation or CFG based SSA with phis")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SSA cache path")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024, help="SSA cache size limit in MiB")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the SSA cache")
+    parser.add_argument("--rebuild", action="store_true", help="ignore cached SSA and store fresh results")
+    parser.add_argument("--trace", choices=sorted(tracing.LEVELS, key=tracing.LEVELS.get), default="off", help="emulation trace level")
+    parser.add_argument("--trace-file", default=None, help="JSON lines trace output, suffixed with the worker pid (default: stderr)")
+    parser.add_argument("--timeout", type=float, default=None, help="wall-clock limit per class in seconds")
+    parser.add_argument("--journal", default=None, help="progress journal (default: <ssaout>/journal.sqlite, <ssaout>.journal.sqlite for --format json)")
+    parser.add_argument("--resume", action="store_true", help="only process the classes the journal doesn't have as finished")
+    parser.add_argument("--retry-failed", action="store_true", help="with --resume, also process the failed classes again")
+    parser.add_argument("--max-attempts", type=int, default=2, help="with --resume, give up on a class that was being processed when this many runs died")
+    parser.add_argument("--checkpoint-every", type=int, default=256, help="classes between checkpoints (store, methods DB and journal written)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir) and not os.path.isfile(args.dir):
         print("[!] Invalid dir path.")
         sys.exit(1)
-    if not os.path.isfile(sys.argv[2]):
+    if args.methods_db.endswith(".json") and not os.path.isfile(args.methods_db):
         print("[!] Invalid methods db path.")
         sys.exit(1)
-    if not os.path.isdir(sys.argv[3]):
+    if not os.path.isdir(args.ssaout):
         print("[!] Invalid ssaout path.")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
\ No newline at end of file
+    if args.resume and not os.path.isfile(args.journal or default_journal_path(args.ssaout, args.format)):
+        print("[!] Invalid journal path, there is nothing to resume.")
+        sys.exit(1)
+    cache_args = None if args.no_cache else (args.cache, args.cache_size * 1024 * 1024, args.rebuild)
+    metrics.configure_from_args(args)
+    main(args.dir, args.methods_db, args.ssaout, args.backend, args.opal_workers, args.jobs, args.chunksize, args.max_pending, cache_args, (args.trace, args.trace_file), args.emulation, args.format, (metrics.enabled, args.profile_dir),
+         args.journal, args.resume, args.retry_failed, args.max_attempts, args.timeout, args.checkpoint_every)
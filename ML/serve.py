@@ -0,0 +1,254 @@
+import os, sys
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+import bparser
+from methodsdb import open_methods_db, FrozenMethodsDB
+from sources import iter_classes
+from ssacache import get_cache, DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES
+from features import ssa_arrays, instruction_rows, encode_rows, allocate, windows
+
+# Scoring daemon for a model saved with simple_lstm.py --save-model. Clients send JSON lines
+# {"id": ..., "path": <class file, jar or directory>} over a Unix socket (or localhost TCP) and
+# get one JSON line per request back with a score per method and the latency of each stage:
+#   ssa       - disassembly/parsing/emulation in the SSA worker processes (summed over classes)
+#   vectorize - turning the SSA into index rows (summed over classes)
+#   queue     - longest wait of a method for its micro-batch
+#   model     - longest model call a method was part of
+#   total     - wall time of the request
+# Methods of all pending requests are batched into one model call of up to --max-batch samples,
+# waiting at most --max-wait ms for a batch to fill. A method longer than the model's max_len
+# is split like in training and scored by its highest scoring window.
+
+DEFAULT_SOCKET = "/tmp/ssa-score.sock"
+
+_methods_db = None
+_cache = None
+
+def init_worker(methods_db_path, emulation, cache_args):
+    global _methods_db, _cache
+    bparser.Method.EMULATION = emulation
+    _methods_db = FrozenMethodsDB(open_methods_db(methods_db_path))
+    _cache = get_cache(*cache_args) if cache_args is not None else None
+
+def ssa_stage(entry, backend):
+    # runs in a worker: SSA of the methods of one class as raw feature rows
+    start = time.perf_counter()
+    methods = bparser.ProcessClass(entry, _methods_db, backend, None, _cache)
+    ssa_done = time.perf_counter()
+    rows = [(name, instruction_rows(ssa_arrays(ssaout))) for name, ssaout in methods]
+    return rows, ssa_done - start, time.perf_counter() - ssa_done
+
+class MicroBatcher(object):
+    # collects samples (rows, start, length) from concurrent requests into model calls
+    def __init__(self, model, meta, max_batch=64, max_wait=0.005):
+        self.model = model
+        self.funcs_size = meta["funcs_size"]
+        self.vars_size = meta["vars_size"]
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+    async def Score(self, sample):
+        # returns (score, queue wait, model time)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sample, future, time.perf_counter()))
+        return await future
+
+    def predict(self, samples):
+        T, F, A = allocate(len(samples), max(1, max(length for _, _, length in samples)))
+        for row, (rows, start, length) in enumerate(samples):
+            encode_rows(rows, row, T, F, A, self.funcs_size, self.vars_size, start, length)
+        return self.model.predict([T, F, A], verbose=0)[:, 0]
+
+    async def Run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            started = time.perf_counter()
+            try:
+                # the model call runs in a thread so the loop keeps accepting requests
+                scores = await loop.run_in_executor(None, self.predict, [sample for sample, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            model_time = time.perf_counter() - started
+            for (_, future, queued), score in zip(batch, scores):
+                if not future.done():
+                    future.set_result((float(score), started - queued, model_time))
+
+class ScoringServer(object):
+    def __init__(self, batcher, executor, meta, backend="native"):
+        self.batcher = batcher
+        self.executor = executor
+        self.backend = backend
+        self.max_len = meta["max_len"]
+        self.policy = meta["policy"]
+        self.stride = meta["stride"]
+
+    async def score_method(self, rows):
+        spans = windows(len(rows[0]), self.max_len, self.policy, self.stride)
+        results = await asyncio.gather(*(self.batcher.Score((rows, start, length)) for start, length in spans))
+        return max(score for score, _, _ in results), max(wait for _, wait, _ in results), max(t for _, _, t in results)
+
+    async def score_class(self, entry, latency):
+        loop = asyncio.get_running_loop()
+        methods, ssa_time, vectorize_time = await loop.run_in_executor(self.executor, ssa_stage, entry, self.backend)
+        latency["ssa"] += ssa_time
+        latency["vectorize"] += vectorize_time
+        results = await asyncio.gather(*(self.score_method(rows) for _, rows in methods))
+        scored = []
+        for (name, _), (score, wait, model_time) in zip(methods, results):
+            latency["queue"] = max(latency["queue"], wait)
+            latency["model"] = max(latency["model"], model_time)
+            scored.append({"class": entry.name, "method": name, "score": score})
+        return scored
+
+    async def Score(self, request):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        latency = {"ssa": 0.0, "vectorize": 0.0, "queue": 0.0, "model": 0.0}
+        path = request.get("path")
+        if not isinstance(path, str) or not os.path.exists(path):
+            return {"id": request.get("id"), "error": f"Invalid path: {path}"}
+        entries = await loop.run_in_executor(None, lambda: list(iter_classes(path)))
+        results = await asyncio.gather(*(self.score_class(entry, latency) for entry in entries), return_exceptions=True)
+        methods, errors = [], []
+        for entry, result in zip(entries, results):
+            if isinstance(result, Exception):
+                errors.append({"class": entry.name, "error": f"{result.__class__.__name__}: {result}"})
+            else:
+                methods.extend(result)
+        latency["total"] = time.perf_counter() - start
+        return {"id": request.get("id"), "path": path, "methods": methods, "errors": errors,
+                "latency_ms": {stage: round(t * 1000, 3) for stage, t in latency.items()}}
+
+    async def handle(self, reader, writer):
+        # requests of a connection are scored concurrently, responses carry the request id
+        tasks = set()
+        async def respond(line):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+            except ValueError as e:
+                request, response = None, {"error": f"Invalid request: {e}"}
+            if request is not None:
+                # every request is answered, a failing one (unreadable jar, dead worker) with its error
+                try:
+                    response = await self.Score(request)
+                except Exception as e:
+                    response = {"id": request.get("id"), "error": f"{e.__class__.__name__}: {e}"}
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(respond(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+async def serve(server, batcher, socket_path=None, port=None):
+    batcher_task = asyncio.ensure_future(batcher.Run())
+    if port is not None:
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", port)
+        print(f"Scoring on 127.0.0.1:{port}")
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        listener = await asyncio.start_unix_server(server.handle, socket_path)
+        print(f"Scoring on {socket_path}")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batcher_task.cancel()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+async def score_paths(paths, socket_path=None, port=None):
+    # a minimal client: sends all paths on one connection and prints the responses
+    if port is not None:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    else:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    for i, path in enumerate(paths):
+        writer.write((json.dumps({"id": i, "path": os.path.abspath(path)}) + "\n").encode())
+    await writer.drain()
+    for _ in paths:
+        print((await reader.readline()).decode().rstrip())
+    writer.close()
+
+def main(model_path, methods_db_path, socket_path=DEFAULT_SOCKET, port=None, jobs=1, max_batch=64, max_wait=0.005, backend="native", emulation="linear", cache_args=None):
+    # keras is only loaded in the daemon, not in the SSA workers
+    from simple_lstm import load_model
+    from featurecache import methods_db_digest
+    model, meta = load_model(model_path)
+    methods_db = open_methods_db(methods_db_path)
+    version = meta["methods_db_version"]
+    if len(methods_db) < version["count"] or methods_db_digest(methods_db, version["count"]) != version["digest"]:
+        print("[!] The methods db doesn't match the one the model was trained with.")
+        sys.exit(1)
+    methods_db.Close()
+    # spawn, not fork: the daemon has TensorFlow loaded
+    executor = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(methods_db_path, emulation, cache_args))
+    batcher = MicroBatcher(model, meta, max_batch, max_wait)
+    try:
+        asyncio.run(serve(ScoringServer(batcher, executor, meta, backend), batcher, socket_path, port))
+    finally:
+        executor.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vulnerability scoring daemon for class files and jars")
+    commands = parser.add_subparsers(dest="command", required=True)
+    daemon = commands.add_parser("serve", help="run the scoring daemon")
+    daemon.add_argument("model", help="model directory saved by simple_lstm.py --save-model")
+    daemon.add_argument("methods_db", help="methods db the model was trained with")
+    daemon.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="SSA worker processes")
+    daemon.add_argument("--max-batch", type=int, default=64, help="samples per model call")
+    daemon.add_argument("--max-wait", type=float, default=5, help="ms to wait for a batch to fill")
+    daemon.add_argument("--backend", choices=sorted(bparser.BACKENDS), default="native")
+    daemon.add_argument("--emulation", choices=bparser.Method.EMULATIONS, default="linear", help="must match the SSA the model was trained on")
+    daemon.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SSA cache path")
+    daemon.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024, help="SSA cache size limit in MiB")
+    daemon.add_argument("--no-cache", action="store_true", help="don't read or write the SSA cache")
+    client = commands.add_parser("score", help="send class files/jars to a running daemon")
+    client.add_argument("paths", nargs="+")
+    for command in (daemon, client):
+        command.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path")
+        command.add_argument("--port", type=int, default=None, help="listen on/connect to 127.0.0.1:PORT instead of the socket")
+    args = parser.parse_args()
+    if args.command == "score":
+        asyncio.run(score_paths(args.paths, args.socket, args.port))
+        sys.exit(0)
+    if not os.path.isdir(args.model):
+        print("[!] Invalid model path.")
+        sys.exit(1)
+    if not os.path.isfile(args.methods_db):
+        print("[!] Invalid methods db path.")
+        sys.exit(1)
+    cache_args = None if args.no_cache else (args.cache, args.cache_size * 1024 * 1024, False)
+    main(args.model, args.methods_db, args.socket, args.port, args.jobs, args.max_batch, args.max_wait / 1000, args.backend, args.emulation, cache_args)
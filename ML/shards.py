@@ -0,0 +1,311 @@
+import os, sys
+import zlib
+import hashlib
+import sqlite3
+import argparse
+import subprocess
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+import bparser
+from methodsdb import open_methods_db, replay
+from sources import iter_classes
+from ssastore import ShardWriter, ShardReader, open_writer, unpack_ssa, is_store, FORMATS
+from ssacache import DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES
+from preprocess_bulk import init_worker, process_chunk, chunks
+
+# Map/reduce SSA generation for corpora that don't fit one machine.
+#   map   - converts one shard of the classes: the classes of its own input, or with
+#           --shard i --shards n the classes of a shared input whose name (below the input
+#           path, so the machines may mount the input anywhere) hashes to i. The
+#           output is an SSA store whose method ids are per class (the lookup positions of
+#           ScopedMethodsDB) plus vocab.sqlite: the shard's own method vocabulary and the
+#           recorded lookups of every class as local ids.
+#   merge - replays the lookups of all classes of all shards, in input order, into one
+#           methods DB and rewrites the SSA with a per class id table (a numpy take over the
+#           funcs of every record, the records are copied otherwise).
+#   local - runs --shards map processes side by side and merges them, for testing.
+# Input order is the position of a class in iter_classes of the input, the order
+# preprocess_bulk.py processes it in. Shards of one shared input merge by that position, so
+# the merged methods DB and SSA don't depend on the number of shards and are what one
+# preprocess_bulk.py run over the input gives. The input is identified by a digest of its class
+# listing (or --input-id), not by its path; shards of a shared input that disagree on it, on
+# the number of shards or that leave a shard out aren't merged. Shards with their own inputs
+# merge input after input, in the order the shard dirs are given.
+
+VOCAB_NAME = "vocab.sqlite"
+
+def shard_of(name, shards):
+    # stable across machines and runs, unlike hash()
+    return zlib.crc32(name.encode()) % shards
+
+def relative_name(name, input_path):
+    # iter_classes names start with the input path as given, what follows is the same on
+    # every machine
+    return name[len(input_path):].lstrip("/" + os.sep)
+
+class ShardVocab(object):
+    # method names of one shard under local ids, and per class its lookups as
+    # local id * 2 + kind (ScopedMethodsDB.INTERN / RESOLVE) int32 arrays
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS vocab (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS classes (name TEXT PRIMARY KEY, position INTEGER NOT NULL, ops BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self.ids = dict(self.conn.execute("SELECT name, id FROM vocab"))
+        self.names = None
+        self.new = []
+        self.rows = []
+
+    def local_id(self, method):
+        if method not in self.ids:
+            self.ids[method] = len(self.ids) + 1
+            self.new.append((self.ids[method], method))
+        return self.ids[method]
+
+    def Add(self, class_name, position, ops):
+        encoded = array("i", [self.local_id(method) * 2 + kind for kind, method in ops])
+        if sys.byteorder != "little":
+            encoded.byteswap()
+        self.rows.append((class_name, position, encoded.tobytes()))
+
+    def Flush(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT INTO vocab (id, name) VALUES (?, ?)", self.new)
+        self.conn.executemany("INSERT OR REPLACE INTO classes (name, position, ops) VALUES (?, ?, ?)", self.rows)
+        self.conn.execute("COMMIT")
+        self.new = []
+        self.rows = []
+
+    def SetSettings(self, settings):
+        self.conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in settings.items()])
+
+    def Settings(self):
+        return dict(self.conn.execute("SELECT key, value FROM settings"))
+
+    def Classes(self):
+        # [(name, position in the input)]
+        return list(self.conn.execute("SELECT name, position FROM classes"))
+
+    def Ops(self, class_name):
+        if self.names is None:
+            self.names = [None] + [name for name, in self.conn.execute("SELECT name FROM vocab ORDER BY id")]
+        encoded = array("i")
+        encoded.frombytes(self.conn.execute("SELECT ops FROM classes WHERE name = ?", (class_name,)).fetchone()[0])
+        if sys.byteorder != "little":
+            encoded.byteswap()
+        return [(op & 1, self.names[op >> 1]) for op in encoded]
+
+    def Close(self):
+        self.conn.close()
+
+def write_shard(chunk, writer, vocab, positions):
+    results, _ = chunk
+    for cf, ops, methods, statuses, error, _ in results:
+        position = positions.pop(cf)
+        if error is not None:
+            print(f"[!] Failed to process {cf}: {error}")
+            continue
+        for method_name, status, reason in statuses:
+            if status != "done":
+                print(f"[!] {status.capitalize()} method '{method_name}' of {cf}: {reason}")
+        # the lookups of failed methods count too, like in a bparser run
+        vocab.Add(cf, position, ops)
+        for method_name, ssaout in methods:
+            writer.Write(cf, method_name, ssaout)
+
+def map_shard(input_path, shard_dir, shard=None, shards=None, backend="native", emulation="linear", jobs=1, chunksize=8, cache_args=None, timeout=None, input_id=None):
+    # positions count every class of the input, so the shards of a shared input can be merged in input order;
+    # the listing digest is only known (and recorded) once the whole input has been seen
+    positions = {}
+    listing = hashlib.sha1()
+    def cfiles():
+        for position, cf in enumerate(iter_classes(input_path)):
+            name = relative_name(cf.name, input_path)
+            listing.update(f"{name}\n".encode())
+            if shards is None or shard_of(name, shards) == shard:
+                positions[cf.name] = position
+                yield cf
+    writer = ShardWriter(shard_dir)
+    vocab = ShardVocab(os.path.join(shard_dir, VOCAB_NAME))
+    vocab.SetSettings({"backend": backend, "emulation": emulation, "input": os.path.abspath(input_path), "input_id": None, "shard": shard, "shards": shards})
+    try:
+        if jobs == 1:
+            init_worker(("off", None), emulation)
+            for chunk in chunks(cfiles(), chunksize):
+                write_shard(process_chunk(chunk, backend, None, cache_args, timeout), writer, vocab, positions)
+        else:
+            pending = deque()
+            with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(("off", None), emulation)) as executor:
+                for chunk in chunks(cfiles(), chunksize):
+                    if len(pending) >= jobs * 2:
+                        write_shard(pending.popleft().result(), writer, vocab, positions)
+                    pending.append(executor.submit(process_chunk, chunk, backend, None, cache_args, timeout))
+                while pending:
+                    write_shard(pending.popleft().result(), writer, vocab, positions)
+        vocab.SetSettings({"input_id": input_id or listing.hexdigest()})
+    finally:
+        # the vocab goes last, a class is only merged once its SSA is on disk
+        writer.Close()
+        vocab.Flush()
+        vocab.Close()
+
+def remap_record(buf, table):
+    record = np.frombuffer(buf, dtype="<i4").copy()
+    count = int(record[0])
+    funcs = record[2 + count:2 + 2 * count]
+    funcs[:] = table.take(funcs)
+    return record.tobytes()
+
+def check_shared(sources, shard_dirs):
+    # True for the shards of one shared input, which must be the same input (by listing, not
+    # path) cut the same way with every shard present; False for shards with their own inputs
+    sharded = [s.get("shards", "None") != "None" for s in sources]
+    if not any(sharded):
+        return False
+    if not all(sharded):
+        raise ValueError("Shards of a shared input (--shards) can't be merged with shards of their own inputs")
+    for d, s in zip(shard_dirs, sources):
+        if s.get("input_id", "None") == "None":
+            raise ValueError(f"{d} wasn't mapped to the end of its input")
+    settings = [{k: s.get(k) for k in ("input_id", "shards")} for s in sources]
+    if any(s != settings[0] for s in settings):
+        raise ValueError(f"The shards were made from different inputs or shard counts: {settings}")
+    numbers = sorted(int(s["shard"]) for s in sources)
+    if numbers != list(range(int(settings[0]["shards"]))):
+        raise ValueError(f"Expected shards 0..{int(settings[0]['shards']) - 1} once each, got {numbers}")
+    return True
+
+def merge_shards(shard_dirs, methods_db_path, ssaout_path, format="shards"):
+    readers = [ShardReader(d) for d in shard_dirs]
+    vocabs = [ShardVocab(os.path.join(d, VOCAB_NAME)) for d in shard_dirs]
+    methods_db = open_methods_db(methods_db_path)
+    writer = open_writer(ssaout_path, format)
+    try:
+        sources = [v.Settings() for v in vocabs]
+        settings = [{k: s.get(k) for k in ("backend", "emulation")} for s in sources]
+        if any(s != settings[0] for s in settings):
+            raise ValueError(f"The shards were made with different settings: {settings}")
+        # one shared input: its order across the shards; separate inputs: one after the other
+        shared = check_shared(sources, shard_dirs)
+        owner, order = {}, {}
+        for i, vocab in enumerate(vocabs):
+            for name, position in vocab.Classes():
+                if name in owner:
+                    raise ValueError(f"{name} is in {shard_dirs[owner[name]]} and in {shard_dirs[i]}")
+                owner[name] = i
+                order[name] = (position,) if shared else (i, position)
+        entries = [{} for _ in readers]
+        for i, reader in enumerate(readers):
+            for entry in reader.Entries():
+                entries[i].setdefault(entry.cls, []).append(entry)
+        for name in sorted(owner, key=order.get):
+            i = owner[name]
+            with methods_db.Batch():
+                table = replay(methods_db, vocabs[i].Ops(name))
+            table = np.array([0] + table[1:], dtype=np.int32)
+            for entry in sorted(entries[i].get(name, []), key=lambda e: e.id):
+                if format == "json":
+                    writer.Write(name, entry.method, unpack_ssa(remap_record(readers[i].ReadBytes(entry), table)))
+                else:
+                    writer.WriteRecord(name, entry.method, remap_record(readers[i].ReadBytes(entry), table), entry.count, entry.max_var)
+        print(f"Merged {len(owner)} classes from {len(shard_dirs)} shards, {len(methods_db)} methods")
+    finally:
+        writer.Close()
+        methods_db.Close()
+        for reader in readers:
+            reader.Close()
+        for vocab in vocabs:
+            vocab.Close()
+
+def map_command(input_path, shard_dir, shard, shards, args):
+    cmd = [sys.executable, os.path.abspath(__file__), "map", input_path, shard_dir, "--shard", str(shard), "--shards", str(shards),
+           "--backend", args.backend, "--emulation", args.emulation, "-j", str(args.jobs), "--chunksize", str(args.chunksize)]
+    if args.timeout is not None:
+        cmd += ["--timeout", str(args.timeout)]
+    if args.no_cache:
+        cmd.append("--no-cache")
+    return cmd
+
+def run_local(input_path, methods_db_path, ssaout_path, work_dir, shards, args):
+    # every shard is a separate map process, like on separate machines
+    shard_dirs = []
+    for i in range(shards):
+        shard_dirs.append(os.path.join(work_dir, f"shard-{i}"))
+        os.makedirs(shard_dirs[-1], exist_ok=True)
+    processes = []
+    for i, shard_dir in enumerate(shard_dirs):
+        with open(os.path.join(shard_dir, "map.log"), "w") as log:
+            processes.append(subprocess.Popen(map_command(input_path, shard_dir, i, shards, args), stdout=log, stderr=subprocess.STDOUT))
+    failed = [i for i, p in enumerate(processes) if p.wait() != 0]
+    if failed:
+        print(f"[!] Map failed for shards {failed}, see map.log in {work_dir}")
+        sys.exit(1)
+    merge_shards(shard_dirs, methods_db_path, ssaout_path, args.format)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded SSA generation: map shards on many machines, merge them into one methods DB and store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    mapper = commands.add_parser("map", help="convert one shard into a store with a shard vocabulary")
+    mapper.add_argument("input", help="directory (searched recursively, jars included) or jar/zip")
+    mapper.add_argument("shard_dir", help="out dir of the shard")
+    mapper.add_argument("--shard", type=int, default=None, help="this shard's number, with --shards")
+    mapper.add_argument("--shards", type=int, default=None, help="only take the classes of a shared input that hash to --shard")
+    mapper.add_argument("--input-id", default=None, help="name of the shared input checked by merge (default: a digest of its class listing)")
+    merger = commands.add_parser("merge", help="merge map outputs into one methods DB and store")
+    merger.add_argument("methods_db", help="methods DB to create or extend (.json or SQLite)")
+    merger.add_argument("ssaout", help="out ssa dir")
+    merger.add_argument("shard_dirs", nargs="+")
+    merger.add_argument("--format", choices=FORMATS, default="shards", help="binary SSA store (default) or one JSON file per method")
+    local = commands.add_parser("local", help="run --shards map processes on this machine and merge them")
+    local.add_argument("input", help="directory (searched recursively, jars included) or jar/zip")
+    local.add_argument("methods_db", help="methods DB to create or extend (.json or SQLite)")
+    local.add_argument("ssaout", help="out ssa dir")
+    local.add_argument("--shards", type=int, default=4)
+    local.add_argument("--work-dir", default=None, help="where the shard outputs go (default: <ssaout>.shards)")
+    local.add_argument("--format", choices=FORMATS, default="shards", help="binary SSA store (default) or one JSON file per method")
+    for command in (mapper, local):
+        command.add_argument("--backend", choices=sorted(bparser.BACKENDS), default="native")
+        command.add_argument("--emulation", choices=bparser.Method.EMULATIONS, default="linear", help="straight-line emulation or CFG based SSA with phis")
+        command.add_argument("-j", "--jobs", type=int, default=1, help="worker processes per shard")
+        command.add_argument("--chunksize", type=int, default=8, help="classes per task")
+        command.add_argument("--timeout", type=float, default=None, help="wall-clock limit per class in seconds")
+        command.add_argument("--no-cache", action="store_true", help="don't read or write the SSA cache")
+    args = parser.parse_args()
+    if args.command in ("map", "local") and not os.path.isdir(args.input) and not os.path.isfile(args.input):
+        print("[!] Invalid input path.")
+        sys.exit(1)
+    if args.command in ("merge", "local"):
+        if args.methods_db.endswith(".json") and not os.path.isfile(args.methods_db):
+            print("[!] Invalid methods db path.")
+            sys.exit(1)
+        if not os.path.isdir(args.ssaout):
+            print("[!] Invalid ssaout path.")
+            sys.exit(1)
+    if args.command == "map":
+        if not os.path.isdir(args.shard_dir):
+            print("[!] Invalid shard dir.")
+            sys.exit(1)
+        if (args.shards is None) != (args.shard is None) or (args.shards is not None and not 0 <= args.shard < args.shards):
+            print("[!] Invalid shard number.")
+            sys.exit(1)
+        bparser.Method.EMULATION = args.emulation
+        cache_args = None if args.no_cache else (DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES, False)
+        map_shard(args.input, args.shard_dir, args.shard, args.shards, args.backend, args.emulation, args.jobs, args.chunksize, cache_args, args.timeout, args.input_id)
+        sys.exit(0)
+    if args.command == "merge" and any(not is_store(d) or not os.path.isfile(os.path.join(d, VOCAB_NAME)) for d in args.shard_dirs):
+        print("[!] Invalid shard dir.")
+        sys.exit(1)
+    try:
+        if args.command == "merge":
+            merge_shards(args.shard_dirs, args.methods_db, args.ssaout, args.format)
+        else:
+            run_local(args.input, args.methods_db, args.ssaout, args.work_dir or os.path.normpath(args.ssaout) + ".shards", args.shards, args)
+    except ValueError as e:
+        print(f"[!] {e}")
+        sys.exit(1)
@@ -1,98 +1,132 @@
 import numpy
 from keras.datasets import imdb
-from keras.models import Sequential
+from keras.models import Model, load_model as load_keras_model
 from keras.layers import Dense
 from keras.layers import LSTM
+from keras.layers import Input, Concatenate, Lambda
 from keras.layers.embeddings import Embedding
+from keras import backend as K
 from keras.preprocessing import sequence
 
-from sklearn.model_selection import train_test_split
-
 # fix random seed for reproducibility
 numpy.random.seed(7)
 
 import sys, os
 import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+from features import VARS_SIZE, MAX_LEN, MAX_ARGS, LONG_POLICIES
+from methodsdb import open_methods_db
+from loader import open_split, prefetch
+from featurecache import update as update_cache, methods_db_version
 
 numpy.set_printoptions(threshold=sys.maxsize)
 
-VARS_SIZE = 100
 FUNCS_SIZE = 0
+EMBEDDING_SIZE = 32
 
-def transform_inst(inst_data):
-    target = inst_data[0]
-    func = inst_data[1]
-    args = inst_data[2]
-    target_ohe = [0] * VARS_SIZE
-    if target is not None:
-        target_ohe[target] = 1
-    func_ohe = [0] * FUNCS_SIZE
-    func_ohe[func] = 1
-    args_map = [0] * VARS_SIZE
-    for a in args:
-        args_map[a] = 1
-    vector = target_ohe + func_ohe + args_map
-    return vector
+# a saved model is a directory with the keras model and what is needed to feed it
+MODEL_FILE = "model.h5"
+META_FILE = "model.json"
 
-def transform_sequence(ssa_data):
-    instructions = []
-    for inst_data in ssa_data:
-        inst_vec = transform_inst(inst_data)
-        instructions.append(inst_vec)
-    if len(instructions) < 100:
-        instructions += [[0] * (VARS_SIZE*2 + FUNCS_SIZE)] * (100 - len(instructions))
-    return instructions
+def build_model(funcs_size, vars_size=VARS_SIZE, lstm_units=100):
+    # embeddings of the target, the function and the sum of the arg embeddings replace the
+    # one-hot target | function | multi-hot args rows. Sequences have no fixed length (each
+    # batch is padded to its bucket) and padding is masked: function ids start at 1, so a 0
+    # function marks a padding row.
+    targets = Input(shape=(None,), dtype="int32", name="targets")
+    funcs = Input(shape=(None,), dtype="int32", name="funcs")
+    args = Input(shape=(None, MAX_ARGS), dtype="int32", name="args")
+    target_emb = Embedding(vars_size + 1, EMBEDDING_SIZE)(targets)
+    func_emb = Embedding(funcs_size, EMBEDDING_SIZE, mask_zero=True)(funcs)
+    args_emb = Lambda(lambda x: K.sum(x, axis=2))(Embedding(vars_size + 1, EMBEDDING_SIZE)(args))
+    x = Concatenate()([target_emb, func_emb, args_emb])
+    x = LSTM(lstm_units)(x)
+    out = Dense(1, activation='sigmoid')(x)
+    return Model(inputs=[targets, funcs, args], outputs=out)
     
-def ML(X, Y):
-    X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.20, random_state=77)
-
-    model = Sequential()
-    model.add(LSTM(100, input_shape=(100, 224)))
-    model.add(Dense(1, activation='sigmoid'))
+def ML(train, test, prefetch_depth=4, lstm_units=100, epochs=10, verbose=1):
+    model = build_model(train.funcs_size, train.vars_size, lstm_units)
     model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
-    print(model.summary())
-    model.fit(X_train, Y_train, validation_data=(X_test, Y_test), epochs=10, batch_size=64)
-    
-    print("Trained")
-    # Final evaluation of the model
-    scores = model.evaluate(X_test, Y_test, verbose=0)
-    print("Accuracy: %.2f%%" % (scores[1]*100))
+    if verbose:
+        print(model.summary())
+    # the prefetch threads are stopped before the next stage reads the same sequences, the
+    # decoder processes once training and evaluation are done
+    try:
+        train_batches, test_batches = prefetch(train, prefetch_depth), prefetch(test, prefetch_depth)
+        try:
+            model.fit(train_batches, steps_per_epoch=len(train), validation_data=test_batches, validation_steps=len(test), epochs=epochs, verbose=verbose)
+        finally:
+            train_batches.close()
+            test_batches.close()
+        
+        if verbose:
+            print("Trained")
+        # Final evaluation of the model
+        test_batches = prefetch(test, prefetch_depth)
+        try:
+            scores = model.evaluate(test_batches, steps=len(test), verbose=0)
+        finally:
+            test_batches.close()
+    finally:
+        train.close()
+        test.close()
+    if verbose:
+        print("Accuracy: %.2f%%" % (scores[1]*100))
+    return model, scores
 
-def main(methods_db_path, ssa_dir):
-    methods_db = json.load(open(methods_db_path, 'r'))
+def save_model(model, path, meta):
+    os.makedirs(path, exist_ok=True)
+    model.save(os.path.join(path, MODEL_FILE))
+    with open(os.path.join(path, META_FILE), 'w') as fp:
+        json.dump(meta, fp, indent=4)
+
+def load_model(path):
+    with open(os.path.join(path, META_FILE), 'r') as fp:
+        meta = json.load(fp)
+    return load_keras_model(os.path.join(path, MODEL_FILE), custom_objects={"K": K}), meta
+
+def main(methods_db_path, ssa_dir, batch_size=64, test_size=0.20, decode_workers=1, prefetch_depth=4, max_len=MAX_LEN, max_vars=1024, policy="head", stride=None, cache_dir=None, model_path=None):
+    methods_db = open_methods_db(methods_db_path)
     methods_cnt = len(methods_db) + 2 # the last indexs stands for wildcard methods
     global FUNCS_SIZE
     FUNCS_SIZE = methods_cnt
     print(f"Methods count: {methods_cnt}")
-    ssa_files = [os.path.join(ssa_dir, f) for f in os.listdir(ssa_dir)]
-    X = []
-    Y = []
-    for ssaf in ssa_files:
-        ssaf_name = ssaf.split("\\")[-1]
-        if ssaf_name.lower().find("bad") != -1:
-            y = 1
-        elif ssaf_name.lower().find("good") != -1:
-            y = 0
-        else:
-            raise ValueError("No label indicator in file name")
-        Y.append(y)
-        x = transform_sequence(json.load(open(ssaf, 'r')))
-        X.append(x)
-    X_np = numpy.asarray(X)
-    Y_np = numpy.asarray(Y)
-    print(f"X shape: {X_np.shape}")
-    print(f"Y shape: {Y_np.shape}")
+    cache = None
+    if cache_dir is not None:
+        cache, (reused, vectorized) = update_cache(ssa_dir, cache_dir, methods_db)
+        print(f"Feature cache: {reused} methods reused, {vectorized} vectorized")
+    # batches are read from ssa_dir (or the feature cache) while training, the corpus is never loaded as a whole
+    train, test, (max_len, vars_size) = open_split(ssa_dir, FUNCS_SIZE, batch_size, test_size, 77, decode_workers, max_len, max_vars, policy, stride, cache)
+    print(f"Train samples: {len(train.samples)}, test samples: {len(test.samples)}, max length: {max_len}, vars: {vars_size}")
     
-    ML(X_np, Y_np)
+    model, _ = ML(train, test, prefetch_depth)
+    if model_path is not None:
+        meta = {"funcs_size": FUNCS_SIZE, "vars_size": vars_size, "max_len": max_len, "policy": policy, "stride": stride,
+                "methods_db": os.path.abspath(methods_db_path), "methods_db_version": methods_db_version(methods_db)}
+        save_model(model, model_path, meta)
+        print(f"Model saved to {model_path}")
     
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: .py <methods_db> <ssa dir>")
-        sys.exit(1)
-    if not os.path.isfile(sys.argv[1]):
+    parser = argparse.ArgumentParser(description="LSTM classifier for SSA methods")
+    parser.add_argument("methods_db", help="methods db (.json or SQLite store)")
+    parser.add_argument("ssa_dir", help="SSA store or directory of JSON .ssa files")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--test-size", type=float, default=0.20, help="share of methods in the test split")
+    parser.add_argument("--decode-workers", type=int, default=1, help="processes reading and decoding methods")
+    parser.add_argument("--prefetch", type=int, default=4, help="batches prepared ahead of training")
+    parser.add_argument("--max-len", type=int, default=MAX_LEN, help="longest sample in instructions (lower if the data is shorter)")
+    parser.add_argument("--max-vars", type=int, default=1024, help="var vocabulary limit (lower if the data has fewer vars)")
+    parser.add_argument("--long", choices=LONG_POLICIES, default="head", help="longer methods: keep the first/last max-len instructions or split them into windows")
+    parser.add_argument("--window-stride", type=int, default=None, help="window step for --long window (default: max-len / 2)")
+    parser.add_argument("--feature-cache", default=None, help="memory-mapped feature cache dir, built on first use and updated for changed methods")
+    parser.add_argument("--save-model", default=None, help="directory to save the trained model to (for serve.py)")
+    args = parser.parse_args()
+    if not os.path.isfile(args.methods_db):
         print("[!] Invalid methods db path.")
         sys.exit(1)
-    if not os.path.isdir(sys.argv[2]):
+    if not os.path.isdir(args.ssa_dir):
         print("[!] Invlid ssa dir path.")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    main(args.methods_db, args.ssa_dir, args.batch_size, args.test_size, args.decode_workers, args.prefetch, args.max_len, args.max_vars, args.long, args.window_stride, args.feature_cache, args.save_model)
@@ -0,0 +1,132 @@
+import os, sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SSAGen"))
+from methodsdb import open_methods_db
+from features import MAX_LEN, LONG_POLICIES
+from featurecache import FeatureCache, update as update_cache
+from loader import data_dims, kfold, split, open_sequences
+
+# Cross-validation and hyperparameter sweep. Every (configuration, fold) pair is a trial run in
+# a pool of worker processes; all of them read batches from the same memory-mapped feature
+# cache, so the corpus is in the page cache once, not once per worker. Each worker is capped
+# to --threads BLAS/TensorFlow threads, so -j * --threads should not exceed the cores.
+
+THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+
+def cap_threads(threads):
+    # the variables are read when the libraries start their pools, so they are set in the parent
+    # before the workers are spawned; TensorFlow is also told directly, it may already be loaded
+    for var in THREAD_VARS:
+        os.environ[var] = str(threads)
+
+def init_worker(threads):
+    cap_threads(threads)
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (ImportError, AttributeError, RuntimeError):
+        pass
+
+def run_trial(cache_dir, config, fold, train, test, funcs_size, dims, policy, stride, seed):
+    from simple_lstm import ML # keras is only loaded in the workers
+    numpy.random.seed(seed)
+    cache = FeatureCache(cache_dir)
+    train, test = open_sequences(cache_dir, train, test, funcs_size, dims, config["batch_size"], seed, 1, policy, stride, cache)
+    start = time.time()
+    _, (loss, accuracy) = ML(train, test, lstm_units=config["lstm_units"], epochs=config["epochs"], verbose=0)
+    return {"config": config, "fold": fold, "loss": float(loss), "accuracy": float(accuracy),
+            "train_samples": len(train.samples), "test_samples": len(test.samples), "seconds": round(time.time() - start, 3)}
+
+def configurations(lstm_units, epochs, batch_sizes):
+    return [{"lstm_units": u, "epochs": e, "batch_size": b} for u, e, b in itertools.product(lstm_units, epochs, batch_sizes)]
+
+def summarize(trials):
+    # one row per configuration, best mean accuracy first
+    rows = {}
+    for trial in trials:
+        key = json.dumps(trial["config"], sort_keys=True)
+        rows.setdefault(key, []).append(trial)
+    summary = []
+    for key, runs in rows.items():
+        accuracy = numpy.array([r["accuracy"] for r in runs])
+        summary.append({"config": runs[0]["config"], "folds": len(runs), "accuracy_mean": float(accuracy.mean()), "accuracy_std": float(accuracy.std()),
+                        "loss_mean": float(numpy.mean([r["loss"] for r in runs])), "seconds": round(sum(r["seconds"] for r in runs), 3)})
+    summary.sort(key=lambda r: -r["accuracy_mean"])
+    return summary
+
+def main(methods_db_path, ssa_dir, cache_dir, configs, folds=5, test_size=0.20, jobs=1, threads=1, max_len=MAX_LEN, max_vars=1024, policy="head", stride=None, seed=77, report_path=None):
+    methods_db = open_methods_db(methods_db_path)
+    funcs_size = len(methods_db) + 2
+    cache, (reused, vectorized) = update_cache(ssa_dir, cache_dir, methods_db)
+    print(f"Feature cache: {reused} methods reused, {vectorized} vectorized")
+    items = cache.Items()
+    # dims come from the whole corpus, so every fold trains the same model shape
+    dims = data_dims(items, max_len, max_vars)
+    splits = kfold(items, folds, seed) if folds > 1 else [split(items, test_size, seed)]
+    tasks = [(config, fold) for config in configs for fold in range(len(splits))]
+    print(f"{len(configs)} configurations x {len(splits)} folds on {jobs} workers x {threads} threads")
+
+    cap_threads(threads)
+    trials = []
+    # spawn, not fork: the parent may have loaded keras/TensorFlow, which don't survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(jobs, mp_context=context, initializer=init_worker, initargs=(threads,)) as executor:
+        futures = [executor.submit(run_trial, cache_dir, config, fold, *splits[fold], funcs_size, dims, policy, stride, seed) for config, fold in tasks]
+        for future in as_completed(futures):
+            trial = future.result()
+            print(f"{trial['config']} fold {trial['fold']}: accuracy {trial['accuracy'] * 100:.2f}% ({trial['seconds']}s)")
+            trials.append(trial)
+    trials.sort(key=lambda t: (json.dumps(t["config"], sort_keys=True), t["fold"]))
+
+    report = {"ssa_dir": os.path.abspath(ssa_dir), "folds": len(splits), "seed": seed, "max_len": dims[0], "vars_size": dims[1], "funcs_size": funcs_size,
+              "policy": policy, "summary": summarize(trials), "trials": trials}
+    for row in report["summary"]:
+        print(f"{row['config']}: {row['accuracy_mean'] * 100:.2f}% +- {row['accuracy_std'] * 100:.2f}% over {row['folds']} folds")
+    if report_path is not None:
+        with open(report_path, 'w') as fp:
+            json.dump(report, fp, indent=4)
+    return report
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel k-fold cross-validation and hyperparameter sweep of the LSTM model")
+    parser.add_argument("methods_db", help="methods db (.json or SQLite store)")
+    parser.add_argument("ssa_dir", help="SSA store or directory of JSON .ssa files")
+    parser.add_argument("cache_dir", help="feature cache dir shared by the workers (see featurecache.py)")
+    parser.add_argument("--lstm-units", type=int_list, default=[100], help="comma separated LSTM sizes")
+    parser.add_argument("--epochs", type=int_list, default=[10], help="comma separated epoch counts")
+    parser.add_argument("--batch-sizes", type=int_list, default=[64], help="comma separated batch sizes")
+    parser.add_argument("--folds", type=int, default=5, help="k for k-fold cross-validation, 1 for a single train/test split")
+    parser.add_argument("--test-size", type=float, default=0.20, help="share of methods in the test split with --folds 1")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="BLAS/TensorFlow threads per worker")
+    parser.add_argument("--max-len", type=int, default=MAX_LEN)
+    parser.add_argument("--max-vars", type=int, default=1024)
+    parser.add_argument("--long", choices=LONG_POLICIES, default="head")
+    parser.add_argument("--window-stride", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=77)
+    parser.add_argument("--report", default=None, help="JSON report output path")
+    args = parser.parse_args()
+    if not os.path.isfile(args.methods_db):
+        print("[!] Invalid methods db path.")
+        sys.exit(1)
+    if not os.path.isdir(args.ssa_dir):
+        print("[!] Invalid ssa dir path.")
+        sys.exit(1)
+    if args.folds < 1 or args.threads < 1:
+        print("[!] Invalid folds/threads.")
+        sys.exit(1)
+    jobs = args.jobs or max(1, os.cpu_count() // args.threads)
+    configs = configurations(args.lstm_units, args.epochs, args.batch_sizes)
+    main(args.methods_db, args.ssa_dir, args.cache_dir, configs, args.folds, args.test_size, jobs, args.threads, args.max_len, args.max_vars, args.long, args.window_stride, args.seed, args.report)
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 import re
 
 class Args(ABC):
@@ -24,29 +25,39 @@ class RegexArgs(Args):
         self.captures = m.groupdict()
 
 class GetStaticArgs(RegexArgs):
-    REGEX = re.compile(r"(?P<class>[a-zA-Z\.0-9_]+)\s+{\s+(?P<stattype>[a-zA-Z\.0-9_]+)\s+(?P<statname>[a-zA-Z\.0-9_]+)\s+}")
+    # nested classes, array types and synthetic fields: Outer$Inner { int[] this$0 }
+    REGEX = re.compile(r"(?P<class>[a-zA-Z\.0-9_$\[\]]+)\s+{\s+(?P<stattype>[a-zA-Z\.0-9_$\[\]]+)\s+(?P<statname>[a-zA-Z\.0-9_$]+)\s+}")
 
     def Parse(self):
         super().Parse()
-        self.cls = self.captures["class"]
-        self.stattype = self.captures["stattype"]
-        self.statname = self.captures["statname"]
+        self.Fill(self.captures["class"], self.captures["stattype"], self.captures["statname"])
+
+    def Fill(self, cls, stattype, statname):
+        self.cls = cls
+        self.stattype = stattype
+        self.statname = statname
         self.name = f"{self.cls}.{self.statname}"
 
     def __repr__(self): return self.name
     def __str__(self): return self.name
     
+class FieldArgs(GetStaticArgs):
+    pass
+    
 class InvokeVirtualArgs(RegexArgs):
-    REGEX = re.compile(r"class\s+(?P<class>[a-zA-Z\.0-9_]+)\s+{\s+(?P<rettype>[a-zA-Z\.0-9]+)\s+(?P<method>[a-zA-Z\.0-9<>_]+)\s+\((?P<args>[a-zA-Z\.0-9,\s]*)\)\s+}")
+    REGEX = re.compile(r"(?:class|interface)\s+(?P<class>[a-zA-Z\.0-9_]+)\s+{\s+(?P<rettype>[a-zA-Z\.0-9]+)\s+(?P<method>[a-zA-Z\.0-9<>_]+)\s+\((?P<args>[a-zA-Z\.0-9,\s]*)\)\s+}")
         
     def Parse(self):
         super().Parse()
-        self.cls = self.captures["class"]
-        self.rettype = self.captures["rettype"]
-        self.method = self.captures["method"]
-        self.methodfull = f"{self.cls}.{self.method}"
-        self.args = [a.strip() for a in self.captures["args"].split(",") if a.strip() != '']
+        args = [a.strip() for a in self.captures["args"].split(",") if a.strip() != '']
+        self.Fill(self.captures["class"], self.captures["rettype"], self.captures["method"], args)
         
+    def Fill(self, cls, rettype, method, args):
+        self.cls = cls
+        self.rettype = rettype
+        self.method = method
+        self.methodfull = f"{self.cls}.{self.method}"
+        self.args = tuple(args)
         
     def __repr__(self): return f"{self.rettype} {self.cls}.{self.method} ({', '.join(self.args)})"
     def __str__(self): return f"{self.rettype} {self.cls}.{self.method} ({', '.join(self.args)})"
@@ -57,15 +68,82 @@ class InvokeSpecialArgs(InvokeVirtualArgs):
 class InvokeStaticArgs(InvokeVirtualArgs):
     pass
     
+class InvokeInterfaceArgs(InvokeVirtualArgs):
+    pass
+    
 class InvokeDynamicArgs(RegexArgs):
     REGEX = re.compile(r"(?P<rettype>[a-zA-Z\.0-9_]+)\s+(?P<method>[a-zA-Z\.0-9_]+)\s+\((?P<args>[a-zA-Z\.0-9,\s_]*)\).*")
     
     def Parse(self):
         super().Parse()
-        self.rettype = self.captures["rettype"]
-        self.method = self.captures["method"]
+        args = [a.strip() for a in self.captures["args"].split(",") if a.strip() != '']
+        self.Fill(self.captures["rettype"], self.captures["method"], args)
+
+    def Fill(self, rettype, method, args):
+        self.rettype = rettype
+        self.method = method
         self.methodfull = self.method
-        self.args = [a.strip() for a in self.captures["args"].split(",")]
+        self.args = tuple(args)
         
     def __repr__(self): return f"{self.rettype} {self.method} ({', '.join(self.args)})"
-    def __str__(self): return f"{self.rettype} {self.method} ({', '.join(self.args)})"
\ No newline at end of file
+    def __str__(self): return f"{self.rettype} {self.method} ({', '.join(self.args)})"
+    
+class BranchArgs(Args):
+    REGEX = re.compile(r"-?\d+")
+    
+    def Parse(self):
+        numbers = self.REGEX.findall(self.raw)
+        if len(numbers) == 0:
+            raise ValueError(f"Unsupported args for {self.__class__.__name__} opcode: {self.raw}")
+        self.target = int(numbers[-1])
+        
+    def __repr__(self): return self.raw
+    def __str__(self): return self.raw
+    
+class SwitchArgs(Args):
+    REGEX = re.compile(r":\s*(-?\d+)")
+    
+    def Parse(self):
+        self.targets = [int(t) for t in self.REGEX.findall(self.raw)]
+        if len(self.targets) == 0:
+            raise ValueError(f"Unsupported args for {self.__class__.__name__} opcode: {self.raw}")
+        
+    def __repr__(self): return self.raw
+    def __str__(self): return self.raw
+    
+class ArgsCache(object):
+    # Parsed args by raw text / referenced member, shared by every method and class the process
+    # handles and bounded with LRU eviction. The cached objects are shared by all instructions
+    # that use them, so they must not be modified after Parse()/Fill().
+    DEFAULT_SIZE = 65536
+    
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def Get(self, key, build):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = self.entries[key] = build()
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+        
+    def Clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        
+    def Stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"Args cache: {self.hits} hits, {self.misses} misses ({rate:.1%}), {len(self.entries)} entries"
+        
+ARGS_CACHE = ArgsCache()
@@ -0,0 +1,270 @@
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+
+from bparser import Method, NativeClass, OpalClass
+from classreader import ClassFile
+from htmlindex import HtmlIndex
+from methodsdb import MethodsDB
+from argparsers import ARGS_CACHE
+from ssastore import ShardWriter, JsonWriter
+from synth import synth_corpus, render_html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ML"))
+from features import ssa_arrays, encode_batch, MAX_LEN
+
+# Stage benchmarks over a synthetic corpus (synth.py). Every stage gets its input prepared
+# outside of its timer, so the numbers are per stage and not cumulative:
+#   read           - ClassFile parsing (constant pool, methods, Code attributes)
+#   disassemble    - the OPAL server writing HTML (only with --opal, needs java and the jar)
+#   html_index     - htmlindex.py over the OPAL style HTML
+#   parse_native   - Method.Parse from the class file (decode + compile)
+#   parse_html     - Method.Parse from the HTML rows
+#   emulate_linear - Method.Emulate, straight-line
+#   emulate_cfg    - Method.Emulate, CFG based SSA
+#   write_store    - SSA into a binary store
+#   write_json     - SSA as JSON .ssa files
+#   vectorize      - features.encode_batch (what transform_sequence used to do)
+# Each stage runs --repeat times; the best time gives methods/sec. Every stage runs in a forked
+# child and its peak RSS is that child's high-water mark, so it covers one stage (and its
+# inputs) and not the stages before it. --baseline compares methods/sec with a saved run
+# (bench-baseline.json next to this file by default) and exits with 1 when a stage got slower
+# than --tolerance.
+
+STAGES = ("read", "disassemble", "html_index", "parse_native", "parse_html", "emulate_linear", "emulate_cfg", "write_store", "write_json", "vectorize")
+DEFAULT_STAGES = tuple(s for s in STAGES if s != "disassemble")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench-baseline.json")
+
+class HtmlClass(OpalClass):
+    # an OpalClass over HTML that is already in memory, no disassembler involved
+    def __init__(self, index):
+        self.index = index
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def parsed_methods(sources):
+    methods = []
+    for source in sources:
+        for name in source.MethodNames():
+            m = Method(source, name, MethodsDB())
+            m.Parse()
+            methods.append(m)
+    return methods
+
+def fixed(data):
+    return lambda: data
+
+class Bench(object):
+    # a stage method returns (prepare, run); prepare() makes the input of one repeat outside
+    # of the timer, run(input) is timed
+    def __init__(self, corpus, workdir):
+        self.corpus = corpus
+        self.workdir = workdir
+        self.methods = sum(len(ClassFile(data).methods) for _, data in corpus)
+        self.html = None
+        self.ssa = None
+        self.pool = None
+
+    def html_pages(self):
+        if self.html is None:
+            self.html = [render_html(data) for _, data in self.corpus]
+        return self.html
+
+    def ssa_output(self):
+        if self.ssa is None:
+            Method.EMULATION = "linear"
+            self.ssa = []
+            for name, data in self.corpus:
+                methods = parsed_methods([NativeClass(ClassFile(data))])
+                for m in methods:
+                    m.Emulate()
+                self.ssa.append((name, [(m.method, m.ssaout) for m in methods]))
+        return self.ssa
+
+    def read(self):
+        return fixed(None), lambda _: [ClassFile(data) for _, data in self.corpus]
+
+    def disassemble(self):
+        from disasm import get_pool
+        pool = self.pool = get_pool()
+        paths = []
+        for name, data in self.corpus:
+            path = os.path.join(self.workdir, os.path.basename(name) + ".class")
+            with open(path, "wb") as fp:
+                fp.write(data)
+            paths.append(path)
+        pool.Disassemble(paths[0], paths[0] + ".html") # JVM startup and warm-up aren't timed
+        return fixed(paths), lambda paths: [pool.Disassemble(p, p + ".html") for p in paths]
+
+    def html_index(self):
+        return fixed(self.html_pages()), lambda html: [HtmlIndex(text) for text in html]
+
+    def parse(self, make_sources):
+        def prepare():
+            ARGS_CACHE.Clear() # every repeat starts cold
+            return make_sources()
+        return prepare, parsed_methods
+
+    def parse_native(self):
+        return self.parse(lambda: [NativeClass(ClassFile(data)) for _, data in self.corpus])
+
+    def parse_html(self):
+        html = self.html_pages()
+        return self.parse(lambda: [HtmlClass(HtmlIndex(text)) for text in html])
+
+    def emulate(self, emulation):
+        # emulation changes the Method objects, so every repeat parses them again
+        def prepare():
+            Method.EMULATION = emulation
+            return parsed_methods([NativeClass(ClassFile(data)) for _, data in self.corpus])
+        def run(methods):
+            for m in methods:
+                m.Emulate()
+        return prepare, run
+
+    def emulate_linear(self):
+        return self.emulate("linear")
+
+    def emulate_cfg(self):
+        return self.emulate("cfg")
+
+    def write(self, writer_class):
+        ssa = self.ssa_output()
+        def prepare():
+            path = os.path.join(self.workdir, "out")
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            return writer_class(path)
+        def run(writer):
+            for name, methods in ssa:
+                for method_name, ssaout in methods:
+                    writer.Write(name + ".class", method_name, ssaout)
+            writer.Close()
+        return prepare, run
+
+    def write_store(self):
+        return self.write(ShardWriter)
+
+    def write_json(self):
+        return self.write(JsonWriter)
+
+    def vectorize(self):
+        arrays = [ssa_arrays(ssaout) for _, methods in self.ssa_output() for _, ssaout in methods]
+        funcs_size = max((int(a[1].max()) for a in arrays if len(a[1])), default=0) + 2
+        return fixed(arrays), lambda arrays: encode_batch(arrays, funcs_size, MAX_LEN)
+
+    def Run(self, stage, repeat):
+        # in a child process: the memory of a stage (and of its inputs) goes with it
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                stats = self.run_stage(stage, repeat)
+            except BaseException as e:
+                stats = {"error": f"{e.__class__.__name__}: {e}"}
+            finally:
+                if self.pool is not None:
+                    self.pool.Close()
+            with os.fdopen(write_fd, "w") as fp:
+                json.dump(stats, fp)
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, "r") as fp:
+            stats = json.load(fp)
+        os.waitpid(pid, 0)
+        if "error" in stats:
+            raise RuntimeError(f"Stage {stage} failed: {stats['error']}")
+        return stats
+
+    def run_stage(self, stage, repeat):
+        prepare, run = getattr(self, stage)()
+        times = []
+        for _ in range(repeat):
+            data = prepare()
+            start = time.perf_counter()
+            run(data)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        return {"seconds": round(best, 6), "median_seconds": round(statistics.median(times), 6),
+                "methods_per_sec": round(self.methods / best, 1) if best > 0 else None, "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+def compare(result, baseline, tolerance):
+    # [(stage, current, baseline, ratio, regressed)] for the stages both runs have
+    rows = []
+    for stage, current in result["stages"].items():
+        old = baseline["stages"].get(stage)
+        if old is None or not old.get("methods_per_sec") or not current.get("methods_per_sec"):
+            continue
+        ratio = current["methods_per_sec"] / old["methods_per_sec"]
+        rows.append((stage, current["methods_per_sec"], old["methods_per_sec"], ratio, ratio < 1 - tolerance))
+    return rows
+
+def main(config, stages=DEFAULT_STAGES, repeat=3, baseline_path=None, tolerance=0.15, save_path=None, json_path=None):
+    corpus = synth_corpus(**config)
+    workdir = tempfile.mkdtemp(prefix="ssabench")
+    emulation = Method.EMULATION
+    try:
+        bench = Bench(corpus, workdir)
+        print(f"Corpus: {len(corpus)} classes, {bench.methods} methods ({config}), RSS before the stages {peak_rss_mb():.1f} MiB")
+        result = {"config": config, "repeat": repeat, "python": platform.python_version(), "machine": platform.machine(), "stages": {}}
+        for stage in stages:
+            stats = bench.Run(stage, repeat)
+            result["stages"][stage] = stats
+            print(f"{stage:16} {stats['seconds'] * 1000:10.1f} ms {stats['methods_per_sec'] or 0:12.1f} methods/s  peak RSS {stats['peak_rss_mb']:.1f} MiB")
+    finally:
+        Method.EMULATION = emulation
+        shutil.rmtree(workdir, ignore_errors=True)
+    if json_path is not None:
+        with open(json_path, 'w') as fp:
+            json.dump(result, fp, indent=4)
+    if save_path is not None:
+        with open(save_path, 'w') as fp:
+            json.dump(result, fp, indent=4)
+        print(f"Baseline saved to {save_path}")
+    regressed = False
+    if baseline_path is not None:
+        with open(baseline_path, 'r') as fp:
+            baseline = json.load(fp)
+        if baseline.get("config") != config:
+            print(f"[!] The baseline was taken with a different corpus: {baseline.get('config')}")
+        for stage, current, old, ratio, slower in compare(result, baseline, tolerance):
+            print(f"{stage:16} {current:12.1f} vs {old:12.1f} methods/s ({ratio - 1:+.1%}){'  REGRESSION' if slower else ''}")
+            regressed = regressed or slower
+    return result, regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage benchmark of the SSA pipeline on a synthetic corpus")
+    parser.add_argument("--classes", type=int, default=100)
+    parser.add_argument("--methods", type=int, default=4, help="methods per class")
+    parser.add_argument("--length", type=int, default=64, help="instructions per method (about)")
+    parser.add_argument("--branch-density", type=float, default=0.1, help="share of branch statements")
+    parser.add_argument("--invoke-ratio", type=float, default=0.3, help="share of invoke statements among the rest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(DEFAULT_STAGES), help=f"comma separated subset of {','.join(STAGES)}")
+    parser.add_argument("--opal", action="store_true", help="also time the OPAL disassembler (needs java and the jar)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", default=None, help="write the results as JSON")
+    parser.add_argument("--save-baseline", default=None, help="write the results as a baseline")
+    parser.add_argument("--baseline", nargs="?", const=DEFAULT_BASELINE, default=None, help="compare methods/sec with this baseline (default: bench-baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before a stage is flagged")
+    args = parser.parse_args()
+    stages = [s for s in args.stages.split(",") if s]
+    if args.opal and "disassemble" not in stages:
+        stages.insert(1, "disassemble")
+    if any(s not in STAGES for s in stages):
+        print("[!] Invalid stages.")
+        sys.exit(1)
+    if args.baseline is not None and not os.path.isfile(args.baseline):
+        print("[!] Invalid baseline path.")
+        sys.exit(1)
+    config = {"classes": args.classes, "methods": args.methods, "length": args.length, "branch_density": args.branch_density, "invoke_ratio": args.invoke_ratio, "seed": args.seed}
+    _, regressed = main(config, stages, args.repeat, args.baseline, args.tolerance, args.save_baseline, args.json)
+    sys.exit(1 if regressed else 0)
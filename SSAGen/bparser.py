@@ -1,26 +1,48 @@
 import sys, os
-import json
-from subprocess import call
-import tempfile
-from bs4 import BeautifulSoup
+import signal
+import argparse
+from contextlib import contextmanager
 from argparsers import *
 from emulators import *
+from classreader import ClassFile, ClassFormatError, MALFORMED
+from sources import iter_classes, as_entry
+from methodsdb import open_methods_db, ScopedMethodsDB, replay, remap_ssa
+from cfg import CFGEmulator
+from stackeffects import table_emulators
+from ssastore import open_writer, write_ssa, FORMATS
+from ssacache import SSACache, method_key, DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES
 from mnemonics import MNEMONICS
+import tracing
+import metrics
 
 DISASM_CMD = "java__SEP__-jar__SEP__OPALDisassembler.jar__SEP__-source__SEP__{src}__SEP__-o__SEP__{output}"
     
 class Instruction(object):
+    __slots__ = ("pc", "mnem", "opcode", "hasArgs", "args", "emulator", "index")
+    
     ARGPARSE = {
         178: GetStaticArgs,
+        179: FieldArgs,
+        180: FieldArgs,
+        181: FieldArgs,
         182: InvokeVirtualArgs,
         183: InvokeSpecialArgs,
         184: InvokeStaticArgs,
-        186: InvokeDynamicArgs
+        185: InvokeInterfaceArgs,
+        186: InvokeDynamicArgs,
+        **{op: BranchArgs for op in list(range(153, 169)) + [198, 199, 200, 201]},
+        170: SwitchArgs,
+        171: SwitchArgs
     }
     
+    # every opcode gets the generic stack effect emulator, the ones that produce SSA
+    # instructions or need the args have their own
     EMULATE = {
+        **table_emulators(),
         1: AconstNullEmulator(),
         18: LoadConstEmulator(),
+        19: LoadConstEmulator(),
+        20: LoadConstEmulator(2),
         25: AloadEmulator(None),
         42: AloadEmulator(0),
         43: AloadEmulator(1),
@@ -44,6 +66,7 @@ class Instruction(object):
         182: InvokeVirtualEmulator(),
         183: InvokeSpecialEmulator(),
         184: InvokeStaticEmulator(),
+        185: InvokeInterfaceEmulator(),
         186: InvokeDynamicEmulator(),
         187: NewEmulator(),
         191: AthrowEmulator(),
@@ -52,38 +75,19 @@ class Instruction(object):
     
     DEFAULT_EMLATOR = DefaultInstEmulator()
     
-    def __init__(self, row):
-        self.hasArgs = False
-        self.args = None
-        columns = row.find_all("td")
-        self.pc = int(columns[0].text)
-        instruction_info = columns[2]
-        
-        opcode = instruction_info.find_all("span", {"class": "instruction"})
-        if len(opcode) != 1:
-            raise ValueError("Couldn't find instruction opcode")
-        self.mnem = opcode[0].text.strip()
+    def __init__(self, pc, mnem, rawargs=None, args=None):
+        self.pc = pc
+        self.mnem = sys.intern(mnem)
+        self.hasArgs = rawargs is not None
+        self.args = args
+        self.index = None
         try:
             self.opcode = MNEMONICS[self.mnem]
         except KeyError as e:
             raise ValueError(f"Unregistered mnemonic: {self.mnem}")
         
-        self.instruction_info = opcode[0].parent
-        children = list(self.instruction_info.findChildren("span", recursive=False))
-        if len(children) == 2:
-            self.hasArgs = True
-            rawargs = children[1].text.strip()
-        else: # goto support
-            children = list(self.instruction_info.findChildren("a", recursive=False))
-            if len(children) == 1:
-                self.hasArgs = True
-                rawargs = children[0].text.strip()
-        if self.hasArgs:
-            if self.opcode in Instruction.ARGPARSE:
-                self.args = Instruction.ARGPARSE[self.opcode](rawargs)
-            else:
-                self.args = DefaultArgs(rawargs)
-            self.args.Parse()
+        if self.hasArgs and self.args is None:
+            self.args = Instruction.ParseArgs(self.opcode, rawargs)
             
         # init emulator
         if self.opcode in Instruction.EMULATE:
@@ -91,6 +95,12 @@ class Instruction(object):
         else:
             self.emulator = Instruction.DEFAULT_EMLATOR
             
+    @staticmethod
+    def ParseArgs(opcode, rawargs):
+        args = Instruction.ARGPARSE.get(opcode, DefaultArgs)(rawargs)
+        args.Parse()
+        return args
+        
     def Emulate(self, econtext):
         self.emulator.Emulate(self, econtext)
             
@@ -101,18 +111,122 @@ class Instruction(object):
     def __str__(self): return f"{self.pc}: {self.mnem} ({self.opcode})" + self.__repr_args()
     def __repr__(self): return f"{self.pc}: {self.mnem} ({self.opcode})" + self.__repr_args()
 
+def build_instructions(records):
+    # records are (pc, mnemonic, raw args, parsed args or None); equal argument text is parsed
+    # once per process (ARGS_CACHE)
+    instructions = []
+    for pc, mnem, rawargs, args in records:
+        if args is None and rawargs is not None:
+            opcode = MNEMONICS.get(mnem)
+            args = ARGS_CACHE.Get((mnem, rawargs), lambda: Instruction.ParseArgs(opcode, rawargs))
+        instructions.append(Instruction(pc, mnem, rawargs, args))
+    return instructions
+
+class CompiledMethod(object):
+    # instructions of a method with their emulators bound once, run as one tight loop
+    __slots__ = ("instructions", "emulate")
+    
+    def __init__(self, instructions):
+        for index, inst in enumerate(instructions):
+            inst.index = index
+        self.instructions = tuple(instructions)
+        self.emulate = tuple(inst.emulator.Emulate for inst in instructions)
+        
+    def Run(self, econtext):
+        if metrics.enabled:
+            return self.RunCounted(econtext)
+        for emulate, inst in zip(self.emulate, self.instructions):
+            emulate(inst, econtext)
+            
+    def RunCounted(self, econtext):
+        for emulate, inst in zip(self.emulate, self.instructions):
+            metrics.count_instruction(inst)
+            emulate(inst, econtext)
+
+class OpalMethod(object):
+    def __init__(self, index, method):
+        self.index = index
+        self.method = method
+        self.max_stack = None
+        self.max_locals = None
+        self.exception_table = []
+        
+    def Instructions(self):
+        # the row elements are dropped here, only the parsed fields are kept
+        return build_instructions((pc, mnem, rawargs, None) for pc, mnem, rawargs, _ in self.index.Rows(self.method))
+        
+class OpalClass(object):
+    def __init__(self, class_file, pool=None):
+        from htmlindex import HtmlIndex # html.parser is only needed by the OPAL backend
+        temp = get_temp_file_path()
+        if pool is not None:
+            pool.Disassemble(class_file, temp)
+        else:
+            invoke(DISASM_CMD, {"src": class_file, "output": temp})
+        self.index = HtmlIndex.Load(temp)
+        os.remove(temp)
+        
+    def MethodNames(self):
+        return self.index.MethodNames()
+        
+    def GetMethod(self, method):
+        if self.index.Count(method) != 1:
+            raise ValueError("Method data wasn't found")
+        return OpalMethod(self.index, method)
+        
+class NativeMethod(object):
+    def __init__(self, method_info):
+        self.method_info = method_info
+        self.max_stack = method_info.max_stack
+        self.max_locals = method_info.max_locals
+        self.exception_table = method_info.exception_table
+        
+    def Instructions(self):
+        return build_instructions(self.method_info.Decode())
+        
+class NativeClass(object):
+    def __init__(self, classfile):
+        self.classfile = classfile
+        
+    def MethodNames(self):
+        return self.classfile.MethodNames()
+        
+    def GetMethod(self, method):
+        method_data = self.classfile.GetMethods(method)
+        if len(method_data) != 1:
+            raise ValueError("Method data wasn't found")
+        return NativeMethod(method_data[0])
+        
+BACKENDS = {
+    "native": NativeClass,
+    "opal": OpalClass,
+}
+
+def load_class(class_file, backend="native", pool=None):
+    entry = as_entry(class_file)
+    if backend == "native":
+        try:
+            return NativeClass(ClassFile(entry.Read()))
+        except ClassFormatError as e:
+            print(f"[!] Native reader failed for {entry} ({e}), falling back to OPAL")
+    with entry.AsFile() as path:
+        return OpalClass(path, pool)
+
 class Method(object):
-    VARARR_SIZE = 500
-    NO_VAR = 0
+    VARARR_SIZE = 500 # when max_locals is unknown (OPAL backend)
+    NO_VAR = NO_VAR
+    EMULATION = "linear" # or "cfg": per basic block, with phis at control flow merges
+    EMULATIONS = ("linear", "cfg")
 
-    def __init__(self, soup, method, method_db):
+    def __init__(self, source, method, method_db):
         self.method = method
         self.method_db = method_db
         self.instructions = None
-        method_data = soup.find_all(attrs={"class": "method", "data-name": method})
-        if len(method_data) != 1:
-            raise ValueError("Method data wasn't found")
-        self.method_data = method_data[0]
+        self.compiled = None
+        self.method_data = source.GetMethod(method)
+        self.max_stack = self.method_data.max_stack
+        self.max_locals = self.method_data.max_locals
+        self.exception_table = self.method_data.exception_table
         self.current_var = 0
         
         self.stack = None
@@ -120,78 +234,270 @@ class Method(object):
         self.ssaout = None
         
     def Parse(self):
-        instruction_table = self.method_data.find_all("table", {"class": "method_bytecode"})
-        if len(instruction_table) != 1:
-            raise ValueError("No instruction table was found")
-        instruction_table = instruction_table[0]
-        rows = instruction_table.find_all("tr")
-        rows.pop(0)
-        self.instructions = [Instruction(row) for row in rows]
+        with metrics.stage("parse"):
+            self.compiled = CompiledMethod(self.method_data.Instructions())
+        self.instructions = self.compiled.instructions
         
     def get_new_var(self):
         self.current_var += 1
-        print(f"Created var V{self.current_var}")
+        if tracing.level >= tracing.TRACE:
+            tracing.emit("var", var=self.current_var)
         return self.current_var
         
     def EmulatorState(self):
-        print(f"\tSTACK:  {self.stack}")
-        print(f"\tVARARR: {self.vararr}")
+        tracing.emit("state", stack=list(self.stack.stack), vararr=self.vararr.vararr.tolist())
+        
+    def LocalsSize(self):
+        # slot 0 always gets THIS, even for static methods without locals
+        if self.max_locals is None:
+            return Method.VARARR_SIZE
+        return max(self.max_locals, 1)
         
     def Emulate(self):
-        self.stack = JVMStack()
-        self.vararr = JVMVarArray(Method.VARARR_SIZE)
+        with metrics.stage("emulate"):
+            try:
+                if Method.EMULATION == "cfg":
+                    self.EmulateCFG()
+                else:
+                    self.EmulateLinear()
+            except Exception as e:
+                if metrics.enabled:
+                    metrics.emulation_error(e)
+                raise
+        
+    def EmulateLinear(self):
+        self.stack = JVMStack(self.max_stack)
+        self.vararr = JVMVarArray(self.LocalsSize())
         self.vararr[0] = self.get_new_var() # put THIS to the VARARRAY
         self.ssaout = []
         
         econtext = EmulationContext(self.ssaout, self.instructions, self.stack, self.vararr, self.method_db, self.get_new_var)
-        for i in self.instructions:
-            self.EmulatorState()
-            i.Emulate(econtext)
+        if tracing.level >= tracing.INFO:
+            tracing.emit("method", method=self.method, instructions=len(self.instructions))
+        if tracing.level >= tracing.TRACE:
+            for i in self.instructions:
+                self.EmulatorState()
+                tracing.emit("inst", pc=i.pc, op=i.mnem, args=str(i.args) if i.hasArgs else None)
+                i.Emulate(econtext)
+        else:
+            self.compiled.Run(econtext)
         if len(self.stack.stack) != 0:
             raise ValueError("Stack is not empty after emulation")
         
+    def EmulateCFG(self):
+        self.ssaout = []
+        if tracing.level >= tracing.INFO:
+            tracing.emit("method", method=self.method, instructions=len(self.instructions))
+        this = self.get_new_var()
+        CFGEmulator(self, self.LocalsSize()).Run(self.ssaout, self.method_db, self.get_new_var, this)
+        
     def PrintBody(self):
         for i in self.instructions:
             print(i)
         
 def invoke(command, args={}):
+    from subprocess import call
     call(command.format(**args).split("__SEP__"))
     
 def get_temp_file_path():
+    import tempfile
     t = tempfile.NamedTemporaryFile()
     name = t.name
     t.close()
     return name
 
-def main(class_file, method_db_path, ssaout_path):
-    temp = get_temp_file_path()
-    invoke(DISASM_CMD, {"src": class_file, "output": temp})
-    method_db = json.load(open(method_db_path, 'r'))
-    with open(temp) as fp:
-        soup = BeautifulSoup(fp, 'html.parser')
-        all_methods = soup.find_all("details", {"class": "method"})
-        all_methods = [e["data-name"] for e in all_methods]
-        for method_name in [m for m in all_methods if m == "bad" or (m != "good" and m.startswith("good"))]:
+def select_methods(all_methods):
+    return [m for m in all_methods if m == "bad" or (m != "good" and m.startswith("good"))]
+
+class ClassTimeout(Exception):
+    pass
+
+@contextmanager
+def time_limit(seconds):
+    # wall-clock limit (SIGALRM, main thread only); a hung disassembler is interrupted too
+    if not seconds:
+        yield
+        return
+    def expired(signum, frame):
+        raise ClassTimeout(f"Timeout after {seconds}s")
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def ProcessClass(class_file, method_db, backend="native", pool=None, cache=None, statuses=None, timeout=None):
+    # With a statuses list a failing method doesn't fail the class: every selected method gets
+    # (method, "done" | "failed" | "skipped", reason) and the class result has the done ones.
+    # ClassTimeout always fails the whole class.
+    with metrics.stage("class"):
+        try:
+            with time_limit(timeout):
+                results = process_class(class_file, method_db, backend, pool, cache, statuses)
+        except Exception:
+            if metrics.enabled:
+                metrics.inc("classes_total", result="failed")
+            raise
+    if metrics.enabled:
+        metrics.inc("classes_total", result="ok")
+        metrics.inc("methods_total", len(results))
+    return results
+
+def run_method(source, method_name, method_db, statuses):
+    # the emulated Method, or None when the method failed and statuses took the error
+    try:
+        m = Method(source, method_name, method_db)
+    except ValueError as e: # no or several methods of this name
+        if statuses is None:
+            raise
+        statuses.append((method_name, "skipped", str(e)))
+        return None
+    try:
+        m.Parse()
+        m.Emulate()
+    except ClassTimeout:
+        raise
+    except Exception as e:
+        if statuses is None:
+            raise
+        statuses.append((method_name, "failed", f"{e.__class__.__name__}: {e}"))
+        return None
+    if statuses is not None:
+        statuses.append((method_name, "done", None))
+    return m
+
+def process_class(class_file, method_db, backend, pool, cache, statuses=None):
+    class_file = as_entry(class_file)
+    if cache is not None:
+        try:
+            classfile = ClassFile(class_file.Read())
+        except ClassFormatError:
+            classfile = None
+        if classfile is not None:
+            return process_class_cached(class_file, classfile, method_db, backend, pool, cache, statuses)
+    with metrics.stage("load"):
+        source = load_class(class_file, backend, pool)
+    results = []
+    for method_name in select_methods(source.MethodNames()):
+        print(f"Processing method '{method_name}' for class {class_file}...")
+        m = run_method(source, method_name, method_db, statuses)
+        if m is not None:
+            results.append((method_name, m.ssaout))
+    return results
+
+def process_class_cached(class_file, classfile, method_db, backend, pool, cache, statuses=None):
+    # methods are emulated against their own scoped db so the cached SSA is independent of
+    # the methods DB; on a hit the class isn't disassembled, parsed or emulated at all
+    source = None
+    results = []
+    for method_name in select_methods(classfile.MethodNames()):
+        method_info = classfile.GetMethods(method_name)
+        try:
+            key = method_key(classfile.cp, method_info[0], backend, Method.EMULATION) if len(method_info) == 1 else None
+        except MALFORMED:
+            key = None # malformed code isn't cached, run_method reports it
+        entry = cache.Get(key) if key is not None else None
+        if entry is None:
             print(f"Processing method '{method_name}' for class {class_file}...")
-            m = Method(soup, method_name, method_db)
-            m.Parse()
-            m.Emulate()
-            class_file_name = class_file.split("\\")[-1]
-            outpath = os.path.join(ssaout_path, f"{class_file_name.replace('.class', '')}_{method_name}.ssa")
-            json.dump(m.ssaout, open(outpath, 'w'), indent=4)
-    json.dump(m.method_db, open(method_db_path, 'w'), indent=4)
+            if source is None:
+                with metrics.stage("load"):
+                    source = NativeClass(classfile) if backend == "native" else load_class(class_file, backend, pool)
+            scoped = ScopedMethodsDB()
+            m = run_method(source, method_name, scoped, statuses)
+            if m is None:
+                # the lookups made before the failure count, like without the cache
+                replay(method_db, scoped.ops)
+                continue
+            entry = (scoped.ops, m.ssaout)
+            if key is not None:
+                cache.Put(key, *entry)
+        elif statuses is not None:
+            statuses.append((method_name, "done", None))
+        ops, ssaout = entry
+        results.append((method_name, remap_ssa(ssaout, replay(method_db, ops))))
+    return results
+
+def main(class_file, method_db_path, ssaout_path, backend="native", pool=None, cache=None, format="shards", timeout=None):
+    # class_file may also be a jar/zip or a directory tree, classes are streamed from it; a
+    # failing class or method is reported and skipped
+    method_db = open_methods_db(method_db_path)
+    writer = open_writer(ssaout_path, format)
+    try:
+        for entry in iter_classes(class_file):
+            known = len(method_db)
+            statuses = []
+            try:
+                methods = ProcessClass(entry, method_db, backend, pool, cache, statuses, timeout)
+            except Exception as e:
+                print(f"[!] Failed to process {entry}: {e.__class__.__name__}: {e}")
+                continue
+            for method_name, status, reason in statuses:
+                if status != "done":
+                    print(f"[!] {status.capitalize()} method '{method_name}' of {entry}: {reason}")
+            with metrics.stage("write"):
+                for method_name, ssaout in methods:
+                    writer.Write(entry.name, method_name, ssaout)
+            if metrics.enabled:
+                metrics.methods_db_growth(known, len(method_db))
+                metrics.maybe_export()
+    finally:
+        writer.Close()
+        method_db.Close()
     
-if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: .py <path to .class file to analyse> <method db path> <out ssa dir>")
-        sys.exit(1)
-    if not os.path.isfile(sys.argv[1]):
-        print("[!] Invalid class file path.")
-        sys.exit(1)
-    if not os.path.isfile(sys.argv[2]):
+def add_arguments(parser):
+    # the options bparser.py and worker.py share
+    parser.add_argument("--format", choices=FORMATS, default="shards", help="binary SSA store (default) or one JSON file per method")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="native", help="bytecode reader (default: native)")
+    parser.add_argument("--emulation", choices=Method.EMULATIONS, default="linear", help="straight-line emulation or CFG based SSA with phis (default: linear)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SSA cache path")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024, help="SSA cache size limit in MiB")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the SSA cache")
+    parser.add_argument("--rebuild", action="store_true", help="ignore cached SSA and store fresh results")
+    parser.add_argument("--trace", choices=sorted(tracing.LEVELS, key=tracing.LEVELS.get), default="off", help="emulation trace level")
+    parser.add_argument("--trace-file", default=None, help="JSON lines trace output (default: stderr)")
+    parser.add_argument("--timeout", type=float, default=None, help="wall-clock limit per class in seconds")
+    metrics.add_arguments(parser)
+
+def check_paths(args):
+    if args.method_db.endswith(".json") and not os.path.isfile(args.method_db):
         print("[!] Invalid method db file path.")
         sys.exit(1)
-    if not os.path.isdir(sys.argv[3]):
+    if not os.path.isdir(args.ssaout):
         print("[!] Invalid ssaout dir.")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
\ No newline at end of file
+
+def configure_from_args(args):
+    # returns the SSA cache (or None)
+    tracing.configure(args.trace, args.trace_file)
+    metrics.configure_from_args(args)
+    Method.EMULATION = args.emulation
+    return None if args.no_cache else SSACache(args.cache, args.cache_size * 1024 * 1024, args.rebuild)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Java bytecode to SSA converter")
+    parser.add_argument("class_file", help="path to .class file, jar or directory to analyse")
+    parser.add_argument("method_db", help="method db path (.json, or an SQLite store that is created if missing)")
+    parser.add_argument("ssaout", help="out ssa dir")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if not os.path.isfile(args.class_file) and not os.path.isdir(args.class_file):
+        print("[!] Invalid class file path.")
+        sys.exit(1)
+    check_paths(args)
+    cache = configure_from_args(args)
+    pool = None
+    if args.backend == "opal":
+        # one JVM for all classes of a jar or directory
+        from disasm import get_pool
+        pool = get_pool()
+    try:
+        main(args.class_file, args.method_db, args.ssaout, args.backend, pool, cache, args.format, args.timeout)
+    finally:
+        if pool is not None:
+            pool.Close()
+        metrics.export()
+    if cache is not None:
+        print(cache.Stats())
+    print(ARGS_CACHE.Stats())
@@ -0,0 +1,345 @@
+from array import array
+import tracing
+import metrics
+from emulators import JVMStack, JVMVarArray, EmulationContext, EmulationError, NO_VAR
+from methodsdb import ScopedMethodsDB
+
+# Control flow graph based emulation: basic blocks from branch targets and the exception
+# table, dominators (Cooper/Harvey/Kennedy), dominance frontiers and phi placement on the
+# iterated frontier of each local/stack slot's definitions, then one renaming pass over the
+# blocks in reverse postorder. Every step is linear in the number of instructions/edges
+# (up to the phi placement, which is linear per slot that has definitions).
+
+CONDITIONAL = set(range(153, 167)) | {198, 199}
+GOTO = {167, 200}
+JSR = {168, 201}
+SWITCH = {170, 171}
+RETURNS = set(range(172, 178))
+TERMINAL = RETURNS | {169, 191}
+ENDS_BLOCK = CONDITIONAL | GOTO | JSR | SWITCH | TERMINAL
+
+PHI_METHOD = "special.phi"
+
+class Block(object):
+    __slots__ = ("start", "end", "succs", "preds", "handler", "rpo", "idom", "frontier",
+                 "entry_height", "local_defs", "stack_defs", "phis", "exit_stack", "exit_locals", "exit_wide", "out")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.succs = []
+        self.preds = []
+        self.handler = False
+        self.rpo = None
+        self.idom = None
+        self.frontier = set()
+        self.entry_height = 0
+        self.local_defs = ()
+        self.stack_defs = ()
+        self.phis = []
+        self.exit_stack = None
+        self.exit_locals = None
+        self.exit_wide = None
+        self.out = []
+
+def link(a, b):
+    if b not in a.succs:
+        a.succs.append(b)
+        b.preds.append(a)
+
+def build_blocks(instructions, exception_table):
+    n = len(instructions)
+    if n == 0:
+        raise EmulationError("Method has no instructions")
+    pc_index = {inst.pc: i for i, inst in enumerate(instructions)}
+
+    def index_of(pc):
+        if pc not in pc_index:
+            raise EmulationError(f"Branch target {pc} is not an instruction")
+        return pc_index[pc]
+
+    def targets(inst):
+        if not inst.hasArgs:
+            raise EmulationError(f"Branch without target at {inst.pc}")
+        if inst.opcode in SWITCH:
+            return [index_of(t) for t in inst.args.targets]
+        return [index_of(inst.args.target)]
+
+    leaders = {0}
+    for i, inst in enumerate(instructions):
+        op = inst.opcode
+        if op in ENDS_BLOCK:
+            if op not in TERMINAL:
+                leaders.update(targets(inst))
+            if i + 1 < n:
+                leaders.add(i + 1)
+    for start, end, handler, _ in exception_table:
+        leaders.add(index_of(handler))
+        # split at the protected range so exception edges leave whole blocks
+        for pc in (start, end):
+            if pc in pc_index:
+                leaders.add(pc_index[pc])
+
+    starts = sorted(leaders)
+    blocks = [Block(s, e) for s, e in zip(starts, starts[1:] + [n])]
+    block_at = {b.start: b for b in blocks}
+    for b in blocks:
+        last = instructions[b.end - 1]
+        op = last.opcode
+        if op in ENDS_BLOCK and op not in TERMINAL:
+            for t in targets(last):
+                link(b, block_at[t])
+        if (op not in ENDS_BLOCK or op in CONDITIONAL or op in JSR) and b.end < n:
+            link(b, block_at[b.end])
+    for start, end, handler, _ in exception_table:
+        target = block_at[pc_index[handler]]
+        target.handler = True
+        for b in blocks:
+            if start <= instructions[b.start].pc < end:
+                link(b, target)
+    return blocks
+
+def reverse_postorder(entry):
+    order = []
+    visited = {id(entry)}
+    stack = [(entry, iter(entry.succs))]
+    while stack:
+        block, succs = stack[-1]
+        for s in succs:
+            if id(s) not in visited:
+                visited.add(id(s))
+                stack.append((s, iter(s.succs)))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    order.reverse()
+    for i, b in enumerate(order):
+        b.rpo = i
+    return order
+
+def intersect(a, b):
+    while a is not b:
+        while a.rpo > b.rpo:
+            a = a.idom
+        while b.rpo > a.rpo:
+            b = b.idom
+    return a
+
+def compute_dominators(order):
+    entry = order[0]
+    entry.idom = entry
+    changed = True
+    while changed:
+        changed = False
+        for b in order[1:]:
+            new_idom = None
+            for p in b.preds:
+                if p.rpo is None or p.idom is None:
+                    continue
+                new_idom = p if new_idom is None else intersect(p, new_idom)
+            if new_idom is not b.idom:
+                b.idom = new_idom
+                changed = True
+
+def compute_frontiers(order):
+    for b in order:
+        preds = [p for p in b.preds if p.rpo is not None]
+        if len(preds) < 2:
+            continue
+        for p in preds:
+            runner = p
+            while runner is not b.idom:
+                runner.frontier.add(b)
+                runner = runner.idom
+
+def iterated_frontier(def_blocks):
+    result = set()
+    work = list(def_blocks)
+    seen = set(id(b) for b in work)
+    while work:
+        for y in work.pop().frontier:
+            if y not in result:
+                result.add(y)
+                if id(y) not in seen:
+                    seen.add(id(y))
+                    work.append(y)
+    return result
+
+class CFGEmulator(object):
+    def __init__(self, method, nlocals):
+        self.method = method
+        self.instructions = method.instructions
+        self.nlocals = nlocals
+        self.blocks = build_blocks(self.instructions, method.exception_table or [])
+        # a virtual, empty entry block holds the initial locals and this, so the method entry
+        # is a predecessor of the first block like any other edge (a loop header at the first
+        # instruction gets its phis)
+        self.entry = Block(0, 0)
+        link(self.entry, self.blocks[0])
+        self.order = reverse_postorder(self.entry)
+        compute_dominators(self.order)
+        compute_frontiers(self.order)
+
+    def run_block(self, block, econtext, stack, locals_):
+        econtext.stack = JVMStack(self.method.max_stack)
+        econtext.stack.stack = stack
+        econtext.vararr = JVMVarArray(0)
+        econtext.vararr.vararr = locals_
+        for inst in self.instructions[block.start:block.end]:
+            inst.emulator.Emulate(inst, econtext)
+        return econtext.stack.stack, econtext.vararr.vararr
+
+    def FindDefinitions(self):
+        # dry run of every block on placeholder values: which slots does it (re)define,
+        # and how high is the stack at its entry
+        counter = [0]
+        def new_var():
+            counter[0] += 1
+            return counter[0]
+        econtext = EmulationContext([], self.instructions, None, None, ScopedMethodsDB(), new_var)
+        econtext.cfg = True
+        nlocals = self.nlocals
+        local_marks = array("q", range(-1, -nlocals - 1, -1))
+        level, tracing.level = tracing.level, tracing.OFF # the dry run isn't traced
+        try:
+            self.dry_run(econtext, local_marks)
+        finally:
+            tracing.level = level
+        for block in self.order:
+            block.exit_stack = None
+            block.exit_wide = None
+
+    def dry_run(self, econtext, local_marks):
+        nlocals = self.nlocals
+        for block in self.order:
+            if block.handler:
+                block.entry_height = 1
+            elif block.rpo > 0:
+                # the DFS parent comes earlier in RPO, so some predecessor has run already
+                block.entry_height = next(len(p.exit_stack) for p in block.preds if p.exit_stack is not None)
+            stack_marks = [-(nlocals + p + 1) for p in range(block.entry_height)]
+            # a placeholder is a long/double if the value it stands for is: the real run starts
+            # from the exit of the immediate dominator, so its categories are carried over
+            econtext.wide = set()
+            if block.rpo > 0:
+                wide_stack, wide_locals = block.idom.exit_wide
+                if not block.handler:
+                    econtext.wide.update(stack_marks[p] for p in wide_stack if p < block.entry_height)
+                econtext.wide.update(local_marks[i] for i in wide_locals)
+            stack, locals_ = self.run_block(block, econtext, stack_marks, local_marks[:])
+            block.local_defs = [i for i in range(nlocals) if locals_[i] != local_marks[i]]
+            block.stack_defs = [p for p, v in enumerate(stack) if v != -(nlocals + p + 1)]
+            block.exit_stack = stack
+            block.exit_wide = ([p for p, v in enumerate(stack) if v in econtext.wide], [i for i, v in enumerate(locals_) if v in econtext.wide])
+
+    def PlacePhis(self):
+        entry = self.order[0]
+        local_sites = {}
+        stack_sites = {}
+        for block in self.order:
+            for i in block.local_defs:
+                local_sites.setdefault(i, [entry]).append(block)
+            for p in block.stack_defs:
+                stack_sites.setdefault(p, [entry]).append(block)
+        for i, sites in sorted(local_sites.items()):
+            for b in iterated_frontier(sites):
+                b.phis.append(["L", i, None])
+        for p, sites in sorted(stack_sites.items()):
+            for b in iterated_frontier(sites):
+                if not b.handler and p < b.entry_height:
+                    b.phis.append(["S", p, None])
+
+    def Run(self, ssaout, methods_db, new_var, this_var):
+        self.FindDefinitions()
+        self.PlacePhis()
+        econtext = EmulationContext(None, self.instructions, None, None, methods_db, new_var)
+        econtext.cfg = True
+        phi_vars = {}
+        for block in self.order:
+            if block.rpo == 0:
+                locals_ = array("q", bytes(8 * self.nlocals))
+                locals_[0] = this_var
+                stack = []
+            else:
+                idom = block.idom
+                locals_ = idom.exit_locals[:]
+                stack = list(idom.exit_stack[:block.entry_height])
+            if block.handler:
+                stack = [new_var()] # thrown exception
+            while len(stack) < block.entry_height:
+                stack.append(new_var())
+            for phi in block.phis:
+                kind, slot, _ = phi
+                phi[2] = var = new_var()
+                phi_vars[var] = (block, kind, slot)
+                values = locals_ if kind == "L" else stack
+                if values[slot] in econtext.wide:
+                    econtext.wide.add(var)
+                values[slot] = var
+            if tracing.level >= tracing.DEBUG and block is not self.entry:
+                tracing.emit("block", start=self.instructions[block.start].pc, preds=[self.instructions[p.start].pc for p in block.preds if p is not self.entry], phis=len(block.phis))
+            econtext.ssaout = block.out
+            block.exit_stack, block.exit_locals = self.run_block(block, econtext, stack, locals_)
+            if metrics.enabled:
+                metrics.count_instructions(self.instructions[block.start:block.end])
+            if block is self.entry:
+                continue
+            last = self.instructions[block.end - 1]
+            if last.opcode in RETURNS and len(block.exit_stack) != 0:
+                raise ValueError("Stack is not empty after emulation")
+        self.Assemble(ssaout, methods_db, phi_vars)
+
+    def Assemble(self, ssaout, methods_db, phi_vars):
+        operands = {}
+        for var, (block, kind, slot) in phi_vars.items():
+            values = []
+            for p in block.preds:
+                if p.exit_locals is None:
+                    continue
+                if kind == "L":
+                    values.append(p.exit_locals[slot] if slot < len(p.exit_locals) else None)
+                else:
+                    values.append(p.exit_stack[slot] if slot < len(p.exit_stack) else None)
+            operands[var] = values
+
+        replaced = {}
+        def find(v):
+            root = v
+            while root in replaced:
+                root = replaced[root]
+            while v in replaced and replaced[v] != root:
+                replaced[v], v = root, replaced[v]
+            return root
+
+        # drop phis that merge a single value, repeat until nothing changes
+        live = set(operands)
+        changed = True
+        while changed:
+            changed = False
+            for var in list(live):
+                distinct = set(find(v) for v in operands[var] if v not in (None, NO_VAR)) - {var}
+                if len(distinct) == 1:
+                    replaced[var] = distinct.pop()
+                    live.discard(var)
+                    changed = True
+                elif len(distinct) == 0:
+                    live.discard(var)
+                    changed = True
+
+        func = None
+        for block in self.blocks:
+            if block.rpo is None:
+                continue
+            for _, _, var in block.phis:
+                if var not in live:
+                    continue
+                if func is None:
+                    func = methods_db.Intern(PHI_METHOD)
+                args = []
+                for v in operands[var]:
+                    if v not in (None, NO_VAR) and find(v) not in args:
+                        args.append(find(v))
+                ssaout.append([var, func, args])
+            for target, function, args in block.out:
+                ssaout.append([None if target is None else find(target), function, [find(a) for a in args]])
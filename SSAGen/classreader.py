@@ -0,0 +1,431 @@
+import struct
+from argparsers import *
+from mnemonics import MNEMONICS
+
+OPCODES = {v: k for k, v in MNEMONICS.items()}
+
+CONSTANT_UTF8 = 1
+CONSTANT_INTEGER = 3
+CONSTANT_FLOAT = 4
+CONSTANT_LONG = 5
+CONSTANT_DOUBLE = 6
+CONSTANT_CLASS = 7
+CONSTANT_STRING = 8
+CONSTANT_FIELDREF = 9
+CONSTANT_METHODREF = 10
+CONSTANT_INTERFACE_METHODREF = 11
+CONSTANT_NAME_AND_TYPE = 12
+CONSTANT_METHOD_HANDLE = 15
+CONSTANT_METHOD_TYPE = 16
+CONSTANT_DYNAMIC = 17
+CONSTANT_INVOKE_DYNAMIC = 18
+CONSTANT_MODULE = 19
+CONSTANT_PACKAGE = 20
+
+# constant pool entry layouts (struct format of the entry body)
+CP_LAYOUT = {
+    CONSTANT_INTEGER: ">i",
+    CONSTANT_FLOAT: ">f",
+    CONSTANT_LONG: ">q",
+    CONSTANT_DOUBLE: ">d",
+    CONSTANT_CLASS: ">H",
+    CONSTANT_STRING: ">H",
+    CONSTANT_FIELDREF: ">HH",
+    CONSTANT_METHODREF: ">HH",
+    CONSTANT_INTERFACE_METHODREF: ">HH",
+    CONSTANT_NAME_AND_TYPE: ">HH",
+    CONSTANT_METHOD_HANDLE: ">BH",
+    CONSTANT_METHOD_TYPE: ">H",
+    CONSTANT_DYNAMIC: ">HH",
+    CONSTANT_INVOKE_DYNAMIC: ">HH",
+    CONSTANT_MODULE: ">H",
+    CONSTANT_PACKAGE: ">H",
+}
+
+BASE_TYPES = {
+    "B": "byte", "C": "char", "D": "double", "F": "float",
+    "I": "int", "J": "long", "S": "short", "Z": "boolean", "V": "void"
+}
+
+NEWARRAY_TYPES = {4: "boolean", 5: "char", 6: "float", 7: "double", 8: "byte", 9: "short", 10: "int", 11: "long"}
+
+# opcodes grouped by operand layout
+LOCAL_INDEX_OPS = set(range(21, 26)) | set(range(54, 59)) | {169}
+BRANCH_OPS = set(range(153, 169)) | {198, 199}
+WIDE_BRANCH_OPS = {200, 201}
+FIELD_OPS = {178, 179, 180, 181}
+METHOD_OPS = {182, 183, 184, 185}
+CLASS_OPS = {187, 189, 192, 193}
+
+# operand sizes of fixed-length instructions (switches and wide are handled separately)
+OPERAND_SIZES = dict.fromkeys(range(0, 202), 0)
+OPERAND_SIZES.update(dict.fromkeys(LOCAL_INDEX_OPS | {16, 18, 188}, 1))
+OPERAND_SIZES.update(dict.fromkeys(BRANCH_OPS | FIELD_OPS | CLASS_OPS | {17, 19, 20, 132, 182, 183, 184}, 2))
+OPERAND_SIZES.update({197: 3, 185: 4, 186: 4, 200: 4, 201: 4})
+CP_U2_OPS = {19, 20, 186, 197} | FIELD_OPS | METHOD_OPS | CLASS_OPS
+
+
+class ClassFormatError(ValueError):
+    pass
+
+# what reading past the end or following a bad constant pool index raises
+MALFORMED = (struct.error, IndexError, TypeError, ValueError)
+
+
+def java_class_name(internal):
+    if internal.startswith("["):
+        return parse_field_type(internal, 0)[0]
+    return internal.replace("/", ".")
+
+
+def parse_field_type(desc, pos):
+    dims = 0
+    while desc[pos] == "[":
+        dims += 1
+        pos += 1
+    c = desc[pos]
+    if c == "L":
+        end = desc.index(";", pos)
+        name = desc[pos + 1:end].replace("/", ".")
+        pos = end + 1
+    elif c in BASE_TYPES:
+        name = BASE_TYPES[c]
+        pos += 1
+    else:
+        raise ClassFormatError(f"Bad descriptor: {desc}")
+    return name + "[]" * dims, pos
+
+
+def parse_method_descriptor(desc):
+    if not desc.startswith("("):
+        raise ClassFormatError(f"Bad method descriptor: {desc}")
+    args = []
+    pos = 1
+    while desc[pos] != ")":
+        t, pos = parse_field_type(desc, pos)
+        args.append(t)
+    rettype, _ = parse_field_type(desc, pos + 1)
+    return rettype, args
+
+
+def decode_utf8(raw):
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        # modified UTF-8: NUL is encoded as C0 80, supplementary chars as surrogate pairs
+        text = bytes(raw).replace(b"\xc0\x80", b"\x00").decode("utf-8", errors="surrogatepass")
+        return text.encode("utf-16", "surrogatepass").decode("utf-16")
+
+
+class ConstantPool(object):
+    def __init__(self, data, offset):
+        count = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+        self.entries = [None] * count
+        i = 1
+        while i < count:
+            tag = data[offset]
+            offset += 1
+            if tag == CONSTANT_UTF8:
+                length = struct.unpack_from(">H", data, offset)[0]
+                offset += 2
+                self.entries[i] = (tag, decode_utf8(data[offset:offset + length]))
+                offset += length
+            elif tag in CP_LAYOUT:
+                layout = CP_LAYOUT[tag]
+                self.entries[i] = (tag,) + struct.unpack_from(layout, data, offset)
+                offset += struct.calcsize(layout)
+            else:
+                raise ClassFormatError(f"Unknown constant pool tag {tag} at index {i}")
+            i += 2 if tag in (CONSTANT_LONG, CONSTANT_DOUBLE) else 1
+        self.end = offset
+
+    def tag(self, index):
+        return self.entries[index][0]
+
+    def utf8(self, index):
+        entry = self.entries[index]
+        if entry[0] != CONSTANT_UTF8:
+            raise ClassFormatError(f"Constant pool entry {index} is not Utf8")
+        return entry[1]
+
+    def class_name(self, index):
+        return java_class_name(self.utf8(self.entries[index][1]))
+
+    def name_and_type(self, index):
+        _, name, desc = self.entries[index]
+        return self.utf8(name), self.utf8(desc)
+
+    def member_ref(self, index):
+        _, cls, nat = self.entries[index]
+        name, desc = self.name_and_type(nat)
+        return self.class_name(cls), name, desc
+
+    def describe(self, index):
+        # a class-independent description of an entry, used for cache keys
+        entry = self.entries[index]
+        tag = entry[0]
+        if tag in (CONSTANT_FIELDREF, CONSTANT_METHODREF, CONSTANT_INTERFACE_METHODREF):
+            return f"{tag}:" + " ".join(self.member_ref(index))
+        if tag in (CONSTANT_INVOKE_DYNAMIC, CONSTANT_DYNAMIC):
+            return f"{tag}:" + " ".join(self.name_and_type(entry[2]))
+        return f"{tag}:{self.constant_text(index)}"
+
+    def constant_text(self, index):
+        entry = self.entries[index]
+        tag = entry[0]
+        if tag == CONSTANT_STRING:
+            return '"' + self.utf8(entry[1]) + '"'
+        if tag == CONSTANT_CLASS:
+            return self.class_name(index)
+        if tag == CONSTANT_METHOD_TYPE:
+            return self.utf8(entry[1])
+        if tag in (CONSTANT_DYNAMIC, CONSTANT_METHOD_HANDLE):
+            return f"#{index}"
+        return str(entry[1])
+
+
+class MethodInfo(object):
+    def __init__(self, cp, access_flags, name, descriptor):
+        self.cp = cp
+        self.access_flags = access_flags
+        self.name = name
+        self.descriptor = descriptor
+        self.max_stack = 0
+        self.max_locals = 0
+        self.code = None
+        self.exception_table = []
+
+    def ParseCode(self, data, offset):
+        self.max_stack, self.max_locals, code_length = struct.unpack_from(">HHI", data, offset)
+        offset += 8
+        self.code = bytes(data[offset:offset + code_length])
+        offset += code_length
+        count = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+        for _ in range(count):
+            start, end, handler, catch_type = struct.unpack_from(">HHHH", data, offset)
+            offset += 8
+            catch = self.cp.class_name(catch_type) if catch_type != 0 else None
+            self.exception_table.append((start, end, handler, catch))
+
+    def Decode(self):
+        if self.code is None:
+            return []
+        try:
+            return decode_code(self.code, self.cp)
+        except ClassFormatError:
+            raise
+        except MALFORMED as e:
+            raise ClassFormatError(f"Truncated or malformed code of {self.name}: {e.__class__.__name__}: {e}") from e
+
+
+class ClassFile(object):
+    MAGIC = 0xCAFEBABE
+
+    def __init__(self, data):
+        self.data = data
+        self.methods = []
+        try:
+            self.Parse()
+        except ClassFormatError:
+            raise
+        except MALFORMED as e:
+            raise ClassFormatError(f"Truncated or malformed class: {e.__class__.__name__}: {e}") from e
+
+    @staticmethod
+    def Load(path):
+        with open(path, "rb") as fp:
+            return ClassFile(fp.read())
+
+    def Parse(self):
+        data = self.data
+        if len(data) < 10 or struct.unpack_from(">I", data, 0)[0] != ClassFile.MAGIC:
+            raise ClassFormatError("Not a class file")
+        self.minor_version, self.major_version = struct.unpack_from(">HH", data, 4)
+        self.cp = ConstantPool(data, 8)
+        offset = self.cp.end
+        self.access_flags, this_class, super_class, interfaces = struct.unpack_from(">HHHH", data, offset)
+        self.name = self.cp.class_name(this_class)
+        self.super_name = self.cp.class_name(super_class) if super_class != 0 else None
+        offset += 8 + 2 * interfaces
+        offset = self.skip_members(offset)
+        count = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+        for _ in range(count):
+            access, name, desc, attrs = struct.unpack_from(">HHHH", data, offset)
+            offset += 8
+            method = MethodInfo(self.cp, access, self.cp.utf8(name), self.cp.utf8(desc))
+            for _ in range(attrs):
+                attr_name, length = struct.unpack_from(">HI", data, offset)
+                offset += 6
+                if self.cp.utf8(attr_name) == "Code":
+                    method.ParseCode(data, offset)
+                offset += length
+            self.methods.append(method)
+
+    def skip_members(self, offset):
+        count = struct.unpack_from(">H", self.data, offset)[0]
+        offset += 2
+        for _ in range(count):
+            attrs = struct.unpack_from(">H", self.data, offset + 6)[0]
+            offset += 8
+            for _ in range(attrs):
+                length = struct.unpack_from(">I", self.data, offset + 2)[0]
+                offset += 6 + length
+        return offset
+
+    def MethodNames(self):
+        return [m.name for m in self.methods]
+
+    def GetMethods(self, name):
+        return [m for m in self.methods if m.name == name]
+
+
+def member_args(opcode, cp, index):
+    # build pre-filled argument objects with the same text OPAL renders
+    if opcode in FIELD_OPS:
+        cls, name, desc = cp.member_ref(index)
+        fieldtype, _ = parse_field_type(desc, 0)
+        raw = f"{cls} {{ {fieldtype} {name} }}"
+        args = GetStaticArgs(raw) if opcode == 178 else FieldArgs(raw)
+        args.Fill(cls, fieldtype, name)
+        return raw, args
+    cls, name, desc = cp.member_ref(index)
+    rettype, argtypes = parse_method_descriptor(desc)
+    kind = "interface" if cp.tag(index) == CONSTANT_INTERFACE_METHODREF else "class"
+    raw = f"{kind} {cls} {{ {rettype} {name} ({', '.join(argtypes)}) }}"
+    argsclass = {182: InvokeVirtualArgs, 183: InvokeSpecialArgs, 184: InvokeStaticArgs, 185: InvokeInterfaceArgs}.get(opcode)
+    if argsclass is None:
+        return raw, None
+    args = argsclass(raw)
+    args.Fill(cls, rettype, name, argtypes)
+    return raw, args
+
+
+def invokedynamic_args(cp, index):
+    _, _, nat = cp.entries[index]
+    name, desc = cp.name_and_type(nat)
+    rettype, argtypes = parse_method_descriptor(desc)
+    raw = f"{rettype} {name} ({', '.join(argtypes)})"
+    args = InvokeDynamicArgs(raw)
+    args.Fill(rettype, name, argtypes)
+    return raw, args
+
+
+def constant_refs(code):
+    # constant pool indexes referenced by the code, without decoding the instructions
+    refs = []
+    pc = 0
+    length = len(code)
+    while pc < length:
+        start = pc
+        opcode = code[pc]
+        pc += 1
+        if opcode == 196:
+            pc += 5 if code[pc] == 132 else 3
+        elif opcode == 170:
+            pc += (4 - pc % 4) % 4
+            low, high = struct.unpack_from(">ii", code, pc + 4)
+            pc += 12 + 4 * (high - low + 1)
+        elif opcode == 171:
+            pc += (4 - pc % 4) % 4
+            pc += 8 + 8 * struct.unpack_from(">i", code, pc + 4)[0]
+        else:
+            if opcode == 18:
+                refs.append(code[pc])
+            elif opcode in CP_U2_OPS:
+                refs.append(struct.unpack_from(">H", code, pc)[0])
+            if opcode not in OPERAND_SIZES:
+                raise ClassFormatError(f"Unknown opcode {opcode} at pc {start}")
+            pc += OPERAND_SIZES[opcode]
+    return refs
+
+
+def decode_code(code, cp):
+    # returns (pc, mnemonic, rawargs, args) records; args is None when the raw text has to be parsed
+    result = []
+    members = {} # (opcode, cp index) -> (raw, args), in front of the per-process ARGS_CACHE
+    pc = 0
+    length = len(code)
+    while pc < length:
+        start = pc
+        opcode = code[pc]
+        pc += 1
+        wide = False
+        if opcode == 196: # wide prefix modifies the next instruction
+            wide = True
+            opcode = code[pc]
+            pc += 1
+        if opcode not in OPCODES:
+            raise ClassFormatError(f"Unknown opcode {opcode} at pc {start}")
+        raw = None
+        args = None
+        if opcode in LOCAL_INDEX_OPS:
+            if wide:
+                raw = str(struct.unpack_from(">H", code, pc)[0])
+                pc += 2
+            else:
+                raw = str(code[pc])
+                pc += 1
+        elif opcode == 132: # iinc
+            if wide:
+                index, const = struct.unpack_from(">Hh", code, pc)
+                pc += 4
+            else:
+                index, const = struct.unpack_from(">Bb", code, pc)
+                pc += 2
+            raw = f"{index} {const}"
+        elif opcode == 16: # bipush
+            raw = str(struct.unpack_from(">b", code, pc)[0])
+            pc += 1
+        elif opcode == 17: # sipush
+            raw = str(struct.unpack_from(">h", code, pc)[0])
+            pc += 2
+        elif opcode == 18: # ldc
+            raw = cp.constant_text(code[pc])
+            pc += 1
+        elif opcode in (19, 20): # ldc_w, ldc2_w
+            raw = cp.constant_text(struct.unpack_from(">H", code, pc)[0])
+            pc += 2
+        elif opcode in BRANCH_OPS:
+            raw = str(start + struct.unpack_from(">h", code, pc)[0])
+            pc += 2
+        elif opcode in WIDE_BRANCH_OPS:
+            raw = str(start + struct.unpack_from(">i", code, pc)[0])
+            pc += 4
+        elif opcode == 170: # tableswitch
+            pc += (4 - pc % 4) % 4
+            default, low, high = struct.unpack_from(">iii", code, pc)
+            pc += 12
+            offsets = struct.unpack_from(f">{high - low + 1}i", code, pc)
+            pc += 4 * (high - low + 1)
+            cases = [f"{low + i}: {start + o}" for i, o in enumerate(offsets)]
+            raw = ", ".join(cases + [f"default: {start + default}"])
+        elif opcode == 171: # lookupswitch
+            pc += (4 - pc % 4) % 4
+            default, npairs = struct.unpack_from(">ii", code, pc)
+            pc += 8
+            pairs = struct.unpack_from(f">{2 * npairs}i", code, pc)
+            pc += 8 * npairs
+            cases = [f"{pairs[i]}: {start + pairs[i + 1]}" for i in range(0, len(pairs), 2)]
+            raw = ", ".join(cases + [f"default: {start + default}"])
+        elif opcode in FIELD_OPS or opcode in METHOD_OPS or opcode == 186:
+            key = (opcode, struct.unpack_from(">H", code, pc)[0])
+            if key not in members:
+                build = (lambda: invokedynamic_args(cp, key[1])) if opcode == 186 else (lambda: member_args(opcode, cp, key[1]))
+                members[key] = ARGS_CACHE.Get((opcode, cp.describe(key[1])), build)
+            raw, args = members[key]
+            pc += 4 if opcode in (185, 186) else 2
+        elif opcode in CLASS_OPS:
+            raw = cp.class_name(struct.unpack_from(">H", code, pc)[0])
+            pc += 2
+        elif opcode == 188: # newarray
+            raw = NEWARRAY_TYPES.get(code[pc], str(code[pc]))
+            pc += 1
+        elif opcode == 197: # multianewarray
+            index, dims = struct.unpack_from(">HB", code, pc)
+            raw = f"{cp.class_name(index)} {dims}"
+            pc += 3
+        result.append((start, OPCODES[opcode], raw, args))
+    return result
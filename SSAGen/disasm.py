@@ -0,0 +1,101 @@
+import os
+import queue
+import threading
+import atexit
+from subprocess import Popen, PIPE, call
+
+OPAL_JAR = "OPALDisassembler.jar"
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opal")
+SERVER_CLASS = "DisassemblerServer"
+BUILD_CMD = "javac__SEP__-cp__SEP__{jar}__SEP__-d__SEP__{dir}__SEP__{src}"
+SERVER_CMD = "java__SEP__-cp__SEP__{classpath}__SEP__{cls}__SEP__{jar}"
+
+class DisassemblerError(Exception):
+    pass
+
+def ensure_server_built(jar=OPAL_JAR):
+    if os.path.isfile(os.path.join(SERVER_DIR, f"{SERVER_CLASS}.class")):
+        return
+    src = os.path.join(SERVER_DIR, f"{SERVER_CLASS}.java")
+    cmd = BUILD_CMD.format(jar=jar, dir=SERVER_DIR, src=src).split("__SEP__")
+    if call(cmd) != 0:
+        raise DisassemblerError(f"Couldn't build {src}")
+
+class OpalWorker(object):
+    def __init__(self, jar=OPAL_JAR):
+        self.jar = jar
+        self.process = None
+
+    def Start(self):
+        ensure_server_built(self.jar)
+        classpath = os.pathsep.join([self.jar, SERVER_DIR])
+        cmd = SERVER_CMD.format(classpath=classpath, cls=SERVER_CLASS, jar=self.jar).split("__SEP__")
+        self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True, bufsize=1)
+
+    def Disassemble(self, src, output):
+        if self.process is None or self.process.poll() is not None:
+            self.Start()
+        try:
+            self.process.stdin.write(f"{os.path.abspath(src)}\t{os.path.abspath(output)}\n")
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline().strip()
+        except (BrokenPipeError, OSError) as e:
+            self.Stop()
+            raise DisassemblerError(f"Disassembler server died: {e}")
+        except BaseException:
+            # interrupted (a class timeout): the reply would be read for the next request
+            self.Kill()
+            raise
+        if reply == "":
+            self.Stop()
+            raise DisassemblerError("Disassembler server closed the connection")
+        if reply != "OK":
+            raise DisassemblerError(reply[4:] if reply.startswith("ERR ") else reply)
+
+    def Kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def Stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+        self.process = None
+
+class OpalPool(object):
+    def __init__(self, size=1, jar=OPAL_JAR):
+        self.workers = [OpalWorker(jar) for _ in range(size)]
+        self.idle = queue.Queue()
+        for w in self.workers:
+            self.idle.put(w)
+
+    def Disassemble(self, src, output):
+        worker = self.idle.get()
+        try:
+            worker.Disassemble(src, output)
+        finally:
+            self.idle.put(worker)
+
+    def Close(self):
+        for w in self.workers:
+            w.Stop()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.Close()
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_pool(size=1, jar=OPAL_JAR):
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = OpalPool(size, jar)
+            atexit.register(_default_pool.Close)
+        return _default_pool
@@ -1,10 +1,23 @@
+import sys
 from abc import ABC, abstractmethod
+from array import array
+import tracing
+
+# bump whenever emulation changes the produced SSA, cached SSA of older versions is ignored
+EMULATOR_VERSION = 2
+
+WIDE_TYPES = ("long", "double")
+NO_VAR = 0 # vars are numbered from 1
 
 class JVMStack(object):
-    def __init__(self):
+    def __init__(self, size=None):
+        # size is the method's max_stack; values are one entry each, so it is never exceeded by valid code
         self.stack = []
+        self.size = size if size is not None else sys.maxsize
         
     def push(self, var):
+        if len(self.stack) >= self.size:
+            raise EmulationError(f"Stack overflow")
         self.stack.append(var)
         
     def pop(self):
@@ -21,31 +34,29 @@ class JVMStack(object):
 
 class JVMVarArray(object):
     def __init__(self, size):
-        self.vararr = [None] * size
-        self.max_written = 0
+        # sized from max_locals, NO_VAR marks slots that weren't written yet
+        self.vararr = array("q", bytes(8 * size))
         
     def __getitem__(self, key):
         try:
             var = self.vararr[key]
         except IndexError:
             raise EmulationError(f"Not enough VARARR space")
-        if var is None:
+        if var == NO_VAR:
             raise EmulationError(f"Accessing not initialized cell of VARARR")
         return var
             
     def __setitem__(self, key, value):
-        if key > self.max_written:
-            self.max_written = key
         try:
             self.vararr[key] = value
         except IndexError:
             raise EmulationError(f"Not enough VARARR space")
             
     def __str__(self):
-        vararrelems = ["NOVAR" if e is None else f"V{e}" for e in self.vararr[:self.max_written + 1]]
+        vararrelems = ["NOVAR" if e == NO_VAR else f"V{e}" for e in self.vararr]
         return str(vararrelems)
     def __repr__(self):
-        vararrelems = ["NOVAR" if e is None else f"V{e}" for e in self.vararr[:self.max_written + 1]]
+        vararrelems = ["NOVAR" if e == NO_VAR else f"V{e}" for e in self.vararr]
         return str(vararrelems)
         
 class EmulationContext(object):
@@ -56,10 +67,18 @@ class EmulationContext(object):
         self.methods_db = methods_db
         self.get_new_var = newVarGetter
         self.ssaout = ssaout
+        self.cfg = False # handlers get the thrown exception from the CFG emulator
+        self.wide = set() # long/double vars, pop2/dup2 move them as two words
         
     def get_new_var(self):
         return self.get_new_var()
         
+    def lookup_method(self, method):
+        # JDK methods are added to the db, the rest resolve to the next free index
+        if method.startswith("java."):
+            return self.methods_db.Intern(method)
+        return self.methods_db.Resolve(method)
+        
     def add_ssaout_inst(self, target, function, args):
         self.ssaout.append([target, function, args])
 
@@ -73,28 +92,25 @@ class InstEmulator(ABC):
 
 class DefaultInstEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
+        pass
         
 class AconstNullEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         retvar = econtext.get_new_var()
         econtext.stack.push(retvar)
-        method = "special.aconstnull"
-        if method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
-        func = econtext.methods_db[method]
+        func = econtext.methods_db.Intern("special.aconstnull")
         econtext.add_ssaout_inst(retvar, func, [])
             
 class LoadConstEmulator(InstEmulator):
+    def __init__(self, category=1):
+        self.category = category
+        
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         retvar = econtext.get_new_var()
+        if self.category == 2:
+            econtext.wide.add(retvar)
         econtext.stack.push(retvar)
-        method = "special.loadconst"
-        if method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
-        func = econtext.methods_db[method]
+        func = econtext.methods_db.Intern("special.loadconst")
         econtext.add_ssaout_inst(retvar, func, [])
         
 class AloadEmulator(InstEmulator):
@@ -102,7 +118,6 @@ class AloadEmulator(InstEmulator):
         self.index = index
         
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         index = self.index if self.index is not None else int(inst.args.raw)
         var = econtext.vararr[index]
         econtext.stack.push(var)
@@ -112,48 +127,46 @@ class AstoreEmulator(InstEmulator):
         self.index = index
         
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         var = econtext.stack.pop()
         index = self.index if self.index is not None else int(inst.args.raw)
         econtext.vararr[index] = var
         
 class PopEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         econtext.stack.pop()
         
 class DupEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         var = econtext.stack.pop()
         econtext.stack.push(var)
         econtext.stack.push(var)
         
 class IfIntCmpEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         econtext.stack.pop()
         
 class GotoEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
-        pos = econtext.instructions.index(inst)
+        pos = inst.index
         previousInst = econtext.instructions[pos - 1]
-        if previousInst.opcode == 182: # if it was invokevirtual
-            econtext.stack.push(econtext.get_new_var()) # push thrown exception on stack
-            print(f"Pushed exception object on stack")
+        if not econtext.cfg and previousInst.opcode == 182: # if it was invokevirtual
+            var = econtext.get_new_var()
+            econtext.stack.push(var) # push thrown exception on stack
+            if tracing.level >= tracing.DEBUG:
+                tracing.emit("exception", pc=inst.pc, var=var)
             
 class GetStaticEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
-        econtext.stack.push(econtext.get_new_var())
+        var = econtext.get_new_var()
+        if inst.args.stattype in WIDE_TYPES:
+            econtext.wide.add(var)
+        econtext.stack.push(var)
         method = inst.args.name
-        if method.startswith("java.") and method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
+        if method.startswith("java."):
+            econtext.methods_db.Intern(method)
         
 class InvokeVirtualEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         argc = len(inst.args.args)
         argv = [econtext.stack.pop() for _ in range(argc)]
         argv.reverse()
@@ -161,54 +174,53 @@ class InvokeVirtualEmulator(InstEmulator):
         retvar = None
         if inst.args.rettype != 'void':
             retvar = econtext.get_new_var()
+            if inst.args.rettype in WIDE_TYPES:
+                econtext.wide.add(retvar)
             econtext.stack.push(retvar)
         method = inst.args.methodfull
-        if method.startswith("java.") and method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
-        func = econtext.methods_db[method] if method in econtext.methods_db else len(econtext.methods_db) + 1
+        func = econtext.lookup_method(method)
         econtext.add_ssaout_inst(retvar, func, argv)
-        print(f"Calling: {inst.args.rettype} {inst.args.method} (this=V{obj}, {', '.join([f'V{v}' for v in argv])})")
+        if tracing.level >= tracing.DEBUG:
+            tracing.emit("call", pc=inst.pc, method=method, this=obj, args=argv, ret=retvar)
 
 class InvokeSpecialEmulator(InvokeVirtualEmulator):
     pass
     
+class InvokeInterfaceEmulator(InvokeVirtualEmulator):
+    pass
+    
 class InvokeStaticEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         argc = len(inst.args.args)
         argv = [econtext.stack.pop() for _ in range(argc)]
         argv.reverse()
         retvar = None
         if inst.args.rettype != 'void':
             retvar = econtext.get_new_var()
+            if inst.args.rettype in WIDE_TYPES:
+                econtext.wide.add(retvar)
             econtext.stack.push(retvar)
         method = inst.args.methodfull
-        if method.startswith("java.") and method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
-        func = econtext.methods_db[method] if method in econtext.methods_db else len(econtext.methods_db) + 1
+        func = econtext.lookup_method(method)
         econtext.add_ssaout_inst(retvar, func, argv)
-        print(f"Calling: {inst.args.rettype} {inst.args.method} ({', '.join([f'V{v}' for v in argv])})")
+        if tracing.level >= tracing.DEBUG:
+            tracing.emit("call", pc=inst.pc, method=method, args=argv, ret=retvar)
         
 class InvokeDynamicEmulator(InvokeStaticEmulator):
     pass
     
 class NewEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         retvar = econtext.get_new_var()
         econtext.stack.push(retvar)
         method = inst.args.raw.strip()
-        if method.startswith("java.") and method not in econtext.methods_db:
-            econtext.methods_db[method] = len(econtext.methods_db) + 1
-        func = econtext.methods_db[method] if method in econtext.methods_db else len(econtext.methods_db) + 1
+        func = econtext.lookup_method(method)
         econtext.add_ssaout_inst(retvar, func, [])
     
 class AthrowEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         econtext.stack.pop()
         
 class IfnullEmulator(InstEmulator):
     def Emulate(self, inst, econtext):
-        print(f"Emulating. {inst}")
         econtext.stack.pop()
\ No newline at end of file
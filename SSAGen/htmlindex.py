@@ -0,0 +1,152 @@
+from html.parser import HTMLParser
+from xml.etree.ElementTree import TreeBuilder
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+def has_class(attrs, name):
+    return name in (attrs.get("class") or "").split()
+
+class MethodIndexer(HTMLParser):
+    # one pass over the disassembly: method name -> spans of its bytecode tables
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+        self.line_starts = [0]
+        pos = text.find("\n")
+        while pos != -1:
+            self.line_starts.append(pos + 1)
+            pos = text.find("\n", pos + 1)
+        self.methods = []
+        self.method = None
+        self.details_depth = 0
+        self.table_start = None
+        self.table_depth = 0
+
+    def position(self):
+        line, col = self.getpos()
+        return self.line_starts[line - 1] + col
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "details":
+            self.details_depth += 1
+            attrs = dict(attrs)
+            if self.method is None and has_class(attrs, "method") and "data-name" in attrs:
+                self.method = (attrs["data-name"], self.details_depth, [])
+        elif tag == "table" and self.method is not None:
+            if self.table_start is not None:
+                self.table_depth += 1
+            elif has_class(dict(attrs), "method_bytecode"):
+                self.table_start = self.position()
+                self.table_depth = 0
+
+    def handle_endtag(self, tag):
+        if tag == "details":
+            if self.method is not None and self.method[1] == self.details_depth:
+                self.methods.append((self.method[0], self.method[2]))
+                self.method = None
+            self.details_depth -= 1
+        elif tag == "table" and self.table_start is not None:
+            if self.table_depth > 0:
+                self.table_depth -= 1
+                return
+            end = self.text.index(">", self.position()) + 1
+            self.method[2].append((self.table_start, end))
+            self.table_start = None
+
+class ElementBuilder(HTMLParser):
+    # builds a small ElementTree for one table, closing unbalanced tags like html.parser soup does
+    def __init__(self):
+        super().__init__()
+        self.builder = TreeBuilder()
+        self.builder.start("root", {})
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        self.builder.start(tag, {k: v or "" for k, v in attrs})
+        if tag in VOID_TAGS:
+            self.builder.end(tag)
+        else:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.builder.start(tag, {k: v or "" for k, v in attrs})
+        self.builder.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        while self.open_tags:
+            last = self.open_tags.pop()
+            self.builder.end(last)
+            if last == tag:
+                break
+
+    def handle_data(self, data):
+        self.builder.data(data)
+
+    def Build(self, text):
+        self.feed(text)
+        self.close()
+        while self.open_tags:
+            self.builder.end(self.open_tags.pop())
+        self.builder.end("root")
+        return self.builder.close()
+
+def element_text(element):
+    return "".join(element.itertext())
+
+def parse_row(row):
+    # same lookup as the BeautifulSoup version: pc column, instruction span, its args
+    columns = list(row.iter("td"))
+    pc = int(element_text(columns[0]))
+    instruction_info = None
+    opcodes = []
+    for parent in columns[2].iter():
+        for child in parent:
+            if child.tag == "span" and has_class(child.attrib, "instruction"):
+                opcodes.append(child)
+                instruction_info = parent
+    if len(opcodes) != 1:
+        raise ValueError("Couldn't find instruction opcode")
+    mnem = element_text(opcodes[0]).strip()
+    rawargs = None
+    children = [c for c in instruction_info if c.tag == "span"]
+    if len(children) == 2:
+        rawargs = element_text(children[1]).strip()
+    else: # goto support
+        children = [c for c in instruction_info if c.tag == "a"]
+        if len(children) == 1:
+            rawargs = element_text(children[0]).strip()
+    return pc, mnem, rawargs, instruction_info
+
+class HtmlIndex(object):
+    def __init__(self, text):
+        self.text = text
+        indexer = MethodIndexer(text)
+        indexer.feed(text)
+        indexer.close()
+        self.names = [name for name, _ in indexer.methods]
+        self.tables = {}
+        for name, spans in indexer.methods:
+            self.tables.setdefault(name, []).append(spans)
+
+    @staticmethod
+    def Load(path):
+        with open(path) as fp:
+            return HtmlIndex(fp.read())
+
+    def MethodNames(self):
+        return self.names
+
+    def Count(self, name):
+        return len(self.tables.get(name, []))
+
+    def Rows(self, name):
+        spans = self.tables[name][0]
+        if len(spans) != 1:
+            raise ValueError("No instruction table was found")
+        start, end = spans[0]
+        table = ElementBuilder().Build(self.text[start:end])
+        rows = list(table.iter("tr"))
+        rows.pop(0)
+        return [parse_row(row) for row in rows]
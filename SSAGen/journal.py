@@ -0,0 +1,114 @@
+import os, sys
+import time
+import sqlite3
+
+# Progress journal of a bulk run, so a run that died can be resumed instead of started over.
+#   classes:  name, status, error, attempts, seconds
+#   methods:  class, method, status, error
+#   settings: what the run was started with (a resume has to match)
+# Class status is "running" (a worker started it), "done", "failed" (class error, timeout or
+# failed methods) or "skipped" (nothing to convert); method status is "done", "failed" or
+# "skipped" (no single method of that name). Workers mark a class running and count the
+# attempt right away; final statuses are kept in memory by the parent and only committed
+# (Commit) after the SSA and the methods DB they refer to are on disk, together with the size of
+# the methods DB at that point: a resume drops what was interned after it, so the classes it
+# processes again see the methods DB they saw the first time. A class still running
+# when a run died is retried on resume, up to max_attempts starts, so a class that kills its
+# worker (OOM, crash) doesn't stop every resumed run.
+
+STATUSES = ("running", "done", "failed", "skipped")
+
+class Journal(object):
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS classes (name TEXT PRIMARY KEY, status TEXT NOT NULL, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, seconds REAL, updated REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS methods (class TEXT NOT NULL, method TEXT NOT NULL, status TEXT NOT NULL, error TEXT, PRIMARY KEY (class, method))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self.pending = []
+
+    def Reset(self, settings):
+        # a new run: previous progress is dropped
+        self.conn.execute("BEGIN IMMEDIATE")
+        for table in ("classes", "methods", "settings"):
+            self.conn.execute(f"DELETE FROM {table}")
+        self.conn.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in settings.items()])
+        self.conn.execute("COMMIT")
+
+    def Settings(self):
+        return dict(self.conn.execute("SELECT key, value FROM settings"))
+
+    def Mismatches(self, settings):
+        # the settings a resume would change, [(key, journal value, new value)]
+        old = self.Settings()
+        return [(k, old.get(k), str(v)) for k, v in settings.items() if old.get(k) != str(v)]
+
+    def Start(self, name):
+        self.conn.execute("INSERT INTO classes (name, status, attempts, updated) VALUES (?, 'running', 1, ?) "
+                          "ON CONFLICT (name) DO UPDATE SET status = 'running', attempts = attempts + 1, updated = excluded.updated", (name, time.time()))
+
+    def Record(self, name, status, error=None, seconds=None, methods=()):
+        # methods are (method, status, reason); kept until the next Commit
+        self.pending.append((name, status, error, seconds, list(methods)))
+
+    def Commit(self, methods_db_size=None):
+        if not self.pending and methods_db_size is None:
+            return
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        if methods_db_size is not None:
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('methods_db_size', ?)", (str(methods_db_size),))
+        for name, status, error, seconds, methods in self.pending:
+            self.conn.execute("INSERT INTO classes (name, status, error, seconds, updated) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT (name) DO UPDATE SET status = excluded.status, error = excluded.error, seconds = excluded.seconds, updated = excluded.updated",
+                              (name, status, error, seconds, now))
+            self.conn.execute("DELETE FROM methods WHERE class = ?", (name,))
+            self.conn.executemany("INSERT INTO methods (class, method, status, error) VALUES (?, ?, ?, ?)", [(name,) + tuple(m) for m in methods])
+        self.conn.execute("COMMIT")
+        self.pending = []
+
+    def MethodsDBSize(self):
+        # methods DB size at the last commit, None for journals without one
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'methods_db_size'").fetchone()
+        return int(row[0]) if row is not None else None
+
+    def Finished(self, retry_failed=False, max_attempts=2):
+        # names a resumed run doesn't process again
+        self.conn.execute("UPDATE classes SET status = 'failed', error = 'Worker died while processing it (' || attempts || ' attempts)' "
+                          "WHERE status = 'running' AND attempts >= ?", (max_attempts,))
+        statuses = ("done", "skipped") if retry_failed else ("done", "skipped", "failed")
+        return set(name for name, in self.conn.execute(f"SELECT name FROM classes WHERE status IN ({','.join('?' * len(statuses))})", statuses))
+
+    def Summary(self):
+        classes = dict(self.conn.execute("SELECT status, COUNT(*) FROM classes GROUP BY status"))
+        methods = dict(self.conn.execute("SELECT status, COUNT(*) FROM methods GROUP BY status"))
+        return classes, methods
+
+    def Failures(self):
+        # [(class, method or None, status, error)] of everything that didn't go through
+        rows = [(name, None, status, error) for name, status, error in self.conn.execute("SELECT name, status, error FROM classes WHERE status IN ('failed', 'running') ORDER BY name")]
+        rows += list(self.conn.execute("SELECT class, method, status, error FROM methods WHERE status != 'done' ORDER BY class, method"))
+        return rows
+
+    def Close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ("summary", "failures"):
+        print("Usage: .py summary <journal.sqlite>")
+        print("       .py failures <journal.sqlite>")
+        sys.exit(1)
+    if not os.path.isfile(sys.argv[2]):
+        print("[!] Invalid journal path.")
+        sys.exit(1)
+    journal = Journal(sys.argv[2])
+    if sys.argv[1] == "summary":
+        classes, methods = journal.Summary()
+        print("classes: " + ", ".join(f"{s} {classes.get(s, 0)}" for s in STATUSES))
+        print("methods: " + ", ".join(f"{s} {methods.get(s, 0)}" for s in STATUSES[1:]))
+    else:
+        for cls, method, status, error in journal.Failures():
+            print(f"{status}\t{cls}" + (f" {method}" if method is not None else "") + f"\t{error}")
+    journal.Close()
@@ -0,0 +1,243 @@
+import os, sys
+import json
+import sqlite3
+from contextlib import contextmanager
+
+class MethodsDB(dict):
+    # "method name" -> index mapping; unknown methods resolve to the next free index
+    path = None
+    saved = 0 # size at the last save, the db only grows
+
+    def Intern(self, method):
+        if method not in self:
+            self[method] = len(self) + 1
+        return self[method]
+
+    def Resolve(self, method):
+        return self[method] if method in self else len(self) + 1
+
+    @staticmethod
+    def Load(path):
+        with open(path, 'r') as fp:
+            db = MethodsDB(json.load(fp))
+        db.path = path
+        db.saved = len(db)
+        return db
+
+    def Save(self, path):
+        # replaced, not rewritten: a long-lived worker saves while it runs
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as fp:
+            json.dump(self, fp, indent=4)
+        os.replace(tmp, path)
+        self.saved = len(self)
+
+    def Flush(self):
+        if self.path is not None and len(self) != self.saved:
+            self.Save(self.path)
+
+    def Truncate(self, size):
+        for method in [m for m, index in self.items() if index > size]:
+            del self[method]
+
+    @contextmanager
+    def Batch(self):
+        yield self
+
+    def Close(self):
+        if self.path is not None:
+            self.Save(self.path)
+
+class SqliteMethodsDB(object):
+    # Append-only method store that several processes can intern into at the same time.
+    # Known names and the highest id are kept in memory; IDs stay dense (1..n) like MethodsDB.
+    # They are synced (the rows added since) when a write transaction starts and, outside of
+    # one, only when another connection committed (PRAGMA data_version), so lookups of unknown
+    # methods and len() don't query the table.
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS methods (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        self.in_batch = False
+        self.reload()
+
+    def reload(self):
+        self.ids = {}
+        self.count = 0
+        self.version = None
+        self.sync()
+
+    def sync(self):
+        # picks up what other processes added since we last looked
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.version:
+            return
+        self.version = version
+        for method, index in self.conn.execute("SELECT name, id FROM methods WHERE id > ? ORDER BY id", (self.count,)):
+            self.ids[method] = index
+            self.count = index
+
+    def Intern(self, method):
+        if method in self.ids:
+            return self.ids[method]
+        with self.Batch():
+            # another process may have added it before we got the write lock
+            if method in self.ids:
+                return self.ids[method]
+            self.count += 1
+            self.conn.execute("INSERT INTO methods (id, name) VALUES (?, ?)", (self.count, method))
+            self.ids[method] = self.count
+            return self.count
+
+    def Resolve(self, method):
+        if method not in self.ids and not self.in_batch:
+            self.sync()
+        return self.ids.get(method, self.count + 1)
+
+    @contextmanager
+    def Batch(self):
+        # one write transaction for many interns; BEGIN IMMEDIATE serializes allocating processes
+        if self.in_batch:
+            yield self
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.in_batch = True
+        self.sync()
+        try:
+            yield self
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            self.in_batch = False
+            self.reload()
+            raise
+        else:
+            self.conn.execute("COMMIT")
+        finally:
+            self.in_batch = False
+
+    def __len__(self):
+        if not self.in_batch:
+            self.sync()
+        return self.count
+
+    def __contains__(self, method):
+        if method not in self.ids and not self.in_batch:
+            self.sync()
+        return method in self.ids
+
+    def __getitem__(self, method):
+        if method not in self.ids and not self.in_batch:
+            self.sync()
+        return self.ids[method]
+
+    def Flush(self):
+        pass # every intern is committed
+
+    def Truncate(self, size):
+        # drops the names above id size (what a run interned after its last checkpoint)
+        with self.Batch():
+            self.conn.execute("DELETE FROM methods WHERE id > ?", (size,))
+        self.reload()
+
+    def items(self):
+        return list(self.conn.execute("SELECT name, id FROM methods ORDER BY id"))
+
+    def Import(self, methods):
+        with self.Batch():
+            for method, index in sorted(methods.items(), key=lambda e: e[1]):
+                self.conn.execute("INSERT OR IGNORE INTO methods (id, name) VALUES (?, ?)", (index, method))
+            self.ids = dict(self.conn.execute("SELECT name, id FROM methods"))
+            self.count = max(self.ids.values(), default=0)
+
+    def ExportJson(self, path):
+        # the format simple_lstm.py and older bparser runs use
+        with open(path, 'w') as fp:
+            json.dump(dict(self.items()), fp, indent=4)
+
+    def Close(self):
+        self.conn.close()
+
+class FrozenMethodsDB(object):
+    # The vocabulary of a trained model: lookups never add names, unknown methods (interned
+    # or not) get the wildcard index len(db) + 1 the model was trained with.
+    def __init__(self, methods_db):
+        self.methods_db = methods_db
+
+    def Intern(self, method):
+        return self.methods_db.Resolve(method)
+
+    def Resolve(self, method):
+        return self.methods_db.Resolve(method)
+
+    @contextmanager
+    def Batch(self):
+        yield self
+
+    def __len__(self):
+        return len(self.methods_db)
+
+    def Close(self):
+        pass
+
+def open_methods_db(path):
+    if path.endswith(".json"):
+        return MethodsDB.Load(path)
+    return SqliteMethodsDB(path)
+
+class ScopedMethodsDB(object):
+    # Records the lookups of one unit of work (a class) instead of assigning global IDs.
+    # The emitted IDs are 1-based positions in self.ops; replay() maps them to global IDs
+    # exactly as if the lookups had been done against the global db in that order.
+    INTERN = 0
+    RESOLVE = 1
+
+    def __init__(self):
+        self.ops = []
+        self.interned = {}
+        self.resolved = {}
+
+    def Intern(self, method):
+        if method not in self.interned:
+            self.ops.append((ScopedMethodsDB.INTERN, method))
+            self.interned[method] = len(self.ops)
+        return self.interned[method]
+
+    def Resolve(self, method):
+        if method in self.interned:
+            return self.interned[method]
+        # the result only depends on the global db size, i.e. on how many interns came before
+        key = (method, len(self.interned))
+        if key not in self.resolved:
+            self.ops.append((ScopedMethodsDB.RESOLVE, method))
+            self.resolved[key] = len(self.ops)
+        return self.resolved[key]
+
+def replay(methods_db, ops):
+    table = [None]
+    for kind, method in ops:
+        if kind == ScopedMethodsDB.INTERN:
+            table.append(methods_db.Intern(method))
+        else:
+            table.append(methods_db.Resolve(method))
+    return table
+
+def remap_ssa(ssaout, table):
+    return [[target, table[func], args] for target, func, args in ssaout]
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ("import", "export"):
+        print("Usage: .py import <methods_db.json> <methods.sqlite>")
+        print("       .py export <methods.sqlite> <methods_db.json>")
+        sys.exit(1)
+    if not os.path.isfile(sys.argv[2]):
+        print("[!] Invalid source path.")
+        sys.exit(1)
+    if sys.argv[1] == "import":
+        db = SqliteMethodsDB(sys.argv[3])
+        db.Import(MethodsDB.Load(sys.argv[2]))
+    else:
+        db = SqliteMethodsDB(sys.argv[2])
+        db.ExportJson(sys.argv[3])
+    db.Close()
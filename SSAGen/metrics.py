@@ -0,0 +1,254 @@
+import os, sys
+import re
+import json
+import time
+from collections import Counter
+
+from emulators import DefaultInstEmulator
+
+# Run metrics, off by default like tracing. Hot paths test `metrics.enabled` first, stage() hands
+# out a shared no-op context when disabled. Collected per process:
+#   stage_seconds{stage}             histogram  class, load, parse, emulate, write
+#   instructions_total{opcode}       counter    emulated instructions (dispatches)
+#   default_emulator_total{opcode}   counter    dispatches that fell back to DefaultInstEmulator
+#   emulation_errors_total{error, cause}  counter  failed emulations, numbers in causes are
+#                                                   replaced by N to bound the label values
+#   classes_total{result}            counter    ok / failed classes
+#   methods_total                    counter    emulated methods
+#   methods_db_size                  gauge      methods DB entries after the last class
+#   methods_db_added_total           counter    methods DB growth
+# export() writes a JSON snapshot and/or a Prometheus textfile (node_exporter textfile
+# collector format); bulk workers take() their metrics after every chunk and the parent
+# merge()s them. With a profile dir every stage runs under its own cProfile profiler (time in
+# nested stages is left to their profiles) and <stage>.<pid>.prof files are written on
+# export/take.
+
+PREFIX = "ssagen_"
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+enabled = False
+opcodes = Counter()
+fallbacks = Counter()
+counters = {} # (name, labels) -> value, labels are sorted (key, value) tuples
+gauges = {}
+histograms = {} # (name, labels) -> [count per bucket..., +Inf count, sum]
+
+_json_path = None
+_prom_path = None
+_interval = None
+_last_export = 0.0
+_profile_dir = None
+_profiles = {}
+_profiling = [] # profiles of the open stages, innermost last
+
+def configure(enable=False, json_path=None, prom_path=None, interval=None, profile_dir=None):
+    global enabled, _json_path, _prom_path, _interval, _profile_dir, _last_export
+    enabled = bool(enable or json_path or prom_path or profile_dir)
+    _json_path = json_path
+    _prom_path = prom_path
+    _interval = interval
+    _profile_dir = profile_dir
+    _last_export = time.time()
+    reset()
+
+def reset():
+    opcodes.clear()
+    fallbacks.clear()
+    counters.clear()
+    gauges.clear()
+    histograms.clear()
+
+def labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, value=1, **labels):
+    key = (name, labels_key(labels))
+    counters[key] = counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    gauges[(name, labels_key(labels))] = value
+
+def observe(name, value, **labels):
+    key = (name, labels_key(labels))
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = [0] * (len(BUCKETS) + 2)
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            h[i] += 1
+            break
+    else:
+        h[len(BUCKETS)] += 1
+    h[-1] += value
+
+def count_instruction(inst):
+    opcodes[inst.mnem] += 1
+    if isinstance(inst.emulator, DefaultInstEmulator):
+        fallbacks[inst.mnem] += 1
+
+def count_instructions(instructions):
+    for inst in instructions:
+        count_instruction(inst)
+
+def methods_db_growth(before, after):
+    if after > before:
+        inc("methods_db_added_total", after - before)
+    set_gauge("methods_db_size", after)
+
+def emulation_error(e):
+    inc("emulation_errors_total", error=e.__class__.__name__, cause=re.sub(r"-?\d+", "N", str(e))[:120])
+
+class Stage(object):
+    __slots__ = ("name", "start", "profile")
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        if _profile_dir is not None:
+            # one profiler runs at a time: a nested stage pauses the one of its outer stage,
+            # so every profile holds the time spent in its own stage only
+            if _profiling:
+                _profiling[-1].disable()
+            self.profile = _profiles.get(self.name)
+            if self.profile is None:
+                import cProfile
+                self.profile = _profiles[self.name] = cProfile.Profile()
+            _profiling.append(self.profile)
+            self.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_seconds", time.perf_counter() - self.start, stage=self.name)
+        if self.profile is not None:
+            self.profile.disable()
+            _profiling.pop()
+            if _profiling:
+                _profiling[-1].enable()
+        return False
+
+class NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STAGE = NoStage()
+
+def stage(name):
+    return Stage(name) if enabled else NO_STAGE
+
+def snapshot():
+    # plain lists, so a snapshot can be pickled to the parent and dumped as JSON
+    entries = {"counters": [], "gauges": [], "histograms": []}
+    for mnem, value in opcodes.items():
+        entries["counters"].append(["instructions_total", {"opcode": mnem}, value])
+    for mnem, value in fallbacks.items():
+        entries["counters"].append(["default_emulator_total", {"opcode": mnem}, value])
+    for (name, labels), value in counters.items():
+        entries["counters"].append([name, dict(labels), value])
+    for (name, labels), value in gauges.items():
+        entries["gauges"].append([name, dict(labels), value])
+    for (name, labels), h in histograms.items():
+        entries["histograms"].append([name, dict(labels), {"buckets": list(BUCKETS), "counts": h[:-1], "sum": h[-1]}])
+    return entries
+
+def take():
+    # snapshot and reset, for workers that report to a parent
+    dump_profiles()
+    entries = snapshot()
+    reset()
+    return entries
+
+def merge(entries):
+    if entries is None:
+        return
+    for name, labels, value in entries["counters"]:
+        if name == "instructions_total":
+            opcodes[labels["opcode"]] += value
+        elif name == "default_emulator_total":
+            fallbacks[labels["opcode"]] += value
+        else:
+            inc(name, value, **labels)
+    for name, labels, value in entries["gauges"]:
+        set_gauge(name, value, **labels)
+    for name, labels, h in entries["histograms"]:
+        key = (name, labels_key(labels))
+        current = histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for i, c in enumerate(h["counts"]):
+            current[i] += c
+        current[-1] += h["sum"]
+
+def label_text(labels, extra=()):
+    items = list(labels.items()) + list(extra)
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def prometheus_text(entries):
+    lines = []
+    typed = set()
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+    for name, labels, value in sorted(entries["counters"], key=lambda e: e[0]):
+        header(name, "counter")
+        lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+    for name, labels, value in sorted(entries["gauges"], key=lambda e: e[0]):
+        header(name, "gauge")
+        lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+    for name, labels, h in sorted(entries["histograms"], key=lambda e: e[0]):
+        header(name, "histogram")
+        total = 0
+        for bound, count in zip(h["buckets"] + ["+Inf"], h["counts"]):
+            total += count
+            lines.append(f"{PREFIX}{name}_bucket{label_text(labels, [('le', bound)])} {total}")
+        lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {h['sum']}")
+        lines.append(f"{PREFIX}{name}_count{label_text(labels)} {total}")
+    return "\n".join(lines) + "\n"
+
+def write_atomic(path, text):
+    # the textfile collector may read at any time, so the file is replaced, never rewritten
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        fp.write(text)
+    os.replace(tmp, path)
+
+def dump_profiles():
+    for name, profile in _profiles.items():
+        profile.dump_stats(os.path.join(_profile_dir, f"{name}.{os.getpid()}.prof"))
+
+def export():
+    global _last_export
+    _last_export = time.time()
+    if not enabled:
+        return
+    entries = snapshot()
+    if _json_path is not None:
+        write_atomic(_json_path, json.dumps(dict(entries, time=_last_export, pid=os.getpid()), indent=4))
+    if _prom_path is not None:
+        write_atomic(_prom_path, prometheus_text(entries))
+    if _profile_dir is not None:
+        dump_profiles()
+
+def maybe_export():
+    # periodic export during long runs
+    if enabled and _interval is not None and time.time() - _last_export >= _interval:
+        export()
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-json", default=None, help="write run metrics as JSON")
+    parser.add_argument("--metrics-prom", default=None, help="write run metrics as a Prometheus textfile (.prom)")
+    parser.add_argument("--metrics-interval", type=float, default=None, help="also export every N seconds during the run")
+    parser.add_argument("--profile-dir", default=None, help="cProfile every stage into <dir>/<stage>.<pid>.prof")
+
+def configure_from_args(args):
+    if args.profile_dir is not None and not os.path.isdir(args.profile_dir):
+        print("[!] Invalid profile dir.")
+        sys.exit(1)
+    configure(False, args.metrics_json, args.metrics_prom, args.metrics_interval, args.profile_dir)
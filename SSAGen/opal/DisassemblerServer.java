@@ -0,0 +1,47 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.util.jar.JarFile;
+
+/*
+ * Keeps one JVM with OPALDisassembler loaded and disassembles many classes.
+ * Protocol (one request per line on stdin): <class path>\t<html output path>
+ * Reply (one line on stdout): OK | ERR <message>
+ */
+public class DisassemblerServer {
+    public static void main(String[] args) throws Exception {
+        if (args.length != 1) {
+            System.err.println("Usage: DisassemblerServer <OPALDisassembler.jar>");
+            System.exit(1);
+        }
+        String mainClass;
+        try (JarFile jar = new JarFile(args[0])) {
+            mainClass = jar.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        Method disassemble = Class.forName(mainClass).getMethod("main", String[].class);
+
+        // the disassembler reports progress on stdout, keep it away from the protocol channel
+        PrintStream replies = new PrintStream(System.out, true, "UTF-8");
+        System.setOut(System.err);
+
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] paths = line.split("\t");
+            if (paths.length != 2) {
+                replies.println("ERR malformed request");
+                continue;
+            }
+            try {
+                disassemble.invoke(null, (Object) new String[]{"-source", paths[0], "-o", paths[1]});
+                replies.println("OK");
+            } catch (InvocationTargetException e) {
+                replies.println("ERR " + String.valueOf(e.getCause()).replace('\n', ' '));
+            } catch (Throwable e) {
+                replies.println("ERR " + String.valueOf(e).replace('\n', ' '));
+            }
+        }
+    }
+}
@@ -0,0 +1,102 @@
+import os
+import mmap
+import zlib
+from contextlib import contextmanager
+
+ARCHIVE_EXTENSIONS = (".jar", ".zip", ".war", ".ear")
+
+class ClassEntry(object):
+    # A class to process: either a file on disk or bytes read from an archive.
+    # Plain attributes only, so entries can be sent to worker processes.
+    def __init__(self, name, path=None, data=None):
+        self.name = name
+        self.path = path
+        self.data = data
+
+    def Read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as fp:
+            return fp.read()
+
+    @contextmanager
+    def AsFile(self):
+        # for tools that need a path (OPAL); archive entries are written to a temp file
+        if self.path is not None:
+            yield self.path
+            return
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix=".class")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(self.data)
+            yield path
+        finally:
+            os.remove(path)
+
+    def __str__(self): return self.name
+    def __repr__(self): return self.name
+
+class MappedFile(object):
+    # the file interface zipfile needs on top of an mmap (mmap has no seekable() before 3.13)
+    def __init__(self, mm):
+        self.mm = mm
+
+    def read(self, n=-1): return self.mm.read(n if n is not None and n >= 0 else len(self.mm) - self.mm.tell())
+    def seek(self, pos, whence=0):
+        # zipfile expects OSError for a position before the start (short or non-zip files)
+        try:
+            self.mm.seek(pos, whence)
+        except ValueError as e:
+            raise OSError(f"Invalid seek: {e}")
+        return self.mm.tell()
+    def tell(self): return self.mm.tell()
+    def seekable(self): return True
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def iter_archive(path):
+    import zipfile # only loaded for archives, it's a large part of the startup time
+    if os.path.getsize(path) == 0:
+        return
+    # a corrupt archive (or entry) is reported and skipped, it doesn't end the run
+    with open(path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        try:
+            zf = zipfile.ZipFile(MappedFile(mm))
+        except (zipfile.BadZipFile, OSError) as e:
+            print(f"[!] Skipping invalid archive {path}: {e}")
+            return
+        with zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.endswith(".class"):
+                    continue
+                try:
+                    data = zf.read(info)
+                except (zipfile.BadZipFile, OSError, EOFError, zlib.error) as e:
+                    print(f"[!] Skipping invalid archive entry {path}!{info.filename}: {e}")
+                    continue
+                yield ClassEntry(f"{path}!{info.filename}", data=data)
+
+def walk(root):
+    # one directory listing at a time, sorted so runs are reproducible
+    with os.scandir(root) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir():
+            yield from walk(e.path)
+        elif e.name.endswith(".class"):
+            yield ClassEntry(e.path, path=e.path)
+        elif is_archive(e.name):
+            yield from iter_archive(e.path)
+
+def iter_classes(path):
+    if os.path.isdir(path):
+        yield from walk(path)
+    elif is_archive(path):
+        yield from iter_archive(path)
+    else:
+        yield ClassEntry(path, path=path)
+
+def as_entry(class_file):
+    return class_file if isinstance(class_file, ClassEntry) else ClassEntry(class_file, path=class_file)
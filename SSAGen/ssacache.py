@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from classreader import constant_refs
+from emulators import EMULATOR_VERSION
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "BytecodeToSSA", "ssa.sqlite")
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+def method_key(cp, method_info, backend, emulation="linear"):
+    # The SSA of a method only depends on its code, the constants it references and the
+    # frame layout. Method IDs are cached symbolically (ScopedMethodsDB ops), so the key
+    # doesn't have to include the methods DB.
+    h = hashlib.sha256()
+    h.update(f"{EMULATOR_VERSION}|{backend}|{emulation}|{method_info.max_stack}|{method_info.max_locals}|{method_info.exception_table}|".encode())
+    code = method_info.code or b""
+    h.update(code)
+    for index in constant_refs(code):
+        h.update(b"\0")
+        h.update(cp.describe(index).encode("utf-8", errors="surrogatepass"))
+    return h.hexdigest()
+
+class SSACache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, rebuild=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rebuild = rebuild
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def Get(self, key):
+        if self.rebuild:
+            self.misses += 1
+            return None
+        row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        ops, ssaout = json.loads(zlib.decompress(row[0]))
+        return ops, ssaout
+
+    def Put(self, key, ops, ssaout):
+        value = zlib.compress(json.dumps([ops, ssaout], separators=(",", ":")).encode())
+        self.conn.execute("INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+        self.size += len(value)
+        if self.size > self.max_bytes:
+            self.Evict()
+
+    def Evict(self):
+        # drop least recently used entries down to 90% of the limit
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = self.max_bytes * 0.9
+        if self.size <= target:
+            return
+        freed = 0
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY used"):
+            if self.size - freed <= target:
+                break
+            doomed.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        self.size -= freed
+
+    def Stats(self):
+        return f"SSA cache: {self.hits} hits, {self.misses} misses, {self.size / 1024 / 1024:.1f} MiB"
+
+    def Close(self):
+        self.conn.close()
+
+_caches = {}
+
+def get_cache(path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, rebuild=False):
+    # one connection per process, worker processes open their own
+    if path not in _caches:
+        _caches[path] = SSACache(path, max_bytes, rebuild)
+    return _caches[path]
@@ -0,0 +1,251 @@
+import os, sys
+import json
+import mmap
+import hashlib
+import sqlite3
+from array import array
+
+# Sharded binary SSA output. A store is a directory with
+#   index.sqlite      - one row per method: class, method, label, shard, offset, size, count
+#                       (instructions) and max_var (highest var id, for sizing models)
+#   <writer>-<n>.ssab - method records appended back to back, each a little-endian int32 array
+#                       [count, nargs, targets[count], funcs[count], ends[count], args[nargs]]
+#                       where targets use -1 for "no target" and ends[i] is the end of the
+#                       args of instruction i in args
+# Every writer appends to its own shard files and only shares the SQLite index, so bparser
+# runs and bulk workers can write into one store at the same time.
+
+INDEX_NAME = "index.sqlite"
+SHARD_SUFFIX = ".ssab"
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+NO_TARGET = -1
+
+FORMATS = ("shards", "json")
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+def label_of(method_name):
+    # the Juliet naming convention simple_lstm.py trains on
+    name = method_name.lower()
+    if name.find("bad") != -1:
+        return 1
+    if name.find("good") != -1:
+        return 0
+    return None
+
+def pack_ssa(ssaout):
+    count = len(ssaout)
+    targets = array("i", [NO_TARGET if t is None else t for t, _, _ in ssaout])
+    funcs = array("i", [f for _, f, _ in ssaout])
+    ends = array("i")
+    args = array("i")
+    for _, _, a in ssaout:
+        args.extend(a)
+        ends.append(len(args))
+    record = array("i", [count, len(args)]) + targets + funcs + ends + args
+    if sys.byteorder != "little":
+        record.byteswap()
+    return record.tobytes()
+
+def max_var(ssaout):
+    return max((max([t or 0] + a) for t, _, a in ssaout), default=0)
+
+def unpack_arrays(buf):
+    # (targets, funcs, ends, args) int32 arrays of one record
+    record = array("i")
+    record.frombytes(buf)
+    if sys.byteorder != "little":
+        record.byteswap()
+    count, nargs = record[0], record[1]
+    pos = 2
+    targets = record[pos:pos + count]
+    funcs = record[pos + count:pos + 2 * count]
+    ends = record[pos + 2 * count:pos + 3 * count]
+    args = record[pos + 3 * count:pos + 3 * count + nargs]
+    return targets, funcs, ends, args
+
+def unpack_ssa(buf):
+    targets, funcs, ends, args = unpack_arrays(buf)
+    ssaout = []
+    start = 0
+    for target, func, end in zip(targets, funcs, ends):
+        ssaout.append([None if target == NO_TARGET else target, func, args[start:end].tolist()])
+        start = end
+    return ssaout
+
+def open_index(path):
+    conn = sqlite3.connect(os.path.join(path, INDEX_NAME), timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS methods (id INTEGER PRIMARY KEY, class TEXT NOT NULL, method TEXT NOT NULL, label INTEGER, shard TEXT NOT NULL, offset INTEGER NOT NULL, size INTEGER NOT NULL, count INTEGER NOT NULL, max_var INTEGER NOT NULL, UNIQUE (class, method))")
+    return conn
+
+class ShardWriter(object):
+    def __init__(self, path, shard_bytes=DEFAULT_SHARD_BYTES, flush_every=1024):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.flush_every = flush_every
+        self.conn = open_index(path)
+        self.prefix = f"{os.uname().nodename}-{os.getpid()}"
+        self.shard = None
+        self.fp = None
+        self.rows = []
+
+    def open_shard(self):
+        # a fresh shard name per writer, never shared with another process
+        n = 0
+        while os.path.exists(os.path.join(self.path, f"{self.prefix}-{n}{SHARD_SUFFIX}")):
+            n += 1
+        self.shard = f"{self.prefix}-{n}{SHARD_SUFFIX}"
+        self.fp = open(os.path.join(self.path, self.shard), "ab")
+
+    def Write(self, class_name, method_name, ssaout):
+        self.WriteRecord(class_name, method_name, pack_ssa(ssaout), len(ssaout), max_var(ssaout))
+
+    def WriteRecord(self, class_name, method_name, record, count, highest_var):
+        # an already packed record, e.g. copied from another store
+        if self.fp is None or self.fp.tell() >= self.shard_bytes:
+            self.Flush()
+            if self.fp is not None:
+                self.fp.close()
+            self.open_shard()
+        self.rows.append((class_name, method_name, label_of(method_name), self.shard, self.fp.tell(), len(record), count, highest_var))
+        self.fp.write(record)
+        if len(self.rows) >= self.flush_every:
+            self.Flush()
+
+    def Flush(self):
+        # data first, so an index row never points past the end of a shard
+        if not self.rows:
+            return
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR REPLACE INTO methods (class, method, label, shard, offset, size, count, max_var) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.rows)
+        self.conn.execute("COMMIT")
+        self.rows = []
+
+    def Close(self):
+        self.Flush()
+        if self.fp is not None:
+            self.fp.close()
+        self.conn.close()
+
+# "_" is escaped too, so the first "_" of a JSON file name starts the method name
+NAME_ESCAPES = {ord(c): f"%{ord(c):02X}" for c in "%_/\\!:"}
+MAX_NAME = 200
+
+def ssa_file_name(class_name, method_name):
+    # the whole class path (or jar!entry) goes into the name, classes with the same simple
+    # name in other packages or directories don't overwrite each other
+    if class_name.endswith(".class"):
+        class_name = class_name[:-len(".class")]
+    stem = class_name.translate(NAME_ESCAPES)
+    if len(stem) > MAX_NAME: # file names are limited to 255 bytes
+        stem = stem[-MAX_NAME:] + "%" + hashlib.sha1(class_name.encode()).hexdigest()[:16]
+    return f"{stem}_{method_name}.ssa"
+
+def method_of_file(file_name):
+    return file_name.split("_", 1)[1] if "_" in file_name else file_name
+
+def write_ssa(ssaout_path, class_file, method_name, ssaout):
+    outpath = os.path.join(ssaout_path, ssa_file_name(class_file, method_name))
+    with open(outpath, 'w') as fp:
+        json.dump(ssaout, fp, indent=4)
+
+class JsonWriter(object):
+    # one pretty-printed .ssa file per method, for debugging
+    def __init__(self, path):
+        self.path = path
+
+    def Write(self, class_name, method_name, ssaout):
+        write_ssa(self.path, class_name, method_name, ssaout)
+
+    def Flush(self):
+        pass
+
+    def Close(self):
+        pass
+
+def open_writer(path, format="shards"):
+    if format == "json":
+        return JsonWriter(path)
+    return ShardWriter(path)
+
+class Entry(object):
+    __slots__ = ("id", "cls", "method", "label", "shard", "offset", "size", "count", "max_var")
+
+    def __init__(self, id, cls, method, label, shard, offset, size, count, max_var):
+        self.id = id
+        self.cls = cls
+        self.method = method
+        self.label = label
+        self.shard = shard
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.max_var = max_var
+
+class ShardReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = open_index(path)
+        self.maps = {}
+
+    def Entries(self):
+        return [Entry(*row) for row in self.conn.execute("SELECT id, class, method, label, shard, offset, size, count, max_var FROM methods ORDER BY id")]
+
+    def Find(self, class_name, method_name):
+        row = self.conn.execute("SELECT id, class, method, label, shard, offset, size, count, max_var FROM methods WHERE class = ? AND method = ?", (class_name, method_name)).fetchone()
+        return Entry(*row) if row is not None else None
+
+    def shard_map(self, shard):
+        if shard not in self.maps:
+            with open(os.path.join(self.path, shard), "rb") as fp:
+                self.maps[shard] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def ReadBytes(self, entry):
+        return self.shard_map(entry.shard)[entry.offset:entry.offset + entry.size]
+
+    def ReadArrays(self, entry):
+        return unpack_arrays(self.ReadBytes(entry))
+
+    def Read(self, entry):
+        return unpack_ssa(self.ReadBytes(entry))
+
+    def Get(self, class_name, method_name):
+        entry = self.Find(class_name, method_name)
+        if entry is None:
+            raise KeyError(f"{class_name} {method_name}")
+        return self.Read(entry)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM methods").fetchone()[0]
+
+    def Close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+        self.conn.close()
+
+def export_json(store_path, json_path):
+    reader = ShardReader(store_path)
+    try:
+        for entry in reader.Entries():
+            write_ssa(json_path, entry.cls, entry.method, reader.Read(entry))
+    finally:
+        reader.Close()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "export":
+        print("Usage: .py export <ssa store dir> <json out dir>")
+        sys.exit(1)
+    if not is_store(sys.argv[2]):
+        print("[!] Invalid ssa store path.")
+        sys.exit(1)
+    if not os.path.isdir(sys.argv[3]):
+        print("[!] Invalid json out dir.")
+        sys.exit(1)
+    export_json(sys.argv[2], sys.argv[3])
@@ -0,0 +1,179 @@
+from emulators import InstEmulator, WIDE_TYPES
+from mnemonics import MNEMONICS
+
+# Stack effect of every opcode, keyed by opcode. Each value is one stack entry, whatever its
+# size; the category (1 or 2) of a pushed value is remembered in EmulationContext.wide
+# because the pop2/dup2 family moves words, not values.
+#
+#   (pops, pushes, local)
+#     pops   - number of values taken from the stack
+#     pushes - categories of the new values pushed
+#     local  - None, LOAD/STORE (index from the mnemonic suffix or the args) or INC
+#   (SHUFFLE, words moved, words skipped) - pop2/dup*/swap, values are moved, not created
+#
+# Invocations pop a descriptor dependent number of values and are left to the invoke
+# emulators; field loads push a value of the field's category (FIELD).
+
+LOAD = "load"
+STORE = "store"
+INC = "inc"
+SHUFFLE = "shuffle"
+FIELD = "field"
+
+CATEGORY = {"i": 1, "f": 1, "a": 1, "b": 1, "c": 1, "s": 1, "l": 2, "d": 2}
+
+def effects_by_mnemonic():
+    effects = {
+        "nop": (0, (), None),
+        "aconst_null": (0, (1,), None),
+        "bipush": (0, (1,), None),
+        "sipush": (0, (1,), None),
+        "ldc": (0, (1,), None),
+        "ldc_w": (0, (1,), None),
+        "ldc2_w": (0, (2,), None),
+        "pop": (1, (), None),
+        "pop2": (SHUFFLE, 2, None),
+        "dup": (SHUFFLE, 1, 0),
+        "dup_x1": (SHUFFLE, 1, 1),
+        "dup_x2": (SHUFFLE, 1, 2),
+        "dup2": (SHUFFLE, 2, 0),
+        "dup2_x1": (SHUFFLE, 2, 1),
+        "dup2_x2": (SHUFFLE, 2, 2),
+        "swap": (SHUFFLE, 1, 1),
+        "iinc": (0, (), INC),
+        "lcmp": (2, (1,), None),
+        "fcmpl": (2, (1,), None),
+        "fcmpg": (2, (1,), None),
+        "dcmpl": (2, (1,), None),
+        "dcmpg": (2, (1,), None),
+        "goto": (0, (), None),
+        "goto_w": (0, (), None),
+        "jsr": (0, (1,), None),
+        "jsr_w": (0, (1,), None),
+        "ret": (0, (), None),
+        "tableswitch": (1, (), None),
+        "lookupswitch": (1, (), None),
+        "return": (0, (), None),
+        "getstatic": (0, (FIELD,), None),
+        "putstatic": (1, (), None),
+        "getfield": (1, (FIELD,), None),
+        "putfield": (2, (), None),
+        "new": (0, (1,), None),
+        "newarray": (1, (1,), None),
+        "anewarray": (1, (1,), None),
+        "arraylength": (1, (1,), None),
+        "athrow": (1, (), None),
+        "checkcast": (0, (), None), # the reference stays the same value
+        "instanceof": (1, (1,), None),
+        "monitorenter": (1, (), None),
+        "monitorexit": (1, (), None),
+        "multianewarray": (None, (1,), None),
+        "ifnull": (1, (), None),
+        "ifnonnull": (1, (), None),
+    }
+    for t in "ilfda":
+        effects[f"{t}load"] = (0, (), LOAD)
+        effects[f"{t}store"] = (0, (), STORE)
+        for i in range(4):
+            effects[f"{t}load_{i}"] = (0, (), LOAD)
+            effects[f"{t}store_{i}"] = (0, (), STORE)
+        effects[f"{t}return"] = (1, (), None)
+    for t in "ilfdabcs":
+        effects[f"{t}aload"] = (2, (CATEGORY[t],), None)
+        effects[f"{t}astore"] = (3, (), None)
+    for t in "ilfd":
+        cat = CATEGORY[t]
+        for op in ("add", "sub", "mul", "div", "rem"):
+            effects[f"{t}{op}"] = (2, (cat,), None)
+        effects[f"{t}neg"] = (1, (cat,), None)
+        for to in "ilfd":
+            if to != t:
+                effects[f"{t}2{to}"] = (1, (CATEGORY[to],), None)
+    for t in "il":
+        for op in ("shl", "shr", "ushr", "and", "or", "xor"):
+            effects[f"{t}{op}"] = (2, (CATEGORY[t],), None)
+    for to in "bcs":
+        effects[f"i2{to}"] = (1, (1,), None)
+    for n in ("m1", "0", "1", "2", "3", "4", "5"):
+        effects[f"iconst_{n}"] = (0, (1,), None)
+    for t, values in (("l", "01"), ("f", "012"), ("d", "01")):
+        for n in values:
+            effects[f"{t}const_{n}"] = (0, (CATEGORY[t],), None)
+    for cond in ("eq", "ne", "lt", "ge", "gt", "le"):
+        effects[f"if{cond}"] = (1, (), None)
+        effects[f"if_icmp{cond}"] = (2, (), None)
+    for cond in ("eq", "ne"):
+        effects[f"if_acmp{cond}"] = (2, (), None)
+    return effects
+
+STACK_EFFECTS = {MNEMONICS[m]: e for m, e in effects_by_mnemonic().items()}
+
+def category(typename):
+    return 2 if typename in WIDE_TYPES else 1
+
+def local_index(inst):
+    # xload_<n>/xstore_<n> carry the index in the mnemonic, the rest in the args
+    if inst.mnem[-2] == "_":
+        return int(inst.mnem[-1])
+    return int(inst.args.raw.split()[0])
+
+def pop_words(econtext, words):
+    values = []
+    while words > 0:
+        var = econtext.stack.pop()
+        values.append(var)
+        words -= 2 if var in econtext.wide else 1
+    values.reverse()
+    return values
+
+class StackEffectEmulator(InstEmulator):
+    def __init__(self, effect):
+        self.pops, self.pushes, self.local = effect
+
+    def Emulate(self, inst, econtext):
+        stack = econtext.stack
+        if self.local is LOAD:
+            stack.push(econtext.vararr[local_index(inst)])
+            return
+        if self.local is STORE:
+            econtext.vararr[local_index(inst)] = stack.pop()
+            return
+        if self.local is INC:
+            econtext.vararr[local_index(inst)] = econtext.get_new_var()
+            return
+        pops = self.pops
+        if pops is None: # multianewarray, the dimension count is the last operand
+            pops = int(inst.args.raw.split()[-1])
+        for _ in range(pops):
+            stack.pop()
+        for cat in self.pushes:
+            var = econtext.get_new_var()
+            if cat is FIELD:
+                cat = category(inst.args.stattype)
+            if cat == 2:
+                econtext.wide.add(var)
+            stack.push(var)
+
+class ShuffleEmulator(InstEmulator):
+    # pop2, dup*, swap: move existing values by words (a long/double is two words)
+    def __init__(self, effect, swap=False):
+        _, self.words, self.skip = effect
+        self.swap = swap
+
+    def Emulate(self, inst, econtext):
+        top = pop_words(econtext, self.words)
+        if self.skip is None: # pop2
+            return
+        under = pop_words(econtext, self.skip)
+        values = top + under if self.swap else top + under + top
+        for var in values:
+            econtext.stack.push(var)
+
+def table_emulators():
+    emulators = {}
+    for op, effect in STACK_EFFECTS.items():
+        if effect[0] is SHUFFLE:
+            emulators[op] = ShuffleEmulator(effect, op == MNEMONICS["swap"])
+        else:
+            emulators[op] = StackEffectEmulator(effect)
+    return emulators
@@ -0,0 +1,177 @@
+import os, sys
+import struct
+import random
+import argparse
+from html import escape
+
+from classreader import *
+from mnemonics import MNEMONICS
+
+# Synthetic class files (and the OPAL HTML rendering of them) for benchmarks. Every method is
+# static void over int locals and is made of stack-neutral statements:
+#   arithmetic  - iload a; iload b; iadd|isub|imul|iand; istore c
+#   constant    - bipush k; istore c
+#   increment   - iinc a k
+#   invoke      - iload a; iload b; invokestatic <lib> (II)I; istore c, or
+#                 getstatic System.out; iload a; invokevirtual println (I)V
+#   branch      - iload a; if<cond> <statement>, iload a; iload b; if_icmp<cond> <statement>
+#                 or iinc a 1; goto <statement>, to any statement start (loops included)
+# so both the linear and the CFG emulation accept them. The shape is set by the method length,
+# the share of branch and invoke statements and the seed; the same arguments give the same
+# bytes.
+
+LOCALS = 8
+MAX_STACK = 4
+ARITH_OPS = ("iadd", "isub", "imul", "iand")
+IF_OPS = ("ifeq", "ifne", "iflt", "ifge")
+IF_ICMP_OPS = ("if_icmpeq", "if_icmpne", "if_icmplt", "if_icmpge")
+# a mix of java.* (interned) and application methods (resolved to the wildcard when unknown)
+LIBRARY = [("java/lang/Math", "max"), ("java/lang/Math", "min"), ("java/lang/Integer", "rotateLeft")] + \
+          [(f"com/example/Lib{i}", f"f{j}") for i in range(4) for j in range(4)]
+
+def op(mnem):
+    return bytes([MNEMONICS[mnem]])
+
+class PoolBuilder(object):
+    def __init__(self):
+        self.entries = []
+        self.index = {}
+
+    def add(self, key, data):
+        if key not in self.index:
+            self.entries.append(data)
+            self.index[key] = len(self.entries)
+        return self.index[key]
+
+    def utf8(self, text):
+        raw = text.encode()
+        return self.add((CONSTANT_UTF8, text), struct.pack(">BH", CONSTANT_UTF8, len(raw)) + raw)
+
+    def cls(self, name):
+        return self.add((CONSTANT_CLASS, name), struct.pack(">BH", CONSTANT_CLASS, self.utf8(name)))
+
+    def name_and_type(self, name, desc):
+        return self.add((CONSTANT_NAME_AND_TYPE, name, desc), struct.pack(">BHH", CONSTANT_NAME_AND_TYPE, self.utf8(name), self.utf8(desc)))
+
+    def member(self, tag, cls, name, desc):
+        return self.add((tag, cls, name, desc), struct.pack(">BHH", tag, self.cls(cls), self.name_and_type(name, desc)))
+
+    def Bytes(self):
+        return struct.pack(">H", len(self.entries) + 1) + b"".join(self.entries)
+
+def local_op(mnem, index):
+    return op(f"{mnem}_{index}") if index < 4 else op(mnem) + bytes([index])
+
+def statement(rng, cp, invoke_ratio, branch):
+    # (code, branch opcode offset or None); a branch offset is patched by method_code()
+    a, b, c = rng.randrange(LOCALS), rng.randrange(LOCALS), rng.randrange(LOCALS)
+    if branch:
+        kind = rng.randrange(3)
+        if kind == 0:
+            code = local_op("iload", a)
+            return code + op(rng.choice(IF_OPS)) + b"\0\0", len(code)
+        if kind == 1:
+            code = local_op("iload", a) + local_op("iload", b)
+            return code + op(rng.choice(IF_ICMP_OPS)) + b"\0\0", len(code)
+        code = op("iinc") + struct.pack(">Bb", a, 1)
+        return code + op("goto") + b"\0\0", len(code)
+    if rng.random() < invoke_ratio:
+        if rng.random() < 0.25:
+            out = cp.member(CONSTANT_FIELDREF, "java/lang/System", "out", "Ljava/io/PrintStream;")
+            println = cp.member(CONSTANT_METHODREF, "java/io/PrintStream", "println", "(I)V")
+            return op("getstatic") + struct.pack(">H", out) + local_op("iload", a) + op("invokevirtual") + struct.pack(">H", println), None
+        cls, name = rng.choice(LIBRARY)
+        ref = cp.member(CONSTANT_METHODREF, cls, name, "(II)I")
+        return local_op("iload", a) + local_op("iload", b) + op("invokestatic") + struct.pack(">H", ref) + local_op("istore", c), None
+    kind = rng.randrange(3)
+    if kind == 0:
+        return local_op("iload", a) + local_op("iload", b) + op(rng.choice(ARITH_OPS)) + local_op("istore", c), None
+    if kind == 1:
+        return op("bipush") + struct.pack(">b", rng.randrange(-128, 128)) + local_op("istore", c), None
+    return op("iinc") + struct.pack(">Bb", a, rng.randrange(-8, 8)), None
+
+def method_code(rng, cp, length, branch_density, invoke_ratio):
+    # statements until about length instructions, locals initialized first
+    statements = []
+    for i in range(LOCALS):
+        statements.append((op("iconst_0") + local_op("istore", i), None))
+    count = 2 * LOCALS
+    while count < length:
+        code, branch_at = statement(rng, cp, invoke_ratio, rng.random() < branch_density)
+        statements.append((code, branch_at))
+        count += 3
+    starts = []
+    pc = 0
+    for code, _ in statements:
+        starts.append(pc)
+        pc += len(code)
+    end = pc # the final return
+    code = bytearray()
+    for i, (body, branch_at) in enumerate(statements):
+        body = bytearray(body)
+        if branch_at is not None:
+            target = rng.choice(starts[LOCALS:] + [end])
+            struct.pack_into(">h", body, branch_at + 1, target - (starts[i] + branch_at))
+        code += body
+    return bytes(code + op("return"))
+
+def synth_class(name, methods=4, length=64, branch_density=0.1, invoke_ratio=0.3, seed=0):
+    rng = random.Random(f"{seed}:{name}")
+    cp = PoolBuilder()
+    this = cp.cls(name)
+    parent = cp.cls("java/lang/Object")
+    code_name = cp.utf8("Code")
+    bodies = []
+    for i in range(methods):
+        # Juliet style names, so the store labels them
+        method_name = "bad" if i == 0 else f"good{i}"
+        code = method_code(rng, cp, length, branch_density, invoke_ratio)
+        attr = struct.pack(">HHI", MAX_STACK, LOCALS, len(code)) + code + struct.pack(">HH", 0, 0)
+        bodies.append(struct.pack(">HHHH", 0x0009, cp.utf8(method_name), cp.utf8("()V"), 1) + struct.pack(">HI", code_name, len(attr)) + attr)
+    return struct.pack(">IHH", ClassFile.MAGIC, 0, 52) + cp.Bytes() + struct.pack(">HHHHH", 0x0021, this, parent, 0, 0) + \
+           struct.pack(">H", len(bodies)) + b"".join(bodies) + struct.pack(">H", 0)
+
+def render_html(data):
+    # the subset of OPAL's disassembly HTML that htmlindex.py reads
+    classfile = ClassFile(data)
+    parts = [f"<html><body><h1>{escape(classfile.name)}</h1>\n"]
+    for method in classfile.methods:
+        parts.append(f'<details class="method" data-name="{escape(method.name)}"><summary>{escape(method.name)}</summary>\n')
+        parts.append('<table class="method_bytecode"><tr><th>PC</th><th>Line</th><th>Instruction</th></tr>\n')
+        for pc, mnem, raw, _ in method.Decode():
+            if raw is None:
+                args = ""
+            elif MNEMONICS[mnem] in BRANCH_OPS or MNEMONICS[mnem] in WIDE_BRANCH_OPS:
+                args = f" <a>{escape(raw)}</a>"
+            else:
+                args = f" <span>{escape(raw)}</span>"
+            parts.append(f'<tr><td>{pc}</td><td></td><td><span class="instruction">{mnem}</span>{args}</td></tr>\n')
+        parts.append("</table></details>\n")
+    parts.append("</body></html>\n")
+    return "".join(parts)
+
+def synth_corpus(classes=100, methods=4, length=64, branch_density=0.1, invoke_ratio=0.3, seed=0):
+    # [(class name, class bytes)]
+    return [(f"bench/C{i}", synth_class(f"bench/C{i}", methods, length, branch_density, invoke_ratio, seed)) for i in range(classes)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic class file corpus (and its OPAL style HTML)")
+    parser.add_argument("outdir")
+    parser.add_argument("--classes", type=int, default=100)
+    parser.add_argument("--methods", type=int, default=4, help="methods per class")
+    parser.add_argument("--length", type=int, default=64, help="instructions per method (about)")
+    parser.add_argument("--branch-density", type=float, default=0.1, help="share of branch statements")
+    parser.add_argument("--invoke-ratio", type=float, default=0.3, help="share of invoke statements among the rest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--html", action="store_true", help="also write <class>.html next to each class file")
+    args = parser.parse_args()
+    if not os.path.isdir(args.outdir):
+        print("[!] Invalid out dir.")
+        sys.exit(1)
+    for name, data in synth_corpus(args.classes, args.methods, args.length, args.branch_density, args.invoke_ratio, args.seed):
+        path = os.path.join(args.outdir, os.path.basename(name))
+        with open(path + ".class", "wb") as fp:
+            fp.write(data)
+        if args.html:
+            with open(path + ".html", "w") as fp:
+                fp.write(render_html(data))
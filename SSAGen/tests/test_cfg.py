@@ -0,0 +1,108 @@
+import os, sys
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bparser import Method, NativeClass
+from classreader import ClassFile, CONSTANT_METHODREF
+from emulators import EmulationError
+from methodsdb import MethodsDB
+from synth import PoolBuilder, op
+from cfg import PHI_METHOD, build_blocks
+
+def method_class(cp, code, max_stack, max_locals, exceptions=()):
+    # class t/T with static void bad(int), exceptions are (start, end, handler) pcs
+    this = cp.cls("t/T")
+    parent = cp.cls("java/lang/Object")
+    code_name = cp.utf8("Code")
+    table = b"".join(struct.pack(">HHHH", start, end, handler, 0) for start, end, handler in exceptions)
+    attr = struct.pack(">HHI", max_stack, max_locals, len(code)) + code + struct.pack(">H", len(exceptions)) + table + struct.pack(">H", 0)
+    method = struct.pack(">HHHH", 0x0009, cp.utf8("bad"), cp.utf8("(I)V"), 1) + struct.pack(">HI", code_name, len(attr)) + attr
+    return struct.pack(">IHH", ClassFile.MAGIC, 0, 52) + cp.Bytes() + struct.pack(">HHHHH", 0x0021, this, parent, 0, 0) + \
+           struct.pack(">H", 1) + method + struct.pack(">H", 0)
+
+def abs_ref(cp, desc="(I)I"):
+    return struct.pack(">H", cp.member(CONSTANT_METHODREF, "java/lang/Math", "abs", desc))
+
+def loop_class(prefix=b""):
+    # while (x > 0) x = g(x); with the loop header at the first instruction unless a prefix
+    # is given
+    cp = PoolBuilder()
+    code = prefix + op("iload_0") + op("ifle") + struct.pack(">h", 11) + op("iload_0") + op("invokestatic") + abs_ref(cp) + \
+           op("istore_0") + op("goto") + struct.pack(">h", -9) + op("return")
+    return method_class(cp, code, 2, 1)
+
+def emulate_cfg(data):
+    emulation, Method.EMULATION = Method.EMULATION, "cfg"
+    try:
+        db = MethodsDB()
+        m = Method(NativeClass(ClassFile(data)), "bad", db)
+        m.Parse()
+        m.Emulate()
+        return m.ssaout, db
+    finally:
+        Method.EMULATION = emulation
+
+def phis_and_calls(data):
+    ssaout, db = emulate_cfg(data)
+    phi_func = db.get(PHI_METHOD)
+    phis = [(target, args) for target, func, args in ssaout if func == phi_func]
+    calls = [(target, args) for target, func, args in ssaout if func != phi_func]
+    return phis, calls
+
+def check_loop_phi(data):
+    phis, calls = phis_and_calls(data)
+    assert len(phis) == 1 and len(calls) == 1
+    phi, operands = phis[0]
+    result, call_args = calls[0]
+    # the loop-carried value: the parameter on entry, the call result on the back edge
+    assert sorted(operands) == sorted([1, result])
+    assert call_args == [phi]
+
+def test_loop_header_at_entry_gets_phi():
+    check_loop_phi(loop_class())
+
+def test_loop_header_after_nop_gets_phi():
+    check_loop_phi(loop_class(op("nop")))
+
+def test_exception_handler_merges_locals():
+    # try { x = g(x); } catch (Exception e) { x = 0; } g(x);
+    cp = PoolBuilder()
+    g = abs_ref(cp)
+    code = op("iload_0") + op("invokestatic") + g + op("istore_0") + op("goto") + struct.pack(">h", 6) + \
+           op("astore_1") + op("iconst_0") + op("istore_0") + \
+           op("iload_0") + op("invokestatic") + g + op("pop") + op("return")
+    phis, calls = phis_and_calls(method_class(cp, code, 1, 2, [(0, 5, 8)]))
+    assert len(phis) == 1 and len(calls) == 2
+    phi, operands = phis[0]
+    (tried, _), (_, call_args) = calls
+    assert len(operands) == 2 and tried in operands and 1 not in operands
+    assert call_args == [phi]
+
+def test_switch_merges_cases():
+    # switch (x) { case 0: x = 1; break; case 1: x = 2; break; } g(x);
+    cp = PoolBuilder()
+    code = op("iload_0") + op("tableswitch") + b"\0\0" + struct.pack(">iiiii", 33, 0, 1, 23, 28) + \
+           op("iconst_1") + op("istore_0") + op("goto") + struct.pack(">h", 8) + \
+           op("iconst_2") + op("istore_0") + op("goto") + struct.pack(">h", 3) + \
+           op("iload_0") + op("invokestatic") + abs_ref(cp) + op("pop") + op("return")
+    phis, calls = phis_and_calls(method_class(cp, code, 1, 1))
+    assert len(phis) == 1 and len(calls) == 1
+    phi, operands = phis[0]
+    assert len(operands) == 3 and 1 in operands
+    assert calls[0][1] == [phi]
+
+def test_wide_values_across_blocks():
+    # a long on the stack and one in a local, both used by pop2/dup2 after a branch
+    cp = PoolBuilder()
+    code = op("lconst_1") + op("lstore_1") + op("lconst_0") + op("iload_0") + op("ifeq") + struct.pack(">h", 4) + op("nop") + \
+           op("dup2") + op("invokestatic") + abs_ref(cp, "(J)J") + op("pop2") + op("pop2") + \
+           op("lload_1") + op("pop2") + op("return")
+    phis, calls = phis_and_calls(method_class(cp, code, 4, 3))
+    assert phis == [] and len(calls) == 1
+    assert len(calls[0][1]) == 1
+
+def test_empty_method_is_an_emulation_error():
+    with pytest.raises(EmulationError):
+        build_blocks([], [])
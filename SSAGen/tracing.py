@@ -0,0 +1,48 @@
+import os, sys
+import json
+import atexit
+
+# Structured emulation tracing, off by default. Hot paths test `tracing.level >= tracing.X`
+# before building a record, so a disabled trace costs one comparison.
+OFF = 0
+INFO = 1
+DEBUG = 2
+TRACE = 3
+LEVELS = {"off": OFF, "info": INFO, "debug": DEBUG, "trace": TRACE}
+
+level = OFF
+_out = None
+
+def configure(level_name="off", path=None, per_process=False):
+    # JSON lines go to path (stderr if not set); per_process appends the pid for worker pools
+    global level, _out
+    close()
+    level = LEVELS[level_name]
+    if level == OFF:
+        return
+    if path is None:
+        _out = sys.stderr
+    else:
+        if per_process:
+            path = f"{path}.{os.getpid()}"
+        _out = open(path, "a", buffering=1024 * 1024)
+        atexit.register(close)
+        # pool workers leave through os._exit, without atexit; finalizers with an exit priority
+        # still run there
+        from multiprocessing.util import Finalize
+        Finalize(None, close, exitpriority=10)
+
+def emit(ev, **fields):
+    record = {"ev": ev}
+    record.update(fields)
+    _out.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+def flush():
+    if _out is not None:
+        _out.flush()
+
+def close():
+    global _out
+    if _out is not None and _out is not sys.stderr:
+        _out.close()
+    _out = None
@@ -0,0 +1,239 @@
+import os, sys
+import json
+import time
+import select
+import signal
+import socket
+import argparse
+
+import bparser
+import metrics
+from sources import iter_classes
+from methodsdb import open_methods_db
+from ssastore import open_writer
+
+# Long-lived bparser: starts once (interpreter, imports, methods DB load) and converts the
+# classes it is sent. Requests come from stdin or a Unix socket (--socket), one per line or
+# NUL terminated with --null (paths with newlines). A request is either a path (class file,
+# jar or directory) or a JSON object:
+#   {"id": ..., "path": ...}   convert, the SSA goes into the ssaout store like with bparser.py
+#   {"id": ..., "op": "flush"} write the methods DB and the store index now
+#   {"id": ..., "op": "stats"} counters of this worker
+#   {"id": ..., "op": "shutdown"}
+# Every request gets one JSON line back (on stdout, or on the connection): the converted
+# methods with their instruction counts (and the SSA itself with --inline-ssa), the methods
+# that failed or were skipped and the classes that failed, with their errors; a request that
+# fails as a whole (e.g. an unreadable jar) gets {"id": ..., "error": ...}. In stdio mode the progress messages go to stderr.
+# The methods DB is kept in memory and written every --flush-every requests, after
+# --flush-interval seconds with pending changes (also when idle) and on shutdown (EOF,
+# "shutdown", SIGTERM or SIGINT).
+
+DEFAULT_SOCKET = "/tmp/bparser.sock"
+
+class Worker(object):
+    def __init__(self, method_db_path, ssaout_path, backend="native", pool=None, cache=None, format="shards", inline=False, flush_every=None, flush_interval=None, timeout=None):
+        self.method_db = open_methods_db(method_db_path)
+        self.writer = open_writer(ssaout_path, format)
+        self.backend = backend
+        self.pool = pool
+        self.cache = cache
+        self.inline = inline
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.stopping = False
+        self.pending = 0 # requests since the last flush
+        self.last_flush = time.time()
+        self.started = time.time()
+        self.stats = {"requests": 0, "classes": 0, "methods": 0, "errors": 0, "failed_requests": 0}
+
+    def process_path(self, request):
+        path = request.get("path")
+        if not isinstance(path, str) or not os.path.exists(path):
+            return {"id": request.get("id"), "error": f"Invalid path: {path}"}
+        start = time.perf_counter()
+        classes, errors = [], []
+        for entry in iter_classes(path):
+            known = len(self.method_db)
+            statuses = []
+            try:
+                with self.method_db.Batch():
+                    methods = bparser.ProcessClass(entry, self.method_db, self.backend, self.pool, self.cache, statuses, self.timeout)
+            except Exception as e:
+                errors.append({"class": entry.name, "error": f"{e.__class__.__name__}: {e}"})
+                continue
+            with metrics.stage("write"):
+                for method_name, ssaout in methods:
+                    self.writer.Write(entry.name, method_name, ssaout)
+            if metrics.enabled:
+                metrics.methods_db_growth(known, len(self.method_db))
+            result = [{"method": name, "instructions": len(ssaout)} for name, ssaout in methods]
+            if self.inline:
+                for method, (_, ssaout) in zip(result, methods):
+                    method["ssa"] = ssaout
+            failed = [{"method": name, "status": status, "reason": reason} for name, status, reason in statuses if status != "done"]
+            classes.append({"class": entry.name, "methods": result, "failed": failed})
+            self.stats["methods"] += len(methods)
+        self.stats["classes"] += len(classes)
+        self.stats["errors"] += len(errors)
+        self.pending += 1
+        return {"id": request.get("id"), "path": path, "classes": classes, "errors": errors,
+                "ms": round((time.perf_counter() - start) * 1000, 3)}
+
+    def Handle(self, request):
+        self.stats["requests"] += 1
+        op = request.get("op", "process")
+        # a failing request (an unreadable jar, a full disk on flush) is answered, the worker goes on
+        try:
+            if op == "process":
+                response = self.process_path(request)
+            elif op == "flush":
+                self.Flush()
+                response = {"id": request.get("id"), "ok": True}
+            elif op == "stats":
+                response = dict(self.stats, id=request.get("id"), methods_db=len(self.method_db), uptime=round(time.time() - self.started, 3))
+            elif op == "shutdown":
+                self.stopping = True
+                response = {"id": request.get("id"), "ok": True}
+            else:
+                response = {"id": request.get("id"), "error": f"Invalid op: {op}"}
+        except Exception as e:
+            self.stats["failed_requests"] += 1
+            self.pending += 1 # classes before the failure may have been converted
+            response = {"id": request.get("id"), "error": f"{e.__class__.__name__}: {e}"}
+        if self.flush_every is not None and self.pending >= self.flush_every:
+            self.Flush()
+        elif self.IdleTimeout() == 0:
+            self.Flush()
+        metrics.maybe_export()
+        return response
+
+    def HandleRecord(self, raw, strip=True):
+        # one request record as read from the stream; None for empty records
+        text = raw.decode("utf-8", "surrogateescape")
+        if strip:
+            text = text.strip()
+        if not text:
+            return None
+        if not text.startswith("{"):
+            return self.Handle({"path": text})
+        try:
+            request = json.loads(text)
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            return {"error": f"Invalid request: {e}"}
+        return self.Handle(request)
+
+    def IdleTimeout(self):
+        # seconds until pending changes are due to be flushed, None when nothing is pending
+        if self.flush_interval is None or not self.pending:
+            return None
+        return max(0, self.flush_interval - (time.time() - self.last_flush))
+
+    def Flush(self):
+        self.writer.Flush()
+        self.method_db.Flush()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def Close(self):
+        self.writer.Close()
+        self.method_db.Close()
+
+def serve_stream(worker, fileno, recv, send, separator=b"\n"):
+    # reads records until EOF or a shutdown request, flushes while idle
+    buf = b""
+    while not worker.stopping:
+        ready, _, _ = select.select([fileno], [], [], worker.IdleTimeout())
+        if not ready:
+            worker.Flush()
+            continue
+        chunk = recv()
+        if not chunk:
+            break
+        buf += chunk
+        *records, buf = buf.split(separator)
+        for raw in records:
+            response = worker.HandleRecord(raw, separator == b"\n")
+            if response is not None:
+                send((json.dumps(response) + "\n").encode())
+            if worker.stopping:
+                return
+    if buf and not worker.stopping: # the last record had no terminator
+        response = worker.HandleRecord(buf, separator == b"\n")
+        if response is not None:
+            send((json.dumps(response) + "\n").encode())
+
+def serve_stdio(worker, separator=b"\n"):
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr # stdout carries the responses only
+    def send(data):
+        out.write(data)
+        out.flush()
+    serve_stream(worker, 0, lambda: os.read(0, 65536), send, separator)
+
+def serve_socket(worker, path, separator=b"\n"):
+    # one connection at a time, the others wait in the backlog
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    print(f"Listening on {path}")
+    try:
+        while not worker.stopping:
+            ready, _, _ = select.select([listener], [], [], worker.IdleTimeout())
+            if not ready:
+                worker.Flush()
+                continue
+            conn, _ = listener.accept()
+            with conn:
+                try:
+                    serve_stream(worker, conn.fileno(), lambda: conn.recv(65536), conn.sendall, separator)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+def main(method_db_path, ssaout_path, socket_path=None, separator=b"\n", backend="native", cache=None, format="shards", inline=False, flush_every=None, flush_interval=None, timeout=None):
+    pool = None
+    if backend == "opal":
+        from disasm import get_pool
+        pool = get_pool()
+    worker = Worker(method_db_path, ssaout_path, backend, pool, cache, format, inline, flush_every, flush_interval, timeout)
+    # SIGTERM takes the same way out as SIGINT and EOF, so the methods DB and the store are written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if socket_path is not None:
+            serve_socket(worker, socket_path, separator)
+        else:
+            serve_stdio(worker, separator)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.Close()
+    return worker.stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived Java bytecode to SSA converter reading class paths from stdin or a socket")
+    parser.add_argument("method_db", help="method db path (.json, or an SQLite store that is created if missing)")
+    parser.add_argument("ssaout", help="out ssa dir")
+    parser.add_argument("--socket", nargs="?", const=DEFAULT_SOCKET, default=None, help=f"listen on a Unix socket (default: {DEFAULT_SOCKET}) instead of stdin")
+    parser.add_argument("-0", "--null", action="store_true", help="requests are NUL terminated instead of one per line")
+    parser.add_argument("--inline-ssa", action="store_true", help="also send the SSA back in the responses")
+    parser.add_argument("--flush-every", type=int, default=None, help="write the methods DB every N requests")
+    parser.add_argument("--flush-interval", type=float, default=30, help="write pending methods DB changes after N seconds (default: 30)")
+    bparser.add_arguments(parser)
+    args = parser.parse_args()
+    bparser.check_paths(args)
+    cache = bparser.configure_from_args(args)
+    try:
+        stats = main(args.method_db, args.ssaout, args.socket, b"\0" if args.null else b"\n", args.backend, cache, args.format, args.inline_ssa, args.flush_every, args.flush_interval, args.timeout)
+    finally:
+        metrics.export()
+    print(f"{stats['requests']} requests, {stats['classes']} classes, {stats['methods']} methods, {stats['errors']} failed classes, {stats['failed_requests']} failed requests", file=sys.stderr)
+    if cache is not None:
+        print(cache.Stats(), file=sys.stderr)